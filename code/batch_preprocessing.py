@@ -0,0 +1,234 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Data preprocessing of several model variants over the same raw data in one go. Each distinct raw csv is parsed
+# only once, the series being frequency-matched to the sample interval of every variant that uses them and stored in
+# the series cache, see series_cache.SeriesCache. The variants are then preprocessed in parallel worker processes,
+# reading their series from the cache, and each one saves its sets into its own DirStructure.data_dir.
+# Run as: python batch_preprocessing.py RESERVE_input_a.xlsx RESERVE_input_b.xlsx --variants variants.json
+# where variants.json lists further variants as [{"workbook": "RESERVE_input_v1.xlsx", "overrides": {...}}, ...]
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+import pandas as pd
+
+from pipeline import Pipeline
+from series_cache import SeriesCache, DEFAULT_MAX_SIZE_MB
+from data_preprocessing import main, load_configs, get_preprocessing_stages
+from data_preprocessing_util import read_data_checker_csv, match_frequency
+
+
+def parse_variant(variant):
+    """
+    :param variant: str or pathlib.Path of a config workbook, or dict with the path under "workbook" and optionally
+    the main parameters to override under "overrides", see data_preprocessing.load_configs
+    :return: input_excel_path: pathlib.Path. overrides: dict or None
+    """
+    if isinstance(variant, dict):
+        return Path(variant["workbook"]), variant.get("overrides")
+
+    return Path(variant), None
+
+
+def cache_shared_series(model_configs, max_workers=None):
+    """
+    Parse each distinct raw csv used by the models only once, and store its frequency-matched series for the sample
+    interval of every model in the series cache, unless already there
+    :param model_configs: list of (parse_excel_configs.ExcelConfigs, utility.DirStructure). The configs must include
+    the synthesized forecasts, see data_preprocessing_util.add_forecast_configs
+    :param max_workers: int or None. Number of threads parsing the csv files
+    :return: num_parsed: int. Number of csv files parsed
+    """
+    dir_str = model_configs[0][1]
+    series_cache = SeriesCache(
+        dir_str.series_cache_dir,
+        max(
+            getattr(configs, "series_cache_size_mb", DEFAULT_MAX_SIZE_MB)
+            for configs, _ in model_configs
+        ),
+    )
+
+    # Series and sample intervals needed from each csv, across all the models
+    series_requests = {}
+    for configs, dir_str in model_configs:
+        for ts_name, file_name in configs.timeseries_attributes["File Name"].items():
+            csv_path = dir_str.data_checker_dir / file_name
+            series_requests.setdefault(csv_path, set()).add(
+                (ts_name, configs.sample_interval)
+            )
+
+    def cache_series_of_csv(csv_path, requests):
+        keys = {
+            request: series_cache.get_key(csv_path, *request) for request in requests
+        }
+        missing = [
+            request
+            for request, key in keys.items()
+            if not series_cache.get_entry_path(key).exists()
+        ]
+        if not missing:
+            return False
+
+        ts_csv_df = read_data_checker_csv(csv_path)
+        for ts_name, sample_interval in missing:
+            series_cache.save(
+                keys[(ts_name, sample_interval)],
+                *match_frequency(ts_csv_df, ts_name, sample_interval)
+            )
+        return True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        is_parsed = list(
+            executor.map(
+                cache_series_of_csv, series_requests.keys(), series_requests.values()
+            )
+        )
+
+    return sum(is_parsed)
+
+
+def run_variant(variant, incremental=False, chunk_size=None):
+    """
+    Preprocess a single variant, in a worker process
+    :return: wall_time_s: float
+    """
+    input_excel_path, overrides = parse_variant(variant)
+    tic = time.perf_counter()
+    main(
+        incremental=incremental,
+        chunk_size=chunk_size,
+        input_excel_path=input_excel_path,
+        overrides=overrides,
+    )
+
+    return time.perf_counter() - tic
+
+
+def run_batch(variants, max_workers=None, incremental=False, chunk_size=None):
+    """
+    Preprocess several model variants, sharing the parsing of the raw data across them. The forecasts are
+    synthesized model by model first, as they are saved among the raw data shared by all the models
+    :param variants: list of variants, see parse_variant. Every variant must have its own model name
+    :param max_workers: int or None. Number of worker processes, by default one per variant up to the number of CPUs
+    :param incremental: bool. See data_preprocessing.run_preprocessing
+    :param chunk_size: str or pd.Timedelta or None. See data_preprocessing.run_preprocessing
+    :return: batch_df: pd.DataFrame of the status and wall time of each model
+    """
+    print("=== Parse the configs of {} models ===".format(len(variants)))
+    model_configs = [load_configs(*parse_variant(variant)) for variant in variants]
+    model_names = pd.Series([configs.model_name for configs, _ in model_configs])
+    if model_names.duplicated().any():
+        raise ValueError(
+            "Model names must be unique across the batch, {} found more than once!".format(
+                list(model_names[model_names.duplicated()].unique())
+            )
+        )
+
+    for configs, dir_str in model_configs:
+        print("=== Synthesize forecasts of {} ===".format(configs.model_name))
+        Pipeline(
+            get_preprocessing_stages(), configs, dir_str, dir_str.pipeline_cache_dir
+        ).run("synthesize_forecast")
+
+    print("=== Read in the raw series shared by all models ===")
+    num_parsed = cache_shared_series(model_configs)
+    print("{} raw files parsed".format(num_parsed))
+
+    if max_workers is None:
+        max_workers = min(len(variants), os.cpu_count() or 1)
+    print("=== Preprocess the models in {} worker processes ===".format(max_workers))
+    batch_df = pd.DataFrame(
+        {"status": "done", "wall_time_s": float("nan")},
+        index=pd.Index(model_names, name="model_name"),
+    )
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_variant, variant, incremental, chunk_size)
+            for variant in variants
+        ]
+        # Wait for all the models, even if some of them fail
+        for model_name, future in zip(model_names, futures):
+            try:
+                batch_df.loc[model_name, "wall_time_s"] = future.result()
+            except Exception as error:
+                batch_df.loc[model_name, "status"] = "failed: {!r}".format(error)
+
+    print(batch_df.to_string())
+    failed = batch_df.index[batch_df["status"] != "done"]
+    if len(failed) > 0:
+        raise RuntimeError("Preprocessing failed for {}!".format(list(failed)))
+
+    print("All done!")
+    return batch_df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="RESERVE data preprocessing of several models"
+    )
+    parser.add_argument(
+        "workbooks", nargs="*", help="config workbooks of the models to preprocess"
+    )
+    parser.add_argument(
+        "--variants",
+        default=None,
+        help="json file listing further variants, each as a workbook path or as "
+        '{"workbook": path, "overrides": {main parameter: value}}',
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="number of worker processes, by default one per model up to the number of CPUs",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process data after the last saved sample of each model",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        default=None,
+        help="process the data in time chunks of this length, e.g. 30D, and save the sets in shards",
+    )
+    return parser.parse_args()
+
+
+# run as a script
+if __name__ == "__main__":
+    args = parse_args()
+    variants = list(args.workbooks)
+    if args.variants is not None:
+        with open(args.variants) as f:
+            variants += json.load(f)
+    if not variants:
+        raise ValueError("No model to preprocess, pass config workbooks or --variants!")
+
+    run_batch(
+        variants,
+        max_workers=args.max_workers,
+        incremental=args.incremental,
+        chunk_size=args.chunk_size,
+    )
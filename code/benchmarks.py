@@ -0,0 +1,503 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Script to time the hot paths of the model on synthetic data, see synthetic_data.py, at several scales. Results are
+# saved as JSON, so that they can be compared across versions of the code.
+# Run as: python benchmarks.py --scales small medium --compare ../diagnostics/benchmarks/<earlier results>.json
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import types
+import warnings
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+import cross_val
+import metrics
+from calendrical_predictors import CalendricalPredictors
+from parse_excel_configs import ExcelConfigs
+from synthetic_data import (
+    make_synthetic_series,
+    make_synthetic_configs,
+    write_config_workbook,
+)
+from data_preprocessing_util import (
+    COL_NAME_DATETIME,
+    match_frequency,
+    calculate_forecast_error,
+    pad_data_w_buffer,
+    generate_lag_and_lead_terms,
+    build_lag_and_lead_matrix,
+)
+
+BENCHMARK_VERSION = 1
+# Length of the synthetic history of each scale, in days
+BENCHMARK_SCALES = {"small": 30, "medium": 365, "large": 3 * 365}
+# Number of cross validation folds and quantiles of the synthetic predictions
+NUM_CV_FOLDS = 5
+TAUS = [0.025, 0.05, 0.5, 0.95, 0.975]
+DEFAULT_RESULTS_DIR = Path.cwd().parents[0] / "diagnostics" / "benchmarks"
+
+
+def time_function(func, *args, num_repeats=3, **kwargs):
+    """
+    Time a function call, returning the best wall time out of a few repeats together with the last result. Anything
+    printed by the function is swallowed
+    :param func: callable to be timed
+    :param num_repeats: int. Number of times to repeat the call
+    :return: best_time: float. Shortest wall time in seconds. result: the return value of the last call
+    """
+    best_time = np.inf
+    result = None
+    for _ in range(num_repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            tic = time.perf_counter()
+            result = func(*args, **kwargs)
+            best_time = min(best_time, time.perf_counter() - tic)
+
+    return best_time, result
+
+
+def make_synthetic_ts_data(num_days, num_features, sample_interval, invalid_frac=0.01):
+    """
+    Create a random time series data frame with the same layout as the one read in by read_all_timeseries
+    :param num_days: int. Length of the history in days
+    :param num_features: int. Number of time series
+    :param sample_interval: pd.Timedelta. Interval between samples
+    :param invalid_frac: float. Fraction of values marked as invalid, i.e. replaced with NaN
+    :return: ts_data_df: pd.DataFrame of (M,N)
+    """
+    rng = np.random.default_rng(0)
+    index = pd.date_range(
+        "2018-01-01",
+        periods=int(pd.Timedelta("1D") / sample_interval * num_days),
+        freq=sample_interval,
+    )
+    values = rng.normal(size=(len(index), num_features))
+    values[rng.random(values.shape) < invalid_frac] = np.nan
+
+    return pd.DataFrame(
+        values,
+        index=index,
+        columns=["feature_{}".format(i) for i in range(num_features)],
+    )
+
+
+def make_synthetic_predictions(output_trainval, taus, num_cv_folds, seed=0):
+    """
+    Quantile predictions of each output in the layout of pred_trainval, i.e. with (tau, CV fold, output) columns
+    :param output_trainval: pd.DataFrame of (M,O). The outputs to predict
+    :param taus: list of float. Quantiles predicted
+    :param num_cv_folds: int. Number of cross validation folds
+    :return: pred_trainval: pd.DataFrame of (M, len(taus) * num_cv_folds * O)
+    """
+    rng = np.random.default_rng(seed)
+    outputs = output_trainval.fillna(0)
+    columns = pd.MultiIndex.from_product(
+        [taus, range(num_cv_folds), output_trainval.columns]
+    )
+    pred_values = np.stack(
+        [
+            0.5 * outputs[output].to_numpy()
+            + norm.ppf(tau) * outputs[output].std()
+            + rng.normal(scale=0.1 * outputs[output].std(), size=len(outputs))
+            for tau, _, output in columns
+        ],
+        axis=1,
+    )
+
+    return pd.DataFrame(pred_values, index=output_trainval.index, columns=columns)
+
+
+class BenchmarkInputs(object):
+    """
+    Synthetic inputs of the benchmarks at one scale, created once and shared by all of them
+    """
+
+    def __init__(self, num_days, work_dir):
+        """
+        Args:
+            num_days: int. Length of the synthetic history in days
+            work_dir: pathlib.Path. Scratch directory for the files written by the benchmarked functions
+        """
+        self.num_days = num_days
+        self.work_dir = Path(work_dir)
+
+        self.ts_csv_dfs = {
+            ts_name: ts_csv_df.set_index(COL_NAME_DATETIME)
+            for ts_name, ts_csv_df in make_synthetic_series(num_days=num_days).items()
+        }
+        file_names = {ts_name: ts_name + ".csv" for ts_name in self.ts_csv_dfs}
+        config_path = self.work_dir / "RESERVE_input_synthetic.xlsx"
+        write_config_workbook(
+            make_synthetic_configs(file_names, num_days=num_days), config_path
+        )
+        self.configs = ExcelConfigs(config_path)
+        self.dir_str = types.SimpleNamespace(data_checker_dir=self.work_dir)
+
+        # The series on the model time grid, as read in by read_all_timeseries
+        self.ts_data_df = pd.concat(
+            [
+                match_frequency(ts_csv_df, ts_name, self.configs.sample_interval)[0]
+                for ts_name, ts_csv_df in self.ts_csv_dfs.items()
+            ],
+            axis=1,
+        )
+
+
+def get_result(benchmark, scale, best_time, num_repeats, data_shape):
+    return {
+        "benchmark": benchmark,
+        "scale": scale,
+        "num_rows": int(data_shape[0]),
+        "num_columns": int(data_shape[1]),
+        "best_time_s": best_time,
+        "num_repeats": num_repeats,
+    }
+
+
+def benchmark_match_frequency(inputs, scale, num_repeats=3):
+    """
+    Match a high frequency ts to the model time step, creating its sub time series
+    """
+    ts_csv_df = inputs.ts_csv_dfs["load_actuals"]
+    best_time, _ = time_function(
+        match_frequency,
+        ts_csv_df,
+        "load_actuals",
+        inputs.configs.sample_interval,
+        num_repeats=num_repeats,
+    )
+
+    return [
+        get_result("match_frequency", scale, best_time, num_repeats, ts_csv_df.shape)
+    ]
+
+
+def benchmark_lag_and_lead_terms(inputs, scale, num_repeats=3, num_lags=12):
+    """
+    Compare the column-by-column generate_lag_and_lead_terms against the vectorized build_lag_and_lead_matrix
+    """
+    ts_data_df = inputs.ts_data_df
+    lag_term_configs = pd.DataFrame(
+        [[-num_lags, 0, 1]] * ts_data_df.shape[1],
+        index=ts_data_df.columns,
+        columns=["Start", "End", "Step"],
+    )
+    lead_term_configs = pd.DataFrame(
+        [[1, 1, 1]], index=ts_data_df.columns[:1], columns=["Start", "End", "Step"]
+    )
+    ts_data_df = pad_data_w_buffer(
+        ts_data_df,
+        lag_term_configs,
+        lead_term_configs,
+        inputs.configs.sample_interval,
+    )
+
+    # The column-by-column assignment is exactly what pandas warns about, silence it while timing
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", pd.errors.PerformanceWarning)
+        old_time, (old_df, old_is_input) = time_function(
+            generate_lag_and_lead_terms,
+            ts_data_df,
+            lag_term_configs,
+            lead_term_configs,
+            num_repeats=1,
+        )
+    new_time, (new_df, new_is_input) = time_function(
+        build_lag_and_lead_matrix,
+        ts_data_df,
+        lag_term_configs,
+        lead_term_configs,
+        num_repeats=num_repeats,
+    )
+
+    # Both implementations must agree on labels, values and input/output tags
+    assert (old_df.columns == new_df.columns).all()
+    assert (old_is_input.values == new_is_input.values).all()
+    np.testing.assert_array_equal(old_df.astype("float32").values, new_df.values)
+
+    return [
+        get_result("generate_lag_and_lead_terms", scale, old_time, 1, old_df.shape),
+        get_result(
+            "build_lag_and_lead_matrix", scale, new_time, num_repeats, new_df.shape
+        ),
+    ]
+
+
+def benchmark_calendrical_predictors(inputs, scale, num_repeats=3):
+    """
+    Calculate all calendar-based predictors, with the solar position calculated from scratch
+    """
+    best_time, cal_predictors = time_function(
+        CalendricalPredictors,
+        inputs.ts_data_df.index,
+        inputs.configs,
+        num_repeats=num_repeats,
+    )
+
+    return [
+        get_result(
+            "CalendricalPredictors",
+            scale,
+            best_time,
+            num_repeats,
+            cal_predictors.data.shape,
+        )
+    ]
+
+
+def benchmark_calculate_forecast_error(inputs, scale, num_repeats=3):
+    """
+    Calculate the forecast errors of all categories. The configs are updated in place, so each call gets its own copy
+    """
+
+    def calculate_on_copy():
+        return calculate_forecast_error(
+            inputs.ts_data_df, copy.deepcopy(inputs.configs), inputs.dir_str
+        )
+
+    best_time, ts_data_df = time_function(calculate_on_copy, num_repeats=num_repeats)
+
+    return [
+        get_result(
+            "calculate_forecast_error", scale, best_time, num_repeats, ts_data_df.shape
+        )
+    ]
+
+
+def benchmark_cv_masks(inputs, scale, num_repeats=3):
+    """
+    Shuffle the days of the trainval set and create the validation masks of each fold from scratch
+    """
+    trainval_datetimes = inputs.ts_data_df.index
+    shuffled_indices_paths = iter(
+        inputs.work_dir / "shuffled_indices_{}.npy".format(i)
+        for i in range(num_repeats)
+    )
+
+    best_time, val_masks = time_function(
+        lambda: cross_val.get_CV_masks(
+            trainval_datetimes, NUM_CV_FOLDS, next(shuffled_indices_paths)
+        ),
+        num_repeats=num_repeats,
+    )
+
+    return [
+        get_result(
+            "cross_val.get_CV_masks", scale, best_time, num_repeats, val_masks.T.shape
+        )
+    ]
+
+
+def benchmark_metrics(inputs, scale, num_repeats=3):
+    """
+    Compute the metrics and count the quantile crossings of synthetic predictions of the forecast errors
+    """
+    output_trainval = calculate_forecast_error(
+        inputs.ts_data_df, copy.deepcopy(inputs.configs), inputs.dir_str
+    ).filter(like="Forecast_Error")
+    pred_trainval = make_synthetic_predictions(output_trainval, TAUS, NUM_CV_FOLDS)
+    with contextlib.redirect_stdout(io.StringIO()):
+        val_masks = cross_val.get_CV_masks(
+            output_trainval.index,
+            NUM_CV_FOLDS,
+            inputs.work_dir / "metrics_shuffled_indices.npy",
+        )
+
+    metrics_time, _ = time_function(
+        metrics.compute_metrics_for_all_taus,
+        output_trainval,
+        pred_trainval,
+        val_masks=val_masks,
+        num_repeats=num_repeats,
+    )
+    crossings_time, _ = time_function(
+        metrics.n_crossings, pred_trainval, num_repeats=num_repeats
+    )
+
+    return [
+        get_result(
+            "metrics.compute_metrics_for_all_taus",
+            scale,
+            metrics_time,
+            num_repeats,
+            pred_trainval.shape,
+        ),
+        get_result(
+            "metrics.n_crossings",
+            scale,
+            crossings_time,
+            num_repeats,
+            pred_trainval.shape,
+        ),
+    ]
+
+
+BENCHMARKS = [
+    benchmark_match_frequency,
+    benchmark_lag_and_lead_terms,
+    benchmark_calendrical_predictors,
+    benchmark_calculate_forecast_error,
+    benchmark_cv_masks,
+    benchmark_metrics,
+]
+
+
+def run_benchmarks(scales=("small", "medium"), num_repeats=3):
+    """
+    Run all benchmarks at each scale
+    :param scales: list of str. Keys of BENCHMARK_SCALES
+    :param num_repeats: int. Number of times each function is called, the best time being kept
+    :return: results: list of dict, one per benchmark and scale
+    """
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as work_dir:
+            print("=== Creating the {} synthetic inputs ===".format(scale))
+            inputs = BenchmarkInputs(BENCHMARK_SCALES[scale], work_dir)
+            for benchmark in BENCHMARKS:
+                for result in benchmark(inputs, scale, num_repeats=num_repeats):
+                    print(
+                        "{benchmark}, {scale} ({num_rows} x {num_columns}): {best_time_s:.4f}s".format(
+                            **result
+                        )
+                    )
+                    results.append(result)
+
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, results_path):
+    """
+    Save the benchmark results as JSON, along with the versions they were obtained with
+    :param results: list of dict. Output of run_benchmarks
+    :param results_path: pathlib.Path
+    """
+    Path.mkdir(results_path.parent, parents=True, exist_ok=True)
+    with open(results_path, "w") as f:
+        json.dump(
+            {
+                "benchmark_version": BENCHMARK_VERSION,
+                "created_at": pd.Timestamp.now().isoformat(),
+                "git_commit": get_git_commit(),
+                "python_version": platform.python_version(),
+                "pandas_version": pd.__version__,
+                "numpy_version": np.__version__,
+                "cpu_count": os.cpu_count(),
+                "scales": BENCHMARK_SCALES,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def compare_results(results, baseline_path):
+    """
+    Compare benchmark results against earlier ones
+    :param results: list of dict. Output of run_benchmarks
+    :param baseline_path: pathlib.Path. Results saved earlier by save_results
+    :return: comparison_df: pd.DataFrame of the best times of both, and the speedup over the baseline
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    keys = ["benchmark", "scale"]
+    comparison_df = pd.merge(
+        pd.DataFrame(baseline["results"])[keys + ["best_time_s"]],
+        pd.DataFrame(results)[keys + ["best_time_s"]],
+        on=keys,
+        suffixes=("_baseline", "_current"),
+    )
+    comparison_df["speedup"] = (
+        comparison_df["best_time_s_baseline"] / comparison_df["best_time_s_current"]
+    )
+
+    return comparison_df
+
+
+def main(scales=("small", "medium"), num_repeats=3, output=None, compare=None):
+    results = run_benchmarks(scales, num_repeats)
+
+    if output is None:
+        output = DEFAULT_RESULTS_DIR / "benchmarks_{}.json".format(
+            pd.Timestamp.now().strftime("%Y%m%d_%H%M%S")
+        )
+    save_results(results, Path(output))
+    print("Results saved to {}".format(output))
+
+    if compare is not None:
+        print(compare_results(results, compare).to_string(index=False))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="RESERVE benchmarks")
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        default=["small", "medium"],
+        choices=list(BENCHMARK_SCALES),
+        help="scales of the synthetic inputs to run the benchmarks at",
+    )
+    parser.add_argument(
+        "--num-repeats",
+        type=int,
+        default=3,
+        help="number of times each function is called, the best time being kept",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="path to save the results to, by default a timestamped file in ../diagnostics/benchmarks",
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="path to earlier results to compare against",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(**vars(parse_args()))
@@ -1,19 +1,96 @@
+import functools
 import pandas as pd
-from pandas.tseries.holiday import USFederalHolidayCalendar as Calendar
+from pandas.tseries.holiday import AbstractHolidayCalendar, get_calendar
 import numpy as np
 import pvlib
 
+from solar_cache import SolarCache, SOLAR_POSITION
+
 # used in the elapsed time attribute calculation
 START_DATE = pd.Timestamp("20200101")
+# Names of the days of week, sorted as the day of week indicators were originally ordered
+DAY_NAMES = sorted(
+    ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+)
+# Holiday calendar used unless the configs specify another one
+DEFAULT_HOLIDAY_CALENDAR = "USFederalHolidayCalendar"
+# Calendar features, in the order their columns are laid out in the data
+FEATURE_NAMES = [
+    "is_holiday",
+    "is_day_of_week",
+    "elapsed_time",
+    "sin_rev_angle",
+    "cos_rev_angle",
+    "sin_rot_angle",
+    "cos_rot_angle",
+    "sin_solar_azimuth_angle",
+    "cos_solar_azimuth_angle",
+    "sin_solar_zenith_angle",
+    "cos_solar_zenith_angle",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def get_holiday_dates(calendar_name, start_year, end_year):
+    """
+    Dates of the holidays in a range of whole years. Results are cached, so the holiday rules of a calendar are only
+    evaluated once per process, no matter how many chunks or models use them
+    :param calendar_name: str. Name of a registered holiday calendar. Every subclass of pandas'
+    AbstractHolidayCalendar is registered under its class name
+    :param start_year: int. First year of the range
+    :param end_year: int. Last year of the range, inclusive
+    :return: holiday_dates: np.ndarray of datetime64[ns]. Sorted dates of the holidays, at midnight
+    """
+    holidays = get_calendar(calendar_name).holidays(
+        start=pd.Timestamp(year=start_year, month=1, day=1),
+        end=pd.Timestamp(year=end_year, month=12, day=31),
+    )
+    holiday_dates = holidays.values
+    holiday_dates.setflags(write=False)  # shared by all callers
+
+    return holiday_dates
+
+
+def get_holiday_calendar_name(holiday_calendar):
+    """
+    Name of a holiday calendar given in any of the supported forms
+    :param holiday_calendar: str, AbstractHolidayCalendar subclass or instance, or None for the default calendar
+    :return: calendar_name: str
+    """
+    if holiday_calendar is None:
+        return DEFAULT_HOLIDAY_CALENDAR
+    elif isinstance(holiday_calendar, str):
+        return holiday_calendar
+    elif isinstance(holiday_calendar, type) and issubclass(
+        holiday_calendar, AbstractHolidayCalendar
+    ):
+        return holiday_calendar.__name__
+    elif isinstance(holiday_calendar, AbstractHolidayCalendar):
+        return holiday_calendar.name
+    else:
+        raise ValueError(
+            "Holiday calendar must be the name, the class or an instance of a pandas holiday calendar!"
+        )
 
 
 class CalendricalPredictors(object):
-    def __init__(self, dt_series, configs):
+    """
+    Calendar-based predictors of a series of datetimes. Most calendar features only depend on the date or only on
+    the time of day, so they are calculated once for each unique date or time of day, and then broadcast to all the
+    datetimes by integer indexing into a single float32 block.
+    """
+
+    def __init__(self, dt_series, configs, solar_cache_dir=None, holiday_calendar=None):
         """
         Reference for formula:C.B.Honsberg and S.G.Bowden, “Photovoltaics Education Website,” www.pveducation.org, 2019
         Args:
             dt_series:
             configs:
+            solar_cache_dir: pathlib.Path or None. If provided, the solar position is looked up from the solar cache
+            in this directory, see solar_cache.SolarCache, instead of being calculated from scratch
+            holiday_calendar: str, pandas AbstractHolidayCalendar subclass or instance, or None. Calendar the holidays
+            are taken from. If None, the optional "Holiday Calendar" main parameter is used, and otherwise the US
+            federal holidays
         """
         geo_params = ["latitude", "longitude", "tz_from_utc"]
         for geo_param in geo_params:
@@ -22,37 +99,47 @@ class CalendricalPredictors(object):
             else:
                 setattr(self, geo_param, 0)
 
-        # Initialization of all class attributes
-        self.dt_series = pd.to_datetime(dt_series)
-        self.data = pd.DataFrame(index=dt_series)
-        self.is_holiday = None
-        self.is_day_of_week = None
-        self.elapsed_time = None
-        self.sin_rev_angle = None
-        self.cos_rev_angle = None
-        self.sin_rot_angle = None
-        self.cos_rot_angle = None
-        self.sin_solar_azimuth_angle = None
-        self.cos_solar_azimuth_angle = None
-        self.sin_solar_zenith_angle = None
-        self.cos_solar_zenith_angle = None
-        non_feature_attrs = geo_params + [
-            "dt_series",
-            "data",
-        ]  # the attributes that don't end up as features
+        self.solar_cache = None
+        if solar_cache_dir is not None:
+            self.solar_cache = SolarCache(
+                solar_cache_dir,
+                self.latitude,
+                self.longitude,
+                self.tz_from_utc,
+                configs.sample_interval,
+            )
+        if holiday_calendar is None:
+            holiday_calendar = getattr(configs, "holiday_calendar", None)
+        self.holiday_calendar_name = get_holiday_calendar_name(holiday_calendar)
+
+        self.dt_series = pd.DatetimeIndex(pd.to_datetime(dt_series))
+        # Position of each datetime among the unique dates and the unique times of day
+        day_start = self.dt_series.normalize()
+        self.date_pos, self.dates = pd.factorize(day_start)
+        self.time_of_day_pos, self.times_of_day = pd.factorize(
+            self.dt_series - day_start
+        )
 
+        # Each feature is calculated on its own level, either per date, per time of day or per datetime, as a tuple
+        # of (column names, 2D array of values, positions of the datetimes in the rows of the values or None)
+        self.features = {}
         for temporal_feature in configs.temporal_features.index:
             if configs.temporal_features.loc[temporal_feature, "To include?"]:
                 getattr(self, "get_" + temporal_feature.lower().replace(" ", "_"))()
 
-        # collect features into the data attribute:
-        for attr in self.__dict__.keys():
-            attribute_data = getattr(self, attr)
-            if (attr not in non_feature_attrs) and (attribute_data is not None):
-                if isinstance(attribute_data, pd.Series):
-                    self.data[attr] = attribute_data
-                elif isinstance(attribute_data, pd.DataFrame):
-                    self.data = pd.concat([self.data, attribute_data], axis=1)
+        # broadcast all features into the data attribute in one go
+        feature_names = [name for name in FEATURE_NAMES if name in self.features]
+        columns = [col for name in feature_names for col in self.features[name][0]]
+        block = np.empty((len(self.dt_series), len(columns)), dtype="float32")
+        col_start = 0
+        for name in feature_names:
+            feature_columns, values, positions = self.features[name]
+            col_end = col_start + len(feature_columns)
+            block[:, col_start:col_end] = (
+                values if positions is None else values[positions]
+            )
+            col_start = col_end
+        self.data = pd.DataFrame(block, index=dt_series, columns=columns)
 
         # generation the lag configuration for the Calendar terms
         self.cal_term_configs = pd.DataFrame(
@@ -64,49 +151,70 @@ class CalendricalPredictors(object):
             1,
         ]  # no reason to include lagged version of the Calendar terms
 
+    def add_feature(self, name, columns, values, positions=None):
+        """
+        Record a calculated feature, to be broadcast into the data attribute
+        :param name: str. One of FEATURE_NAMES
+        :param columns: list of str. Column names of the feature in the data
+        :param values: np.ndarray of [number of unique dates, times of day or datetimes] or with one column per
+        column name
+        :param positions: np.ndarray of int or None. Row of the values for each datetime, None if there's one row for
+        each datetime already
+        """
+        values = np.asarray(values, dtype="float32")
+        if values.ndim == 1:
+            values = values[:, None]
+        self.features[name] = (columns, values, positions)
+
     def get_holiday(self):
         """
         See if the datetime falls on a holiday
         """
-        holidays = Calendar().holidays(
-            start=self.dt_series.min(), end=self.dt_series.max()
+        holiday_dates = get_holiday_dates(
+            self.holiday_calendar_name, self.dates.year.min(), self.dates.year.max()
+        )
+        self.add_feature(
+            "is_holiday",
+            ["is_holiday"],
+            self.dates.isin(holiday_dates),
+            self.date_pos,
         )
-        self.is_holiday = pd.Series(
-            self.dt_series.isin(holidays), index=self.dt_series
-        ).astype("int")
 
     def get_day_of_week(self):
         # Day of week indicator. 7 binary indicator variables, one each for Mon to Sun
-        day_of_week = self.dt_series.day_name()
-        self.is_day_of_week = pd.get_dummies(day_of_week, prefix="is").set_index(
-            self.dt_series
+        # All 7 are always created, even if some days are missing from a short range of datetimes
+        day_names = self.dates.day_name().to_numpy()
+        self.add_feature(
+            "is_day_of_week",
+            ["is_{}".format(day_name) for day_name in DAY_NAMES],
+            day_names[:, None] == np.array(DAY_NAMES)[None, :],
+            self.date_pos,
         )
 
     def get_revolution_angle(self):
         """
         Revolution angle corresponds to day of year, transformed to radians and in turn sine and cosine.
         """
-        # The grammar here is a bit hacky, but the second subtraction sign is overloaded with pd syntax to move dates
-        time_from_year_start = self.dt_series - (
-            self.dt_series - pd.offsets.YearBegin()
+        days_in_year = np.where(self.dates.is_leap_year, 366, 365)
+        rev_angle = (self.dates.dayofyear - 1) / days_in_year * 2 * np.pi
+        self.add_feature(
+            "sin_rev_angle", ["sin_rev_angle"], np.sin(rev_angle), self.date_pos
         )
-        time_in_a_year = (self.dt_series + pd.offsets.YearBegin()) - (
-            self.dt_series - pd.offsets.YearBegin()
+        self.add_feature(
+            "cos_rev_angle", ["cos_rev_angle"], np.cos(rev_angle), self.date_pos
         )
 
-        # calculate revolution angle and sine and cosine values
-        rev_angle = time_from_year_start / time_in_a_year * 2 * np.pi
-        self.sin_rev_angle = pd.Series(np.sin(rev_angle), index=self.dt_series)
-        self.cos_rev_angle = pd.Series(np.cos(rev_angle), index=self.dt_series)
-
     def get_rotation_angle(self):
         """
         Rotation angle corresponds to hour of day, transformed to radians and in turn trigonometric values.
         """
-        time_from_day_start = self.dt_series - self.dt_series.normalize()
-        rot_angle = time_from_day_start / pd.Timedelta("1D") * 2 * np.pi
-        self.sin_rot_angle = pd.Series(np.sin(rot_angle), index=self.dt_series)
-        self.cos_rot_angle = pd.Series(np.cos(rot_angle), index=self.dt_series)
+        rot_angle = self.times_of_day / pd.Timedelta("1D") * 2 * np.pi
+        self.add_feature(
+            "sin_rot_angle", ["sin_rot_angle"], np.sin(rot_angle), self.time_of_day_pos
+        )
+        self.add_feature(
+            "cos_rot_angle", ["cos_rot_angle"], np.cos(rot_angle), self.time_of_day_pos
+        )
 
     def get_elapsed_time(self):
         """
@@ -114,20 +222,30 @@ class CalendricalPredictors(object):
         installation or load. Represented as days or fraction of days since an arbitrarily defined start_date
 
         """
-        self.elapsed_time = (self.dt_series - START_DATE).total_seconds() / 3600 / 24
-        self.elapsed_time = pd.Series(self.elapsed_time, index=self.dt_series)
+        elapsed_time = (self.dt_series - START_DATE).total_seconds() / 3600 / 24
+        self.add_feature("elapsed_time", ["elapsed_time"], elapsed_time)
 
     def get_solar_position(self):
-        UTC_time = self.dt_series - self.tz_from_utc * pd.Timedelta("1H")
-        position_df = pvlib.solarposition.get_solarposition(
-            UTC_time, self.latitude, self.longitude
-        )
-        # Convert back to local time and to degrees
-        position_df = np.deg2rad(position_df.set_index(self.dt_series))
-        self.sin_solar_zenith_angle = np.sin(position_df["apparent_zenith"])
-        self.cos_solar_zenith_angle = np.cos(position_df["apparent_zenith"])
-        self.sin_solar_azimuth_angle = np.sin(position_df["azimuth"])
-        self.cos_solar_azimuth_angle = np.cos(position_df["azimuth"])
+        if self.solar_cache is not None:
+            position_df = self.solar_cache.query(self.dt_series, SOLAR_POSITION)
+        else:
+            UTC_time = self.dt_series - self.tz_from_utc * pd.Timedelta("1H")
+            position_df = pvlib.solarposition.get_solarposition(
+                UTC_time, self.latitude, self.longitude
+            )
+        # Convert to radians
+        position_df = np.deg2rad(position_df)
+        for angle, position_col in [
+            ("solar_azimuth_angle", "azimuth"),
+            ("solar_zenith_angle", "apparent_zenith"),
+        ]:
+            for trig_name, trig_func in [("sin", np.sin), ("cos", np.cos)]:
+                feature_name = "{}_{}".format(trig_name, angle)
+                self.add_feature(
+                    feature_name,
+                    [feature_name],
+                    trig_func(position_df[position_col].to_numpy()),
+                )
 
 
 def calculate_clear_sky_output(
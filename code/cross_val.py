@@ -20,76 +20,280 @@
 # #############################################################################
 
 import os
+import json
+import hashlib
+from pathlib import Path
 import pandas as pd
 import numpy as np
 
+# Seed of the day shuffling, so that the folds can be recreated if the shuffled indices are lost
+DEFAULT_SHUFFLE_SEED = 0
+# Number of samples read in at once when computing the normalization statistics
+NORM_STATS_CHUNK_SIZE = 2**14
 
-## Master function
-def get_CV_masks(trainval_datetimes, num_of_cv_folds, path_to_shuffled_indices):
 
+## Master function
+def get_CV_masks(
+    trainval_datetimes,
+    num_of_cv_folds,
+    path_to_shuffled_indices,
+    seed=DEFAULT_SHUFFLE_SEED,
+):
     """
-    Gets the masks determining what data goes into validation for each of the cross-validation folds. The shuffled
-    indices are either read from a pre-determined file or created ad-hoc.
-    :param trainval_datetimes: a length N DataFrame holding datetimes for each sample. Totalling N samples
+    Gets the masks determining what data goes into validation for each of the cross-validation folds, see
+    get_fold_ids. For a single fold, get_val_mask avoids materializing the masks of all the folds.
+    :param trainval_datetimes: a length N DatetimeIndex holding datetimes for each sample. Totalling N samples
     :param num_of_cv_folds: # of cross validation folds
     :param path_to_shuffled_indices: Path to save/read shuffled indices (as a .npy)
+    :param seed: int. Seed of the day shuffling, only used if the shuffled indices are created
     :return: val_masks_all_folds: A boolean 2D np array. The first dimension corresponds to the num_of_cv_folds,
              while the 2nd dimension is for each sample. True means this sample belongs to the validation set
              in this cross validation fold.
     """
+    fold_ids = get_fold_ids(
+        trainval_datetimes,
+        num_of_cv_folds,
+        path_to_shuffled_indices,
+        seed,
+    )
 
+    return fold_ids[np.newaxis, :] == np.arange(num_of_cv_folds)[:, np.newaxis]
+
+
+def get_fold_ids(
+    trainval_datetimes,
+    num_of_cv_folds,
+    path_to_shuffled_indices,
+    seed=DEFAULT_SHUFFLE_SEED,
+):
+    """
+    Gets the cross-validation fold each sample is validated in. The shuffled indices are either read from a
+    pre-determined file, if it was created for the same samples, or created ad-hoc.
+    :param trainval_datetimes: a length N DatetimeIndex holding datetimes for each sample. Totalling N samples
+    :param num_of_cv_folds: # of cross validation folds
+    :param path_to_shuffled_indices: Path to save/read shuffled indices (as a .npy)
+    :param seed: int. Seed of the day shuffling, only used if the shuffled indices are created
+    :return: fold_ids: np.array of N int8. The index of the fold in whose validation set each sample is
+    """
     # If day shuffling is pre-determined, use that info
-    if os.path.exists(path_to_shuffled_indices):
-        print("Day block shuffling pre-determnined....")
-        day_block_shuffled_indices = np.load(path_to_shuffled_indices)
+    day_block_shuffled_indices = read_shuffled_indices(
+        trainval_datetimes, path_to_shuffled_indices
+    )
     # Else, perform day shuffling
-    else:
+    if day_block_shuffled_indices is None:
         print("Performing day shuffling....")
         # Get indices that will shuffle days
         day_block_shuffled_indices = create_and_shuffle_day_blocks(
-            trainval_datetimes, path_to_shuffled_indices
+            trainval_datetimes, path_to_shuffled_indices, seed
         )
+    else:
+        print("Day block shuffling pre-determined....")
     print("Done....")
 
     # Now split into train and val sets for each fold, to be returned to caller
-    print("Creating train val masks for each fold....")
-    val_masks_all_folds = create_val_masks_for_each_fold(
-        day_block_shuffled_indices, num_of_cv_folds
+    print("Assigning samples to each fold....")
+    fold_ids = create_fold_ids(day_block_shuffled_indices, num_of_cv_folds)
+    print("Folds are ready!")
+
+    return fold_ids
+
+
+def get_fold_sizes(fold_ids, num_of_cv_folds):
+    """
+    :param fold_ids: np.array of N int8. See get_fold_ids
+    :param num_of_cv_folds: # of cross validation folds
+    :return: fold_sizes: np.array of num_of_cv_folds int. Number of samples validated in each fold
+    :raises ValueError: if a fold has no validation samples, e.g. with fewer samples than folds, as it could
+    neither be early stopped nor evaluated
+    """
+    fold_sizes = np.bincount(fold_ids, minlength=num_of_cv_folds)
+    if len(fold_sizes) > num_of_cv_folds:
+        raise ValueError(
+            "Fold ids go up to {}, for {} folds!".format(
+                len(fold_sizes) - 1, num_of_cv_folds
+            )
+        )
+    if (fold_sizes == 0).any():
+        raise ValueError(
+            "Folds {} have no validation samples, please use fewer folds!".format(
+                list(np.flatnonzero(fold_sizes == 0))
+            )
+        )
+
+    return fold_sizes
+
+
+def get_val_mask(fold_ids, cv_fold_index):
+    """
+    :param fold_ids: np.array of N int8. See get_fold_ids
+    :param cv_fold_index: Int: Index of the cross-validation fold
+    :return: val_mask: np.array of N bool. True means the sample belongs to the validation set of this fold
+    """
+    return fold_ids == cv_fold_index
+
+
+def get_index_fingerprint(trainval_datetimes):
+    """
+    :param trainval_datetimes: a length N DatetimeIndex holding datetimes for each sample
+    :return: fingerprint: str. Hash of the datetimes, which changes with any sample added, removed or moved
+    """
+    hashes = pd.util.hash_pandas_object(pd.Index(trainval_datetimes), index=False)
+
+    return hashlib.sha256(hashes.to_numpy().tobytes()).hexdigest()
+
+
+def get_fingerprint_path(path_to_shuffled_indices):
+    return Path(path_to_shuffled_indices).with_suffix(".json")
+
+
+def read_shuffled_indices(trainval_datetimes, path_to_shuffled_indices):
+    """
+    Read the shuffled indices saved by create_and_shuffle_day_blocks, unless they were created for other samples
+    :param trainval_datetimes: a length N DatetimeIndex holding datetimes for each sample
+    :param path_to_shuffled_indices: Path the shuffled indices are saved to (as a .npy)
+    :return: day_block_shuffled_indices: np.array, or None if missing or stale
+    """
+    if not os.path.exists(path_to_shuffled_indices):
+        return None
+    day_block_shuffled_indices = np.load(path_to_shuffled_indices)
+
+    fingerprint_path = get_fingerprint_path(path_to_shuffled_indices)
+    if fingerprint_path.exists():
+        with open(fingerprint_path) as f:
+            fingerprint = json.load(f)["fingerprint"]
+        if fingerprint == get_index_fingerprint(trainval_datetimes):
+            return day_block_shuffled_indices
+        print("Shuffled indices were created for other samples, ignoring them")
+        return None
+
+    # Saved before the fingerprints were introduced. Reused as long as they still shuffle the days of the samples, so
+    # that the models trained on them are diagnosed on the same folds. Otherwise they are set aside, as they can't
+    # belong to these samples
+    if not is_day_block_shuffle(day_block_shuffled_indices, trainval_datetimes):
+        legacy_path = Path(path_to_shuffled_indices).with_suffix(".legacy.npy")
+        os.replace(path_to_shuffled_indices, legacy_path)
+        print(
+            "Shuffled indices don't shuffle the days of the samples, moved to {}".format(
+                legacy_path.name
+            )
+        )
+        return None
+    save_index_fingerprint(trainval_datetimes, path_to_shuffled_indices, seed=None)
+
+    return day_block_shuffled_indices
+
+
+def is_day_block_shuffle(day_block_shuffled_indices, trainval_datetimes):
+    """
+    :param day_block_shuffled_indices: np.array of shuffled indices, see create_and_shuffle_day_blocks
+    :param trainval_datetimes: a length N DatetimeIndex holding datetimes for each sample
+    :return: bool. Whether the indices are a permutation of all the samples that keeps the samples of each day
+    together and in their order, as create_and_shuffle_day_blocks does
+    """
+    num_samples = len(trainval_datetimes)
+    if len(day_block_shuffled_indices) != num_samples or not np.array_equal(
+        np.sort(day_block_shuffled_indices), np.arange(num_samples)
+    ):
+        return False
+    day_codes, unique_trainval_dates = pd.factorize(
+        pd.DatetimeIndex(trainval_datetimes).normalize()
     )
-    print("Train and val masks are ready!")
+    shuffled_day_codes = day_codes[day_block_shuffled_indices]
+    is_same_day = shuffled_day_codes[1:] == shuffled_day_codes[:-1]
+    # one run of consecutive samples per day, each in increasing order
+    num_day_runs = num_samples - np.count_nonzero(is_same_day)
 
-    return val_masks_all_folds
+    return num_day_runs == len(unique_trainval_dates) and bool(
+        np.all(
+            day_block_shuffled_indices[1:][is_same_day]
+            > day_block_shuffled_indices[:-1][is_same_day]
+        )
+    )
+
+
+def save_index_fingerprint(trainval_datetimes, path_to_shuffled_indices, seed):
+    fingerprint_path = get_fingerprint_path(path_to_shuffled_indices)
+    tmp_path = fingerprint_path.with_name(
+        "{}.{}.tmp".format(fingerprint_path.name, os.getpid())
+    )
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "fingerprint": get_index_fingerprint(trainval_datetimes),
+                "num_samples": len(trainval_datetimes),
+                "seed": seed,
+            },
+            f,
+            indent=2,
+        )
+    os.replace(tmp_path, fingerprint_path)
 
 
-def create_and_shuffle_day_blocks(trainval_datetimes, path_to_shuffled_indices):
+def create_and_shuffle_day_blocks(
+    trainval_datetimes, path_to_shuffled_indices, seed=DEFAULT_SHUFFLE_SEED
+):
     """
     Identifies indices corresponding to each unique date present in the trainval dataset, and then shuffles indices
     such that days are shuffled among other days, while indices within a day are not.
-    :param trainval_datetimes: pd.DataFrame containing datetimes corresponding to all trainval samples
-    :param path_to_shuffled_indices: Path to save shuffled day block indices (as a .npy)
+    :param trainval_datetimes: a length N DatetimeIndex holding datetimes for all trainval samples
+    :param path_to_shuffled_indices: Path to save shuffled day block indices (as a .npy), along with the fingerprint
+    of the samples they were created for (as a .json)
+    :param seed: int. Seed of the day shuffling
     :return: day_block_shuffled_indices: np.array comprising of indices that shuffle days
     """
-    # Extract dates from datetimes and identify unique dates
-    all_trainval_dates = trainval_datetimes.date
-    unique_trainval_dates = np.unique(all_trainval_dates)
-    # Make a bucket for each unique date, fill it with sample indices belonging to that date
-    list_of_unique_date_buckets = []
-    for unique_dt in range(len(unique_trainval_dates)):
-        list_of_unique_date_buckets.append(
-            np.where(all_trainval_dates == unique_trainval_dates[unique_dt])[0]
-        )
-    # Shuffle buckets, i.e days, and then stitch the shuffled days together into a single array
-    np.random.shuffle(list_of_unique_date_buckets)
-    day_block_shuffled_indices = np.concatenate(list_of_unique_date_buckets)
+    # Label each sample with its date, and give every date a random rank
+    day_codes, unique_trainval_dates = pd.factorize(
+        pd.DatetimeIndex(trainval_datetimes).normalize()
+    )
+    rng = np.random.default_rng(seed)
+    day_ranks = rng.permutation(len(unique_trainval_dates))
+    # Sorting the samples by the rank of their date shuffles the days, while the stable sort keeps the order within
+    # each day
+    day_block_shuffled_indices = np.argsort(day_ranks[day_codes], kind="stable")
 
     # Create a directory to store this file in, if it doesn't already exist
-    if not os.path.isdir(os.path.dirname(os.path.abspath(path_to_shuffled_indices))):
-        os.makedirs(os.path.dirname(os.path.abspath(path_to_shuffled_indices)))
-    np.save(path_to_shuffled_indices, day_block_shuffled_indices)
+    path_to_shuffled_indices = Path(path_to_shuffled_indices)
+    path_to_shuffled_indices.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path_to_shuffled_indices.with_name(
+        "{}.{}.tmp.npy".format(path_to_shuffled_indices.stem, os.getpid())
+    )
+    np.save(tmp_path, day_block_shuffled_indices)
+    os.replace(tmp_path, path_to_shuffled_indices)
+    save_index_fingerprint(trainval_datetimes, path_to_shuffled_indices, seed)
 
     return day_block_shuffled_indices
 
 
+def create_fold_ids(day_block_shuffled_indices, num_of_cv_folds):
+    """
+    Takes trainval data that has already been day shuffled. Partitions train val data into training and validation data
+    based on the total number of folds to be created.
+
+    :param num_of_cv_folds: Int: Total # of cross-validation folds
+    :param day_block_shuffled_indices: np.array consisting of indices that are shuffled as intraday consecutive blocks
+    :return: fold_ids: np.array of int8. The index of the fold in whose validation set each sample is
+    """
+    if num_of_cv_folds > np.iinfo(np.int8).max:
+        raise ValueError(
+            "At most {} cross-validation folds are supported!".format(
+                np.iinfo(np.int8).max
+            )
+        )
+    num_samples = day_block_shuffled_indices.shape[0]
+    # Each fold validates a consecutive range of the shuffled indices
+    fold_bounds = [
+        int(cv_fold_index / num_of_cv_folds * num_samples)
+        for cv_fold_index in range(num_of_cv_folds + 1)
+    ]
+    fold_of_shuffled_positions = (
+        np.searchsorted(fold_bounds, np.arange(num_samples), side="right") - 1
+    )
+    fold_ids = np.empty(num_samples, dtype=np.int8)
+    fold_ids[day_block_shuffled_indices] = fold_of_shuffled_positions
+
+    return fold_ids
+
+
 def create_val_masks_for_each_fold(day_block_shuffled_indices, num_of_cv_folds):
     """
     Takes trainval data that has already been day shuffled. Partitions train val data into training and validation data
@@ -101,20 +305,114 @@ def create_val_masks_for_each_fold(day_block_shuffled_indices, num_of_cv_folds):
              while the 2nd dimension is for each sample. True means this sample belongs to the validation set
              in this cross validation fold.
     """
-    num_samples = day_block_shuffled_indices.shape[0]
-    indices = np.arange(num_samples)
-    # Initialize containers to store masks determing the membership of the validation set
-    val_masks_all_folds = np.zeros((num_of_cv_folds, num_samples), dtype=bool)
-
-    # iterate through every CV fold
-    for cv_fold_index in range(num_of_cv_folds):
-        # Define indices for training and validation set. Note that whole days have already been shuffled
-        val_mask = np.zeros(num_samples, dtype=bool)
-        val_range_in_shuffled_indices = np.arange(
-            int(cv_fold_index / num_of_cv_folds * num_samples),
-            int((cv_fold_index + 1) / num_of_cv_folds * num_samples),
+    fold_ids = create_fold_ids(day_block_shuffled_indices, num_of_cv_folds)
+
+    return fold_ids[np.newaxis, :] == np.arange(num_of_cv_folds)[:, np.newaxis]
+
+
+## Normalization statistics of each fold
+def get_fold_norm_stats(
+    input_values, fold_ids, num_of_cv_folds, chunk_size=NORM_STATS_CHUNK_SIZE
+):
+    """
+    Mean and variance of each input feature over the training samples of each fold, i.e. leaving out the validation
+    samples of the fold, for all the folds in a single pass over the inputs. The sums over all the samples and over
+    the samples validated in each fold are accumulated together, and the training sums of a fold are their difference.
+    The inputs are shifted by the mean of their first chunk beforehand, so that the variances don't lose precision.
+    Features constant over the training samples of a fold get a variance of 1. A fold without validation samples gets
+    the statistics of all the samples.
+    :param input_values: np.array of (N, num_inputs). Inputs of the trainval samples, may be memory-mapped
+    :param fold_ids: np.array of N int8. See get_fold_ids
+    :param num_of_cv_folds: # of cross validation folds
+    :param chunk_size: int. Number of samples read in at once, bounding the memory used
+    :return: norm_means: np.array of (num_of_cv_folds, num_inputs) float64. norm_variances: np.array of the same shape
+    """
+    num_samples, num_inputs = input_values.shape
+    if len(fold_ids) != num_samples:
+        raise ValueError("Fold ids and input shape mismatch!")
+
+    shift = np.mean(input_values[:chunk_size], axis=0, dtype="float64")
+    fold_range = np.arange(num_of_cv_folds)[:, np.newaxis]
+    # Row 0 accumulates all the samples, the next rows the validation samples of each fold
+    sums = np.zeros((num_of_cv_folds + 1, num_inputs))
+    sq_sums = np.zeros((num_of_cv_folds + 1, num_inputs))
+    for start in range(0, num_samples, chunk_size):
+        # always a copy, as the chunk is shifted and squared in place
+        chunk = np.array(input_values[start : start + chunk_size], dtype="float64")
+        chunk -= shift
+        weights = np.vstack(
+            [
+                np.ones(len(chunk)),
+                fold_ids[np.newaxis, start : start + chunk_size] == fold_range,
+            ]
         )
-        val_mask[day_block_shuffled_indices[val_range_in_shuffled_indices]] = True
-        val_masks_all_folds[cv_fold_index] = val_mask
+        sums += weights @ chunk
+        sq_sums += weights @ np.square(chunk, out=chunk)
+
+    counts = np.bincount(fold_ids, minlength=num_of_cv_folds)[:num_of_cv_folds]
+    train_counts = (num_samples - counts)[:, np.newaxis]
+    train_means = (sums[0] - sums[1:]) / train_counts
+    train_variances = (sq_sums[0] - sq_sums[1:]) / train_counts - np.square(train_means)
+
+    # A feature constant over the training samples of a fold, e.g. a calendar flag only ever set on the days it
+    # validates, is only centered, as dividing by its zero variance would blow up its validation samples. Constant
+    # is told apart from the round-off of the sums relative to the scale of the feature over all the samples
+    is_constant = train_variances <= np.finfo("float32").eps * sq_sums[0] / num_samples
+    train_variances[is_constant] = 1.0
+
+    return train_means + shift, train_variances
+
+
+def get_norm_stats_key(fold_ids, num_of_cv_folds, input_columns, set_paths):
+    """
+    :param set_paths: list of pathlib.Path of the saved input set, see dataset.find_set_paths
+    :return: key: str. Hash of the fold assignment, the input features and the saved input set, which changes
+    whenever the inputs are saved again
+    """
+    key = hashlib.sha256(np.ascontiguousarray(fold_ids).tobytes())
+    key.update(str(num_of_cv_folds).encode())
+    key.update(json.dumps(list(map(str, input_columns))).encode())
+    for set_path in set_paths:
+        key.update("{}:{}".format(set_path.name, set_path.stat().st_mtime_ns).encode())
+
+    return key.hexdigest()
+
+
+def get_cached_fold_norm_stats(
+    input_values,
+    input_columns,
+    fold_ids,
+    num_of_cv_folds,
+    set_paths,
+    path_to_norm_stats,
+):
+    """
+    Normalization statistics of each fold, see get_fold_norm_stats. They are cached alongside the sets, and computed
+    again only if the folds or the saved inputs change.
+    :param input_values: np.array of (N, num_inputs). Inputs of the trainval samples, may be memory-mapped
+    :param input_columns: list of str. Names of the input features
+    :param fold_ids: np.array of N int8. See get_fold_ids
+    :param num_of_cv_folds: # of cross validation folds
+    :param set_paths: list of pathlib.Path of the saved input set, see dataset.find_set_paths
+    :param path_to_norm_stats: Path to save/read the statistics (as a .npz)
+    :return: norm_means: np.array of (num_of_cv_folds, num_inputs) float64. norm_variances: np.array of the same shape
+    """
+    key = get_norm_stats_key(fold_ids, num_of_cv_folds, input_columns, set_paths)
+    if os.path.exists(path_to_norm_stats):
+        with np.load(path_to_norm_stats) as norm_stats:
+            if str(norm_stats["key"]) == key:
+                print("Normalization statistics pre-computed....")
+                return norm_stats["norm_means"], norm_stats["norm_variances"]
+
+    print("Computing normalization statistics of each fold....")
+    norm_means, norm_variances = get_fold_norm_stats(
+        input_values, fold_ids, num_of_cv_folds
+    )
+    path_to_norm_stats = Path(path_to_norm_stats)
+    tmp_path = path_to_norm_stats.with_name(
+        "{}.{}.tmp.npz".format(path_to_norm_stats.stem, os.getpid())
+    )
+    np.savez(tmp_path, key=key, norm_means=norm_means, norm_variances=norm_variances)
+    os.replace(tmp_path, path_to_norm_stats)
 
-    return val_masks_all_folds
+    return norm_means, norm_variances
@@ -1,8 +1,24 @@
+import argparse
+import copy
+from functools import partial
 import pandas as pd
 import pathlib
 from utility import DirStructure
 from parse_excel_configs import ExcelConfigs
 from calendrical_predictors import CalendricalPredictors
+from dataset import DEFAULT_DATA_FORMAT, list_saved_sets
+from pipeline import Stage, Pipeline
+from instrumentation import RunReport, measure, record_data_in, record_data_out
+from feature_screening import (
+    SCREENING_FILENAME,
+    DEFAULT_SCREENING_CHUNK_ROWS,
+    get_feature_tags,
+    get_max_num_optional_features,
+    is_screening_enabled,
+    screen_features,
+    save_screening,
+    read_dropped_terms,
+)
 from data_preprocessing_util import *
 
 # ==== Constants  ====
@@ -10,57 +26,671 @@ from data_preprocessing_util import *
 INPUT_EXCEL_NAME = pathlib.Path("RESERVE_input_v1.xlsx")
 
 
-def main():
+def main(
+    incremental=False,
+    chunk_size=None,
+    dry_run=False,
+    summary=False,
+    input_excel_path=INPUT_EXCEL_NAME,
+    overrides=None,
+):
+    """
+    Run the data preprocessing end to end, see run_preprocessing. Every step is measured, and the measurements are
+    saved as a run report in the diagnostics directory, see instrumentation.RunReport
+    :param incremental: bool. See run_preprocessing
+    :param chunk_size: str or pd.Timedelta or None. See run_preprocessing
+    :param dry_run: bool. See run_preprocessing
+    :param summary: bool. If True, print a summary table of the run report at the end
+    :param input_excel_path: pathlib.Path. See load_configs
+    :param overrides: dict or None. See load_configs
+    :return: Output of run_preprocessing
+    """
+    report = RunReport("data_preprocessing")
+    print("=== Step 1 of 5, Parse model configs from {} ===".format(input_excel_path))
+    with measure(report, "parse_configs"):
+        configs, dir_str = load_configs(input_excel_path, overrides)
+    report.run_name = configs.model_name
 
-    print("=== Step 1 of 5, Parse model configs from {} ===".format(INPUT_EXCEL_NAME))
-    configs = ExcelConfigs(INPUT_EXCEL_NAME.resolve())
+    try:
+        return run_preprocessing(
+            configs,
+            dir_str,
+            incremental=incremental,
+            chunk_size=chunk_size,
+            dry_run=dry_run,
+            report=report,
+        )
+    finally:
+        # saved even if the run fails, to see how far it got
+        if not dry_run:
+            report_path = report.save(dir_str.diag_dir)
+            print("Run report saved to {}".format(report_path))
+        if summary:
+            report.print_summary()
+
+
+def load_configs(input_excel_path=INPUT_EXCEL_NAME, overrides=None):
+    """
+    Parse the model configs and set up the directory structure of the model
+    :param input_excel_path: pathlib.Path. Path to the config workbook
+    :param overrides: dict or None. Main parameters to override, named as in the workbook or as attributes, e.g.
+    {"Model Name": "RESERVE_5min", "Sample Interval": "5T"}, to run variants of a model off the same workbook
+    :return: configs: parse_excel_configs.ExcelConfigs. dir_str: utility.DirStructure
+    """
+    configs = ExcelConfigs(pathlib.Path(input_excel_path).resolve())
+    if overrides:
+        for param_name, value in overrides.items():
+            setattr(configs, param_name.lower().replace(" ", "_"), value)
+        configs.sample_interval = pd.Timedelta(configs.sample_interval)
     # Paths to read time files from. Defined in the dir_structure class in utility
     dir_str = DirStructure(model_name=configs.model_name)
 
-    print("=== Step 2.1 of 5 synthesize forecast series when needed===")
-    configs = synthesize_forecast(configs, dir_str)
+    return configs, dir_str
 
-    print("=== Step 2.2 of 5.Read in all timeseries ===")
-    # read in all timeseries files
-    ts_data_df, sub_ts_dict = read_all_timeseries(dir_str, configs)
-    # calculate response variables
-    # TODO: Add a check if no time series is defined as output and no response variable has been calculated
-    print("=== step 2.3 of 5 calculate forecast errors when required ===")
-    # This applies to RESERVE more than RECLAIM and is only required some but not at all times
-    if configs.synthesize_forecast_error:
-        fc_err_df = calculate_forecast_error(ts_data_df, configs, dir_str)
-        ts_data_df = pd.concat([ts_data_df, fc_err_df], axis=1, join="outer")
 
-    # Replace timeseries with sub timeseries, applicable to down-sampled ts
-    ts_data_df = concat_sub_ts(ts_data_df, sub_ts_dict, configs)
+def run_preprocessing(
+    configs, dir_str, incremental=False, chunk_size=None, dry_run=False, report=None
+):
+    """
+    Run steps 2 to 5 of the data preprocessing. The steps run as stages of a pipeline, see get_preprocessing_stages,
+    and only the stages affected by changes in the configs or the raw data since the last run are rerun
+    :param configs: parse_excel_configs.ExcelConfigs. Configuration file of how to run this script
+    :param dir_str: utility.DirStructure. Directory structure of the current model
+    :param incremental: bool. If True, only the time points after the last sample saved in the data directory, and
+    those still waiting for their outputs, are processed and merged into the existing sets, see
+    get_incremental_rebuild_start. Steps 2.2 to 5 only process these time points and enough history for their lag
+    terms, see read_incremental_series, and the new samples are appended to the "npy" sets in place, see
+    dataset.append_data_set. The configs must not have changed since the last run
+    :param chunk_size: str or pd.Timedelta or None. If provided, steps 3 to 5 are streamed over time chunks of this
+    length and the sets are saved in shards, see process_in_chunks
+    :param dry_run: bool. If True, only report which stages are stale, without running anything
+    :param report: instrumentation.RunReport or None. If provided, every step is measured and recorded in it
+    :return: stale_stages: pd.Series of the reason to run each stale stage if dry_run, otherwise None
+    """
+    if incremental and (chunk_size is not None):
+        raise ValueError("Incremental mode cannot be combined with chunked mode!")
+
+    pipeline = Pipeline(
+        get_preprocessing_stages(report),
+        configs,
+        dir_str,
+        dir_str.pipeline_cache_dir,
+        report=report,
+    )
+
+    if incremental:
+        rebuild_start = get_incremental_rebuild_start(
+            dir_str.data_dir, configs.starts_and_ends, configs.sample_interval
+        )
+        if rebuild_start is None:
+            print("No processed data found, running a full rebuild instead")
+            incremental = False
+
+    if dry_run:
+        # Steps 3 to 5 don't go through the cached stages in chunked mode, nor steps 2.2 to 5 in incremental mode
+        if incremental:
+            target = "synthesize_forecast"
+        else:
+            target = "split" if not chunk_size else "sub_ts"
+        stale_stages = pipeline.run(target, dry_run=True)
+        print("=== Dry run, stages to be rerun ===")
+        print(stale_stages.fillna("up to date").to_string())
+        return stale_stages
+
+    if not (incremental or chunk_size):
+        pipeline.run("split")
+        print("All done!")
+        return None
+
+    dropped_terms = None
+    if chunk_size is not None and is_screening_enabled(configs):
+        # The screening needs the whole history. It runs through its own pipeline on a copy of the configs, as the
+        # calendar terms are added to the configs chunk by chunk below
+        dropped_terms = Pipeline(
+            get_preprocessing_stages(report),
+            copy.deepcopy(configs),
+            dir_str,
+            dir_str.pipeline_cache_dir,
+            report=report,
+        ).run("screening")
+
+    if incremental:
+        print("=== Incremental mode, processing data from {} ===".format(rebuild_start))
+        pipeline.run("synthesize_forecast")
+        ts_data_df = read_incremental_series(configs, dir_str, rebuild_start, report)
+    else:
+        ts_data_df = pipeline.run("sub_ts")
+
+    # Format to save the sets in, see dataset.py
+    data_format = getattr(configs, "dataset_format", DEFAULT_DATA_FORMAT)
+
+    if chunk_size is not None:
+        print("=== Step 3 to 5 of 5, processed in chunks of {} ===".format(chunk_size))
+        remove_saved_sets(dir_str.data_dir)
+        process_in_chunks(
+            ts_data_df,
+            configs,
+            dir_str.data_dir,
+            pd.Timedelta(chunk_size),
+            data_format=data_format,
+            solar_cache_dir=dir_str.solar_cache_dir,
+            report=report,
+            dropped_terms=dropped_terms,
+        )
+        print("All done!")
+        return None
 
     print("=== Step 3 of 5, Calculating Calendar-based predictors === ")
-    cal_predictors = CalendricalPredictors(ts_data_df.index, configs)
-    ts_data_df = pd.concat([ts_data_df, cal_predictors.data], axis=1, join="outer")
+    with measure(report, "calendar") as record:
+        record_data_in(record, ts_data_df)
+        cal_predictors = CalendricalPredictors(
+            ts_data_df.index, configs, dir_str.solar_cache_dir
+        )
+        cal_data_df = cast_to_dtype(cal_predictors.data, get_pipeline_dtype(configs))
+        record_data_out(record, cal_data_df)
+    ts_data_df = pd.concat([ts_data_df, cal_data_df], axis=1, join="outer")
     configs.lag_term_configs = pd.concat(
         [configs.lag_term_configs, cal_predictors.cal_term_configs]
     )
 
     print("=== Step 4 of 5, Vectorized construction of lag and lead terms ===")
+    with measure(report, "padding") as record:
+        record_data_in(record, ts_data_df)
+        # Pad the raw data with NaNs in both the lag and lead direction for downstream data manipulation
+        ts_data_df = pad_data_w_buffer(
+            ts_data_df,
+            configs.lag_term_configs,
+            configs.lead_term_configs,
+            configs.sample_interval,
+        )
+        record_data_out(record, ts_data_df)
+    with measure(report, "lag_lead") as record:
+        record_data_in(record, ts_data_df)
+        # Only the valid rows of the new time points are built, leaving out the features screened out by the last
+        # full run
+        io_data_df, is_feature_input, row_validity = build_valid_lag_and_lead_matrix(
+            ts_data_df,
+            configs.lag_term_configs,
+            configs.lead_term_configs,
+            configs.starts_and_ends,
+            dtype=get_matrix_dtype(configs),
+            start=rebuild_start,
+            dropped_terms=read_dropped_terms(dir_str.data_dir),
+        )
+        record_data_out(record, io_data_df)
+    if row_validity.empty:
+        print("No new data to process!")
+        return None
+
+    print("=== Step 5 of 5. Append the new samples to the saved sets ===")
+    with measure(report, "split") as record:
+        record_data_in(record, io_data_df)
+        create_trainval_test_infer_sets(
+            io_data_df,
+            configs.starts_and_ends,
+            is_feature_input,
+            dir_str.data_dir,
+            append=True,
+            data_format=data_format,
+            row_validity=row_validity,
+        )
+
+    print("All done!")
+
+
+def read_incremental_series(configs, dir_str, rebuild_start, report=None):
+    """
+    Steps 2.2 to 2.4 of an incremental run. The series are cut to the time points from rebuild_start on, plus just
+    enough history to build their lag terms, before the forecast errors and the sub time series are calculated, so
+    these steps only cost as much as the new data. They are not memoized by the pipeline, as their outputs only cover
+    part of the history; the configs are updated as by the stages, see get_preprocessing_stages.
+    The csv files of the series with new data are still read in full, as the data checker writes them in full, and
+    so are the forecasts synthesized from them in step 2.1
+    :param configs: parse_excel_configs.ExcelConfigs. Configuration file of how to run this script, updated in place
+    :param dir_str: utility.DirStructure. Directory structure of the current model
+    :param rebuild_start: pd.Timestamp. First time point to rebuild, see get_incremental_rebuild_start
+    :param report: instrumentation.RunReport or None. If provided, every step is measured and recorded in it
+    :return: ts_data_df: pd.DataFrame. All time series, including forecast errors and sub time series, from the
+    furthest lag of rebuild_start on
+    """
+    print("=== Step 2.2 of 5.Read in all timeseries ===")
+    with measure(report, "read_series") as record:
+        ts_data_df, sub_ts_dict = read_all_timeseries(dir_str, configs, report=report)
+        check_dtype(ts_data_df, get_pipeline_dtype(configs), "read_series")
+        record_data_out(record, ts_data_df)
+
+    if configs.synthesize_forecast_error:
+        add_forecast_error_configs(configs)
+    # Keep just enough history before the new time points to build their lag terms. The sub time series take the
+    # lag and lead terms of their time series, so they don't change the furthest lag
+    max_lag_terms, _ = get_max_lag_and_lead(
+        configs.lag_term_configs, configs.lead_term_configs
+    )
+    window_start = rebuild_start + max_lag_terms * configs.sample_interval
+    ts_data_df = ts_data_df.loc[window_start:]
+    sub_ts_dict = {
+        ts_name: None if sub_ts_df is None else sub_ts_df.loc[window_start:]
+        for ts_name, sub_ts_df in sub_ts_dict.items()
+    }
+
+    if configs.synthesize_forecast_error:
+        print("=== step 2.3 of 5 calculate forecast errors when required ===")
+        with measure(report, "forecast_error") as record:
+            record_data_in(record, ts_data_df)
+            fc_err_df = compute_forecast_error(ts_data_df, configs, dir_str, save=False)
+            check_dtype(fc_err_df, get_pipeline_dtype(configs), "forecast_error")
+            record_data_out(record, fc_err_df)
+        ts_data_df = pd.concat([ts_data_df, fc_err_df], axis=1, join="outer")
+
+    print("=== Step 2.4 of 5 replace timeseries with their sub timeseries ===")
+    with measure(report, "sub_ts") as record:
+        record_data_in(record, ts_data_df)
+        ts_data_df = concat_sub_ts(ts_data_df, sub_ts_dict, configs)
+        check_dtype(ts_data_df, get_pipeline_dtype(configs), "sub_ts")
+        record_data_out(record, ts_data_df)
+
+    return ts_data_df
+
+
+def get_preprocessing_stages(report=None):
+    """
+    Steps of the data preprocessing as stages of a pipeline, see pipeline.Pipeline. Each stage declares the config
+    values and files its output depends on, so that after a change in the configs or in the raw data only the
+    affected stages are rerun. Config updates made by the stages, e.g. adding the lag terms of the calendar terms,
+    are applied whether the stage is rerun or not.
+    :param report: instrumentation.RunReport or None. If provided, the read of each series is recorded in it
+    :return: stages: list of pipeline.Stage, in order
+    """
+    return [
+        Stage(
+            "synthesize_forecast",
+            synthesize_forecast_stage,
+            get_params=lambda configs: [
+                configs.forecast_configs,
+                configs.timeseries_attributes["File Name"],
+            ]
+            + [
+                getattr(configs, geo_param, None)
+                for geo_param in ["latitude", "longitude", "tz_from_utc"]
+            ],
+            update_configs=lambda configs, meta: add_forecast_configs(configs),
+            get_input_files=lambda configs, dir_str: get_timeseries_paths(
+                configs, dir_str, get_synthesized_ts_names(configs)
+            ),
+            get_output_files=lambda configs, dir_str: get_forecast_paths(
+                configs, dir_str
+            ),
+            description="Step 2.1 of 5 synthesize forecast series when needed",
+        ),
+        Stage(
+            "read_series",
+            partial(read_series_stage, report=report),
+            get_params=lambda configs: [
+                configs.timeseries_attributes["File Name"],
+                configs.sample_interval,
+                get_pipeline_dtype(configs),
+            ],
+            get_input_files=lambda configs, dir_str: get_timeseries_paths(
+                configs, dir_str, configs.timeseries_attributes.index
+            ),
+            persist=False,
+            description="Step 2.2 of 5.Read in all timeseries",
+        ),
+        Stage(
+            "forecast_error",
+            forecast_error_stage,
+            upstream=["read_series"],
+            get_params=lambda configs: [
+                configs.synthesize_forecast_error,
+                configs.forecast_error_contribution,
+                # The lead terms of the errors only go into the config updates
+                configs.forecast_error_configs["Synthesize Error?"],
+            ],
+            update_configs=lambda configs, meta: (
+                add_forecast_error_configs(configs)
+                if configs.synthesize_forecast_error
+                else None
+            ),
+            persist=False,
+            description="step 2.3 of 5 calculate forecast errors when required",
+        ),
+        Stage(
+            "sub_ts",
+            sub_ts_stage,
+            upstream=["read_series", "forecast_error"],
+            update_configs=add_sub_ts_configs,
+            description="Step 2.4 of 5 replace timeseries with their sub timeseries",
+        ),
+        Stage(
+            "calendar",
+            calendar_stage,
+            upstream=["sub_ts"],
+            get_params=lambda configs: [
+                configs.temporal_features,
+                configs.sample_interval,
+                get_pipeline_dtype(configs),
+                list(configs.lag_term_configs.columns),
+                getattr(configs, "holiday_calendar", None),
+            ]
+            + [
+                getattr(configs, geo_param, 0)
+                for geo_param in ["latitude", "longitude", "tz_from_utc"]
+            ],
+            update_configs=lambda configs, cal_term_configs: setattr(
+                configs,
+                "lag_term_configs",
+                pd.concat([configs.lag_term_configs, cal_term_configs]),
+            ),
+            description="Step 3 of 5, Calculating Calendar-based predictors",
+        ),
+        Stage(
+            "padding",
+            padding_stage,
+            upstream=["sub_ts", "calendar"],
+            get_params=lambda configs: [
+                get_max_lag_and_lead(
+                    configs.lag_term_configs, configs.lead_term_configs
+                ),
+                configs.sample_interval,
+            ],
+            persist=False,
+            description="Step 4.1 of 5, Pad the data with NaNs in the lag and lead direction",
+        ),
+        Stage(
+            "screening",
+            screening_stage,
+            upstream=["padding"],
+            get_params=lambda configs: [
+                configs.lag_term_configs,
+                configs.lead_term_configs,
+                configs.starts_and_ends,
+                get_feature_tags(configs),
+                get_max_num_optional_features(configs),
+                getattr(configs, "screening_chunk_rows", DEFAULT_SCREENING_CHUNK_ROWS),
+            ],
+            get_output_files=lambda configs, dir_str: (
+                [dir_str.data_dir / SCREENING_FILENAME]
+                if is_screening_enabled(configs)
+                else []
+            ),
+            description="Step 4.2 of 5, Screen out redundant optional features",
+        ),
+        Stage(
+            "lag_lead",
+            lag_lead_stage,
+            upstream=["padding", "screening"],
+            get_params=lambda configs: [
+                configs.lag_term_configs,
+                configs.lead_term_configs,
+                configs.starts_and_ends,
+                get_matrix_dtype(configs),
+            ],
+            persist=False,
+            description="Step 4.3 of 5, Vectorized construction of lag and lead terms",
+        ),
+        Stage(
+            "split",
+            split_stage,
+            upstream=["lag_lead"],
+            get_params=lambda configs: [
+                configs.starts_and_ends,
+                getattr(configs, "dataset_format", DEFAULT_DATA_FORMAT),
+            ],
+            get_output_files=lambda configs, dir_str: sorted(
+                list_saved_sets(dir_str.data_dir)
+            ),
+            description="Step 5 of 5. Separate trainval, test and inference sets and save",
+        ),
+    ]
+
+
+def get_synthesized_ts_names(configs):
+    fc_configs = configs.forecast_configs  # alias
+    return fc_configs.index[fc_configs["Synthesize Forecast?"].astype(bool)]
+
+
+def get_timeseries_paths(configs, dir_str, ts_names):
+    ts_attrs = configs.timeseries_attributes  # alias
+    return [
+        dir_str.data_checker_dir / ts_attrs.loc[ts_name, "File Name"]
+        for ts_name in ts_names
+    ]
+
+
+def get_forecast_paths(configs, dir_str):
+    fc_configs = configs.forecast_configs  # alias
+    return [
+        dir_str.data_checker_dir
+        / get_forecast_filename(
+            ts_name, pd.Timedelta(fc_configs.loc[ts_name, "Forecast Horizon"])
+        )
+        for ts_name in get_synthesized_ts_names(configs)
+    ]
+
+
+# Functions of the preprocessing stages, see get_preprocessing_stages. Each returns the output passed on to the
+# downstream stages, and the meta output passed on to the config updates of the stage
+
+
+def synthesize_forecast_stage(configs, dir_str):
+    synthesize_forecast_files(configs, dir_str)
+    return None, None
+
+
+def read_series_stage(configs, dir_str, report=None):
+    return read_all_timeseries(dir_str, configs, report=report), None
+
+
+def forecast_error_stage(configs, dir_str, read_series_output):
+    if not configs.synthesize_forecast_error:
+        return None, None
+    ts_data_df, _ = read_series_output
+    fc_err_df = compute_forecast_error(ts_data_df, configs, dir_str)
+    check_dtype(fc_err_df, get_pipeline_dtype(configs), "forecast_error")
+    return fc_err_df, None
+
+
+def sub_ts_stage(configs, dir_str, read_series_output, fc_err_df):
+    ts_data_df, sub_ts_dict = read_series_output
+    check_dtype(ts_data_df, get_pipeline_dtype(configs), "read_series")
+    if fc_err_df is not None:
+        ts_data_df = pd.concat([ts_data_df, fc_err_df], axis=1, join="outer")
+    # Replace timeseries with sub timeseries, applicable to down-sampled ts
+    ts_data_df = concat_sub_ts_data(ts_data_df, sub_ts_dict)
+    check_dtype(ts_data_df, get_pipeline_dtype(configs), "sub_ts")
+    return ts_data_df, get_sub_ts_columns(sub_ts_dict)
+
+
+def calendar_stage(configs, dir_str, ts_data_df):
+    cal_predictors = CalendricalPredictors(
+        ts_data_df.index, configs, dir_str.solar_cache_dir
+    )
+    cal_data_df = cast_to_dtype(cal_predictors.data, get_pipeline_dtype(configs))
+    return cal_data_df, cal_predictors.cal_term_configs
+
+
+def padding_stage(configs, dir_str, ts_data_df, cal_data_df):
+    ts_data_df = pd.concat([ts_data_df, cal_data_df], axis=1, join="outer")
     # Pad the raw data with NaNs in both the lag and lead direction for downstream data manipulation
-    ts_data_df = pad_data_w_buffer(
+    padded_ts_data = pad_data_w_buffer(
         ts_data_df,
         configs.lag_term_configs,
         configs.lead_term_configs,
         configs.sample_interval,
     )
-    io_data_df, is_feature_input = generate_lag_and_lead_terms(
-        ts_data_df, configs.lag_term_configs, configs.lead_term_configs
+    check_dtype(padded_ts_data, get_pipeline_dtype(configs), "padding")
+    return padded_ts_data, None
+
+
+def screening_stage(configs, dir_str, padded_ts_data):
+    screening_path = dir_str.data_dir / SCREENING_FILENAME
+    if not is_screening_enabled(configs):
+        # so that incremental runs don't pick up the results of an earlier screening
+        if screening_path.exists():
+            screening_path.unlink()
+        return None, None
+
+    screening_df = screen_features(padded_ts_data, configs)
+    save_screening(screening_df, dir_str.data_dir)
+    print(
+        "{} of {} optional terms kept".format(
+            screening_df.loc[~screening_df["Is Mandatory?"], "Is Kept?"].sum(),
+            (~screening_df["Is Mandatory?"]).sum(),
+        )
+    )
+    return screening_df.index[~screening_df["Is Kept?"]], None
+
+
+def lag_lead_stage(configs, dir_str, padded_ts_data, dropped_terms):
+    # Only the rows kept in any set are built, and the terms screened out are never built
+    io_data = build_valid_lag_and_lead_matrix(
+        padded_ts_data,
+        configs.lag_term_configs,
+        configs.lead_term_configs,
+        configs.starts_and_ends,
+        dtype=get_matrix_dtype(configs),
+        dropped_terms=dropped_terms,
     )
+    check_dtype(io_data[0], get_pipeline_dtype(configs), "lag_lead")
+    return io_data, None
+
 
-    print("=== Step 5 of 5. Separate trainval, test and inference sets and save ===")
+def split_stage(configs, dir_str, io_data):
+    io_data_df, is_feature_input, row_validity = io_data
+    remove_saved_sets(dir_str.data_dir)
     create_trainval_test_infer_sets(
-        io_data_df, configs.starts_and_ends, is_feature_input, dir_str.data_dir
+        io_data_df,
+        configs.starts_and_ends,
+        is_feature_input,
+        dir_str.data_dir,
+        data_format=getattr(configs, "dataset_format", DEFAULT_DATA_FORMAT),
+        row_validity=row_validity,
     )
+    return None, None
 
-    print("All done!")
+
+def process_in_chunks(
+    ts_data_df,
+    configs,
+    data_dir,
+    chunk_size,
+    data_format=DEFAULT_DATA_FORMAT,
+    solar_cache_dir=None,
+    report=None,
+    dropped_terms=None,
+):
+    """
+    Steps 3 to 5 of the preprocessing, streamed over consecutive time chunks so that the wide lag and lead matrix
+    never has to hold the whole history at once. Each chunk is extended by a halo of as many rows as the furthest lag
+    and lead terms, which yields exactly the same features for the chunk as processing the whole history. The sets
+    of each chunk are saved as separate shards, to be stitched back by utility.read_data_set.
+
+    Args:
+        ts_data_df: pd.DataFrame of (M,N). All time series, including forecast errors and sub time series
+        configs: parse_excel_configs.ExcelConfigs. Configuration file of how to run this script
+        data_dir: pathlib.Path. Directory to save the sets into
+        chunk_size: pd.Timedelta. Length of history covered by each chunk
+        data_format: str. Format to save the shards in, one of dataset.DATA_FORMATS
+        solar_cache_dir: pathlib.Path or None. Directory of the solar cache used by the calendar terms
+        report: instrumentation.RunReport or None. If provided, each chunk is measured and recorded in it
+        dropped_terms: list of str or None. Labels of the terms screened out, see feature_screening.py
+
+    Returns:
+        None. The calendar terms are added to configs.lag_term_configs, as in the unchunked pipeline
+    """
+    max_lag_terms, max_lead_terms = get_max_lag_and_lead(
+        configs.lag_term_configs, configs.lead_term_configs
+    )
+    rows_per_chunk = max(int(chunk_size / configs.sample_interval), 1)
+    lag_term_configs = None  # only known once the calendar terms of a chunk are created
+
+    for shard_id, chunk_start in enumerate(range(0, len(ts_data_df), rows_per_chunk)):
+        chunk_end = min(chunk_start + rows_per_chunk, len(ts_data_df))
+        print(
+            "Processing chunk {} to {}...".format(
+                ts_data_df.index[chunk_start], ts_data_df.index[chunk_end - 1]
+            )
+        )
+        with measure(report, "chunk_{}".format(shard_id), kind="chunk") as record:
+            # the chunk plus its halo. The padding below takes care of the halo beyond the ends of the data
+            window_df = ts_data_df.iloc[
+                max(chunk_start + max_lag_terms, 0) : chunk_end + max_lead_terms
+            ]
+            record_data_in(record, window_df)
+
+            cal_predictors = CalendricalPredictors(
+                window_df.index, configs, solar_cache_dir
+            )
+            cal_data_df = cast_to_dtype(
+                cal_predictors.data, get_pipeline_dtype(configs)
+            )
+            window_df = pd.concat([window_df, cal_data_df], axis=1, join="outer")
+            if lag_term_configs is None:
+                lag_term_configs = pd.concat(
+                    [configs.lag_term_configs, cal_predictors.cal_term_configs]
+                )
+
+            window_df = pad_data_w_buffer(
+                window_df,
+                lag_term_configs,
+                configs.lead_term_configs,
+                configs.sample_interval,
+            )
+            # Leave out the halo, building the valid rows of the time points of this chunk only
+            io_data_df, is_feature_input, row_validity = (
+                build_valid_lag_and_lead_matrix(
+                    window_df,
+                    lag_term_configs,
+                    configs.lead_term_configs,
+                    configs.starts_and_ends,
+                    dtype=get_matrix_dtype(configs),
+                    start=ts_data_df.index[chunk_start],
+                    end=ts_data_df.index[chunk_end - 1],
+                    dropped_terms=dropped_terms,
+                )
+            )
+
+            create_trainval_test_infer_sets(
+                io_data_df,
+                configs.starts_and_ends,
+                is_feature_input,
+                data_dir,
+                shard_id=shard_id,
+                data_format=data_format,
+                row_validity=row_validity,
+            )
+            record_data_out(record, io_data_df)
+
+    configs.lag_term_configs = lag_term_configs
+
+    return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="RESERVE data preprocessing")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process data after the last saved sample, or still waiting for its outputs, and merge it into the existing sets",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        default=None,
+        help="process the data in time chunks of this length, e.g. 30D, and save the sets in shards",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report which steps would be rerun since the last run, without running them",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="print a summary table of the time and memory taken by each step",
+    )
+    return parser.parse_args()
 
 
 # run as a script
 if __name__ == "__main__":
-    main()
+    main(**vars(parse_args()))
@@ -1,7 +1,24 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
-import pvlib
+import scipy.sparse
+
+from series_cache import SeriesCache, DEFAULT_MAX_SIZE_MB
+from instrumentation import measure, record_data_in, record_data_out
+from solar_cache import SolarCache, CLEAR_SKY_OUTPUT, get_typical_1axis_CSO
+from utility import read_data_set
+from dataset import (
+    DataSet,
+    DEFAULT_DATA_FORMAT,
+    get_set_path,
+    find_set_paths,
+    list_saved_sets,
+    save_data_set,
+    append_data_set,
+    remove_data_set,
+    get_last_timestamp,
+)
 
 # Column names used in data-checker output files
 COL_NAME_VALUE = "Value_Interval_Avg"
@@ -10,238 +27,387 @@ COL_NAME_DATETIME = "Datetime_Interval_Start"
 
 # Relationship between lag, lead, input and output
 io_lag_lead_map = {"input": "lag", "output": "lead"}
+# Data type of the lag and lead matrix when no pipeline dtype is set, see get_pipeline_dtype
+DEFAULT_MATRIX_DTYPE = "float32"
 
 
-def get_typical_1axis_CSO(dt_array, lat, lon):
+def synthesize_forecast(configs, dir_str):
     """
-    Assume there's a typical 1axis solar array installed at (lat, lon), calculate the cosine of incidence angle for
-    each entry of the dt_array. Typical is defined as a one-axis tracking solar array, that has a "N-S" axis and no
-    tilt. For reference: https://www.powerfromthesun.net/Book/chapter04/chapter04.html#4.1.2%20Single-Axis%20Tracking%20Apertures
-
-    :param dt_array: pd.DatetimeIndex. A series of date times that incidence should be calculated.
-    :param lat: float. Latitude of the solar installation.
-    :param lon: float. Longitude of the solar installation
-    :return: cos_incidence: pd.series of float. Cosine of the incidence angles.
+    Synthesize forecast of certain timeseries, which almost always comes from persistence
+    :param configs: parse_excel_configs.ExcelConfig. Configuration of the data
+    preprocessing procedure
+    :param dir_str: utility.DirStructure. Directory structure of the current model
+    :return: configs, with the synthesized forecasts added to the timeseries. The forecasts are saved to hard drive
     """
+    synthesize_forecast_files(configs, dir_str)
+    add_forecast_configs(configs)
 
-    typical_single_axis_mount = pvlib.pvsystem.SingleAxisTrackerMount(
-        axis_tilt=0, axis_azimuth=180, backtrack=False
-    )
-    loc = pvlib.location.Location(lat, lon)
-    # default for these module parameters.
-    # pdc0 is output under 1KW/m2, size of panel. gamma_pdc relates to temp model
-    # pdc0 for inverter is the inverter size limit, choose bigger than first pdc0
-    array = pvlib.pvsystem.Array(
-        mount=typical_single_axis_mount,
-        module_parameters=dict(pdc0=1, gamma_pdc=-0.004, b=0.05),
-        temperature_model_parameters=dict(a=-3.56, b=-0.075, deltaT=3),
-    )
-    system = pvlib.pvsystem.PVSystem(arrays=[array], inverter_parameters=dict(pdc0=3))
-    mc = pvlib.modelchain.ModelChain(system, loc, spectral_model="no_loss")
-
-    weather = loc.get_clearsky(dt_array)
-    mc.run_model(weather)
+    return configs
 
-    results = mc.results.ac
 
-    return results
+def get_forecast_filename(ts_name, forecast_horizon):
+    return "{}_forecast_T+{:.0f}min.csv".format(
+        ts_name, forecast_horizon / pd.Timedelta("1T")
+    )
 
 
-def synthesize_forecast(configs, dir_str):
+def synthesize_forecast_files(configs, dir_str):
     """
-    Synthesize forecast of certain timeseries, which almost always comes from persistence
-    :param configs: parse_excel_configs.ExcelConfig. Configuration of the data
-    preprocessing procedure
+    Synthesize the forecast files of certain timeseries into the data checker output directory, see
+    synthesize_forecast. The configs are left untouched
+    :param configs: parse_excel_configs.ExcelConfig. Configuration of the data preprocessing procedure
     :param dir_str: utility.DirStructure. Directory structure of the current model
-    :return: None as files are saved to hard drive
+    :return: forecast_paths: list of str. Paths to the forecast files
     """
 
     fc_configs = configs.forecast_configs  # alias
-    fc_contrib = configs.forecast_error_contribution  # alias
     ts_attrs = configs.timeseries_attributes  # alias
 
+    # read in all the timeseries to synthesize forecasts for, along with the timestamps at which the clear sky output
+    # is needed by the solar persistence method
+    ts_csv_dict = {}
+    cso_timestamps = []
+    for ts_name in fc_configs.index[fc_configs["Synthesize Forecast?"].astype(bool)]:
+        if fc_configs.loc[ts_name, "Method"] not in [
+            "persistence",
+            "solar persistence",
+        ]:
+            raise ValueError("Only persistence and solar persistence are supported!")
+        ts_csv_dict[ts_name] = read_data_checker_csv(
+            os.path.join(dir_str.data_checker_dir, ts_attrs.loc[ts_name, "File Name"])
+        )
+        if fc_configs.loc[ts_name, "Method"] == "solar persistence":
+            forecast_horizon = pd.Timedelta(fc_configs.loc[ts_name, "Forecast Horizon"])
+            cso_timestamps += [
+                ts_csv_dict[ts_name].index,
+                ts_csv_dict[ts_name].index + forecast_horizon,
+            ]
+
+    # The actual and forecast timestamps mostly overlap, so the clear sky output is looked up only once over their
+    # union, for all the solar persistence timeseries together. It comes from the solar cache shared across runs
+    if cso_timestamps:
+        cso_timestamps = pd.DatetimeIndex(np.unique(np.concatenate(cso_timestamps)))
+        solar_cache = SolarCache(
+            dir_str.solar_cache_dir,
+            configs.latitude,
+            configs.longitude,
+            configs.tz_from_utc,
+            get_time_step(cso_timestamps),
+        )
+        clear_sky_output_all = solar_cache.query(cso_timestamps, CLEAR_SKY_OUTPUT)[
+            CLEAR_SKY_OUTPUT
+        ]
+
     # loop through all the timeseries in the forecast configs tab
-    for ts_name in fc_configs.index:
+    forecast_paths = []
+    for ts_name, ts_csv_df in ts_csv_dict.items():
+        # TODO: if forecast exists then skip this process
+        print("... Synthesizing forecast for {}...".format(ts_name))
+        # extract lead time and convert it to amount of lead term
+        forecast_horizon = pd.Timedelta(fc_configs.loc[ts_name, "Forecast Horizon"])
+
+        if fc_configs.loc[ts_name, "Method"] == "persistence":
+            # For the persistence forecast, forecast for T + forecast_lead_time
+            # is the value of that timeseries at T time
+            ts_forecast = ts_csv_df.set_index(ts_csv_df.index + forecast_horizon)
+
+        else:
+            # Slightly more complicated than the persistence method, it assumes that
+            # the cloudiness (solar output/ clear sky output) would remain the same
+            # And assumes the usage of a one-axis tracking panels with N-S axis
+            clear_sky_output_fc = clear_sky_output_all.reindex(
+                ts_csv_df.index + forecast_horizon
+            )
+            clear_sky_output = clear_sky_output_all.reindex(ts_csv_df.index)
 
-        if fc_configs.loc[ts_name, "Synthesize Forecast?"]:
-            # TODO: if forecast exists then skip this process
-            print("... Synthesizing forecast for {}...".format(ts_name))
-            # extract lead time and convert it to amount of lead term
-            forecast_horizon = pd.Timedelta(fc_configs.loc[ts_name, "Forecast Horizon"])
-            ts_csv_df = pd.read_csv(
-                os.path.join(
-                    dir_str.data_checker_dir, ts_attrs.loc[ts_name, "File Name"]
-                ),
-                index_col=COL_NAME_DATETIME,
-                parse_dates=True,
-                infer_datetime_format=True,
+            cso_ratio = (clear_sky_output_fc.values + 1e-4) / (
+                clear_sky_output.values + 1e-4
             )
+            # Cap adjustment factors at 2
+            cso_ratio = np.clip(cso_ratio, a_min=0.5, a_max=2)
+            ts_forecast = ts_csv_df.set_index(ts_csv_df.index + forecast_horizon)
+            ts_forecast[COL_NAME_VALUE] *= cso_ratio
+
+        # Save forecast
+        forecast_path = os.path.join(
+            dir_str.data_checker_dir, get_forecast_filename(ts_name, forecast_horizon)
+        )
+        ts_forecast.to_csv(forecast_path)
+        forecast_paths.append(forecast_path)
 
-            if fc_configs.loc[ts_name, "Method"] == "persistence":
-                # For the persistence forecast, forecast for T + forecast_lead_time
-                # is the value of that timeseries at T time
-                ts_forecast = ts_csv_df.set_index(ts_csv_df.index + forecast_horizon)
-
-            elif fc_configs.loc[ts_name, "Method"] == "solar persistence":
-                # Slightly more complicated than the persistence method, it assumes that
-                # the cloudiness (solar output/ clear sky output) would remain the same
-                # And assumes the usage of a one-axis tracking panels with N-S axis
-
-                clear_sky_output_fc = get_typical_1axis_CSO(
-                    ts_csv_df.index
-                    + forecast_horizon
-                    - configs.tz_from_utc * pd.Timedelta("1h"),
-                    configs.latitude,
-                    configs.longitude,
-                )
+    return forecast_paths
 
-                clear_sky_output = get_typical_1axis_CSO(
-                    ts_csv_df.index - configs.tz_from_utc * pd.Timedelta("1h"),
-                    configs.latitude,
-                    configs.longitude,
-                )
 
-                cso_ratio = (clear_sky_output_fc.values + 1e-4) / (
-                    clear_sky_output.values + 1e-4
-                )
-                # Cap adjustment factors at 2
-                cso_ratio = np.clip(cso_ratio, a_min=0.5, a_max=2)
-                ts_forecast = ts_csv_df.set_index(ts_csv_df.index + forecast_horizon)
-                ts_forecast[COL_NAME_VALUE] *= cso_ratio
+def add_forecast_configs(configs):
+    """
+    Add the synthesized forecasts to the timeseries in the configs, with their lag term configs
+    :param configs: parse_excel_configs.ExcelConfig. Configuration of the data preprocessing procedure, updated in place
+    """
+    fc_configs = configs.forecast_configs  # alias
+    fc_contrib = configs.forecast_error_contribution  # alias
+    ts_attrs = configs.timeseries_attributes  # alias
 
-            else:
-                raise ValueError(
-                    "Only persistence and solar persistence are supported!"
-                )
+    for ts_name in fc_configs.index[fc_configs["Synthesize Forecast?"].astype(bool)]:
+        forecast_horizon = pd.Timedelta(fc_configs.loc[ts_name, "Forecast Horizon"])
+        forecast_filename = get_forecast_filename(ts_name, forecast_horizon)
+
+        # Add the ts forecast to the timeseries.
+        ts_fc_name = ts_name + "_forecast"
+        fc_contrib.loc[ts_fc_name] = fc_contrib.loc[ts_name]
+        fc_contrib.loc[ts_fc_name, "Forecast or Actual"] = "Forecast"
+        ts_attrs.loc[ts_fc_name, "File Name"] = forecast_filename
+        ts_attrs.loc[ts_fc_name, ["Is Input?", "Is Output?"]] = [True, False]
+        if "Is Mandatory?" in ts_attrs.columns:
+            # the forecast can be screened out along with its timeseries, see feature_screening.py
+            ts_attrs.loc[ts_fc_name, "Is Mandatory?"] = ts_attrs.loc[
+                ts_name, "Is Mandatory?"
+            ]
+
+        # Generate lag terms configs for it
+        configs.lag_term_configs.loc[ts_fc_name] = fc_configs.loc[
+            ts_name,
+            ["Forecast Term Start", "Forecast Term End", "Forecast Term Step"],
+        ].values
 
-            # Save forecast
-            forecast_filename = "{}_forecast_T+{:.0f}min.csv".format(
-                ts_name, forecast_horizon / pd.Timedelta("1T")
-            )
-            ts_forecast.to_csv(
-                os.path.join(dir_str.data_checker_dir, forecast_filename)
-            )
 
-            # Add the ts forecast to the timeseries.
-            ts_fc_name = ts_name + "_forecast"
-            fc_contrib.loc[ts_fc_name] = fc_contrib.loc[ts_name]
-            fc_contrib.loc[ts_fc_name, "Forecast or Actual"] = "Forecast"
-            ts_attrs.loc[ts_fc_name, "File Name"] = forecast_filename
-            ts_attrs.loc[ts_fc_name, ["Is Input?", "Is Output?"]] = [True, False]
+def read_data_checker_csv(csv_path):
+    """
+    Read in a single data-checker output file. Only the three columns used downstream are parsed, with explicit
+    dtypes so that pandas doesn't need to infer them.
+    :param csv_path: str or pathlib.Path. Path to the data-checker output file
+    :return: ts_csv_df: pd.DataFrame indexed by the interval start time, holding the value and validity columns
+    """
+    ts_csv_df = pd.read_csv(
+        csv_path,
+        usecols=[COL_NAME_DATETIME, COL_NAME_VALUE, COL_NAME_VALIDITY],
+        dtype={COL_NAME_VALUE: "float64", COL_NAME_VALIDITY: "bool"},
+        index_col=COL_NAME_DATETIME,
+        parse_dates=True,
+        infer_datetime_format=True,
+    )
 
-            # Generate lag terms configs for it
-            configs.lag_term_configs.loc[ts_fc_name] = fc_configs.loc[
-                ts_name,
-                ["Forecast Term Start", "Forecast Term End", "Forecast Term Step"],
-            ].values
+    return ts_csv_df
 
-    return configs
 
+def load_timeseries(csv_path, ts_name, sample_interval, series_cache=None, report=None):
+    """
+    Read in a single data-checker output file and match its frequency to the sample interval of the ML model
+    :param csv_path: str or pathlib.Path. Path to the data-checker output file
+    :param ts_name: str. Name of the ts
+    :param sample_interval: pd.Timedelta. The time step of the ML model
+    :param series_cache: series_cache.SeriesCache or None. If provided, the parsed and frequency-matched series
+    is taken from the cache when available, and saved to it otherwise
+    :param report: instrumentation.RunReport or None. If provided, the read is measured and recorded in it
+    :return: ts_data_one, sub_ts_df: Outputs of match_frequency
+    """
+    with measure(report, ts_name, kind="series", per_thread=True) as record:
+        if series_cache is not None:
+            cache_key = series_cache.get_key(csv_path, ts_name, sample_interval)
+            cached_frames = series_cache.load(cache_key)
+            if cached_frames is not None:
+                record["status"] = "cached"
+                record_series_out(record, *cached_frames)
+                return cached_frames
+
+        ts_csv_df = read_data_checker_csv(csv_path)
+        record_data_in(record, ts_csv_df)
+        ts_data_one, sub_ts_df = match_frequency(ts_csv_df, ts_name, sample_interval)
+
+        if series_cache is not None:
+            series_cache.save(cache_key, ts_data_one, sub_ts_df)
+        record_series_out(record, ts_data_one, sub_ts_df)
 
-def read_all_timeseries(dir_str, configs):
+    return ts_data_one, sub_ts_df
+
+
+def record_series_out(record, ts_data_one, sub_ts_df):
     """
-    Read in all time series according to the timeseries attribute tab
+    Record the size of a ts read in, counting the columns of its sub time series if any, see load_timeseries
+    """
+    record_data_out(record, ts_data_one)
+    if sub_ts_df is not None:
+        record["columns_out"] += sub_ts_df.shape[1]
+
+
+def read_all_timeseries(dir_str, configs, report=None):
+    """
+    Read in all time series according to the timeseries attribute tab. Files are read concurrently in a thread pool,
+    as the bulk of the parsing in pandas is done without holding the GIL. The number of threads can be set through
+    an optional "Num Read Workers" main parameter. Parsed series are cached under the raw data directory, whose
+    size limit can be set through an optional "Series Cache Size MB" main parameter. The series are cast to the
+    pipeline dtype if one is set, see get_pipeline_dtype.
     :param configs: parse_excel_configs.ExcelConfig. Configuration of the data preprocessing procedure
     :param dir_str: utility.DirStructure. Directory structure of the current model
+    :param report: instrumentation.RunReport or None. If provided, the read of each series is recorded in it
     :return: ts_data_df: containing the timeseries information, with 1 column corresponding to one row in the input
     sub_ts_dict: dict(str: pd.DataFrame). For timeseries that are at least twice as more frequent than sample interval,
     sub time series would be created to preserve this information.
     """
 
     ts_attrs = configs.timeseries_attributes  # alias
+    dtype = get_pipeline_dtype(configs)
+    max_workers = getattr(configs, "num_read_workers", None)
+    if max_workers is not None:
+        max_workers = int(max_workers)
+    series_cache = SeriesCache(
+        dir_str.series_cache_dir,
+        getattr(configs, "series_cache_size_mb", DEFAULT_MAX_SIZE_MB),
+    )
 
     # Reading in time series and matching them to the frequency needed
-    ts_data_df = pd.DataFrame()  # empty container for all time series and
-    sub_ts_dict = {}  # empty container for all sub-time series
-    # Iterate over each time series from data-checker
-    for ts_name in ts_attrs.index:
-
-        print("Reading in " + ts_name + "...")
-        ts_csv_df = pd.read_csv(
-            os.path.join(dir_str.data_checker_dir, ts_attrs.loc[ts_name, "File Name"]),
-            index_col=COL_NAME_DATETIME,
-            parse_dates=True,
-            infer_datetime_format=True,
-        )
-        # match the feature frequency with the required frequency of ML problem
-        ts_data_one, sub_ts_dict[ts_name] = match_frequency(
-            ts_csv_df, ts_name, configs.sample_interval
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                load_timeseries,
+                os.path.join(
+                    dir_str.data_checker_dir, ts_attrs.loc[ts_name, "File Name"]
+                ),
+                ts_name,
+                configs.sample_interval,
+                series_cache,
+                report,
+            )
+            for ts_name in ts_attrs.index
+        ]
+
+        ts_data_list = []  # container for all time series
+        sub_ts_dict = {}  # empty container for all sub-time series
+        for ts_name, future in zip(ts_attrs.index, futures):
+            print("Reading in " + ts_name + "...")
+            ts_data_one, sub_ts_df = future.result()
+            # Cast each ts as it comes in, so the full frame is never held in a wider type
+            ts_data_list.append(cast_to_dtype(ts_data_one, dtype))
+            sub_ts_dict[ts_name] = cast_to_dtype(sub_ts_df, dtype)
+    series_cache.evict()
+
+    # collect each individual feature or sub-feature into the total timeseries data dataframe in one go
+    ts_data_df = pd.concat(ts_data_list, axis=1, join="outer")
+
+    return ts_data_df, sub_ts_dict
+
+
+def get_time_step(ts_index):
+    """
+    Determine the time-step size of a ts as the most common interval between its timestamps. Unlike pd.infer_freq,
+    this tolerates a few missing or irregular timestamps
+    :param ts_index: pd.DatetimeIndex. Sorted timestamps of the ts
+    :return: ts_time_step: pd.Timedelta
+    """
+    ts_diffs = np.diff(ts_index.asi8)
+    ts_diffs = ts_diffs[ts_diffs > 0]
+    if len(ts_diffs) == 0:
+        raise ValueError(
+            "Raw data has less than two distinct timestamps! Cannot discern Frequency!"
         )
 
-        # collect each individual feature or sub-feature into the total timeseries data dataframe
-        ts_data_df = pd.concat([ts_data_df, ts_data_one], axis=1, join="outer")
+    diff_values, diff_counts = np.unique(ts_diffs, return_counts=True)
+    return pd.Timedelta(int(diff_values[np.argmax(diff_counts)]))
 
-    return ts_data_df, sub_ts_dict
+
+def align_to_grid(ts_data_one, grid_index, tolerance):
+    """
+    Pick the value of a ts at each point of a regular time grid, using the nearest timestamp of the ts within a
+    tolerance. Grid points without any timestamp close enough are left as NaN
+    :param ts_data_one: pd.Series. The ts, with a sorted and unique index
+    :param grid_index: pd.DatetimeIndex. The time grid
+    :param tolerance: pd.Timedelta. Largest allowed distance between a grid point and the timestamp picked for it
+    :return: grid_values: np.ndarray of float64, with the same length as grid_index
+    """
+    grid_pos = ts_data_one.index.get_indexer(
+        grid_index, method="nearest", tolerance=tolerance
+    )
+    grid_values = ts_data_one.to_numpy(dtype="float64")[grid_pos]
+    grid_values[grid_pos < 0] = np.nan
+
+    return grid_values
 
 
 def match_frequency(ts_csv_df, ts_name, sample_interval):
     """
     Unstack or pad the original ts in order to achieve desired frequency.
 
+    The ts is aligned in one pass to a grid of the model time step, anchored at whole multiples of the time step.
+    Timestamps of a ts that doesn't start on the grid, e.g. a 15-min ts starting at 00:05, are snapped to the nearest
+    grid point, and missing timestamps are left as NaN.
+
     Args:
         ts_csv_df: pd.DataFrame. the dataframe of the ts read in from hard drive, following data checker output format
         ts_name: str. Name of the ts
-        sample_interval: int. The time step of the ML model expressed in seconds.
+        sample_interval: pd.Timedelta. The time step of the ML model
 
     Returns:
-        ts_data_srs: pd.Series of pd.DataFrame. Time series data
+        ts_data_one: pd.DataFrame of (M,1). Time series data on the model time grid
+        sub_ts_df: pd.DataFrame of (M,S) or None. Sub time series, if the ts is more frequent than the model
 
     """
 
     # Embed info about validity, so we can use the ts_data_df alone going forward
-    ts_csv_df.loc[~ts_csv_df[COL_NAME_VALIDITY], COL_NAME_VALUE] = None
+    ts_data_one = (
+        ts_csv_df[COL_NAME_VALUE].where(ts_csv_df[COL_NAME_VALIDITY]).rename(ts_name)
+    )
+    if not (ts_data_one.index.is_monotonic_increasing and ts_data_one.index.is_unique):
+        ts_data_one = ts_data_one.loc[~ts_data_one.index.duplicated()].sort_index()
     # sub timeseries are sometimes generated from frequency matching of high freq ts
     sub_ts_df = None
-    # Rename from generic col name to ts-specific name
-    ts_data_one = ts_csv_df[COL_NAME_VALUE].rename(ts_name)
 
     # Determine time-step size in the data for this ts
-    ts_freq = pd.infer_freq(ts_data_one.index)
-    assert (
-        ts_freq is not None
-    ), "Raw data does not have equally spaced index! Cannot discern Frequency!"
-
-    # If inferred frequency is 1 of something, say 1 min or 1 H, it will just be represented
-    # as "T" or "H". Need to turn it into "1T" or "1H" to interpret as a number using the Timedelta function
-    if ts_freq[0].isdigit():
-        ts_time_step = pd.Timedelta(ts_freq)
-    else:
-        ts_time_step = pd.Timedelta("1" + ts_freq)
-
-    # TODO: The script takes care of frequency mismatch, but not starting time mismatch.
-
-    # ==== Option 1 of 3 ====
-    # If the ts time-step size matches, place the ts into the ML inputs df without any changes
-    if ts_time_step == sample_interval:
-        ts_data_one = ts_data_one.to_frame()
+    ts_time_step = get_time_step(ts_data_one.index)
+
+    # The model time grid covering the ts
+    grid_index = pd.date_range(
+        ts_data_one.index[0].floor(sample_interval),
+        ts_data_one.index[-1].floor(sample_interval),
+        freq=sample_interval,
+        name=ts_data_one.index.name,
+    )
 
-    # ==== Option 2 of 3 ====
+    # ==== Option 1 of 2 ====
     # If the input is more frequent than desired, create multiple timeseries
     # E.g. Given 5-min ts and ML inputs are on a 15-min resolution. Then, create three 15-minutely tss
     # out of each one of the 5-min ts currently being assessed
-    elif ts_time_step < sample_interval:
+    if ts_time_step < sample_interval:
         # calculate number of sub steps and organize ts frequency into sth that can be obtained
         # through dividing ML time step with an integer
         num_sub_steps = sample_interval // ts_time_step
-        ts_data_one_resampled = ts_data_one.resample(
-            sample_interval / num_sub_steps
-        ).nearest()
-
-        # pick the average, when you need to use a single ts instead of all the sub ts
-        ts_data_one = ts_data_one.resample(sample_interval).mean().to_frame()
-        sub_ts_df = pd.DataFrame(index=ts_data_one.index)
-
-        # append each of the sub ts into the data df
-        for i in range(num_sub_steps):
-            # set index to have the same frequency as sample interval
-            sub_ts_df["{}_sub_step_{}".format(ts_name, i)] = ts_data_one_resampled.iloc[
-                i::num_sub_steps
-            ].values
+        sub_grid_index = pd.date_range(
+            grid_index[0],
+            periods=len(grid_index) * num_sub_steps,
+            freq=sample_interval / num_sub_steps,
+        )
+        # a single reshape of the contiguous sub step values puts each sub step into its own column
+        sub_ts_values = align_to_grid(
+            ts_data_one, sub_grid_index, ts_time_step / 2
+        ).reshape(-1, num_sub_steps)
+        sub_ts_df = pd.DataFrame(
+            sub_ts_values,
+            index=grid_index,
+            columns=["{}_sub_step_{}".format(ts_name, i) for i in range(num_sub_steps)],
+        )
+
+        # pick the average of the valid values within each time step, when you need to use a single ts instead of
+        # all the sub ts
+        step_pos = (ts_data_one.index - grid_index[0]) // sample_interval
+        is_valid = ts_data_one.notna().to_numpy()
+        step_sums = np.bincount(
+            step_pos[is_valid],
+            weights=ts_data_one.to_numpy()[is_valid],
+            minlength=len(grid_index),
+        )
+        step_counts = np.bincount(step_pos[is_valid], minlength=len(grid_index))
+        with np.errstate(invalid="ignore"):
+            ts_data_one = pd.DataFrame(
+                step_sums / step_counts, index=grid_index, columns=[ts_name]
+            )
 
-    # ==== Option 3 of 3 ====
-    # If ts frequency is lower than desired, pad the series into ML frequency
+    # ==== Option 2 of 2 ====
+    # If the ts time-step size matches, place the ts onto the model time grid. If ts frequency is lower than desired,
+    # pad the series into ML frequency by repeating the nearest value
     else:
-        ts_data_one = ts_data_one.resample(sample_interval).nearest().to_frame()
+        ts_data_one = pd.DataFrame(
+            align_to_grid(ts_data_one, grid_index, ts_time_step / 2),
+            index=grid_index,
+            columns=[ts_name],
+        )
 
     return ts_data_one, sub_ts_df
 
@@ -258,63 +424,295 @@ def calculate_forecast_error(ts_data_df, configs, dir_str):
     original number of time series, while R being the newly generated forecast error time series
     equal to the number of timeseries category +1
     """
-    # Initialize df to store response variable(s)
-    fe_contrib = configs.forecast_error_contribution
-    fe_configs = configs.forecast_error_configs
+    fc_err_df = compute_forecast_error(ts_data_df, configs, dir_str)
+    add_forecast_error_configs(configs)
+
+    return fc_err_df
+
+
+def compute_forecast_error(ts_data_df, configs, dir_str, save=True):
+    """
+    Calculate the forecast errors, see calculate_forecast_error. The configs are left untouched
+    :param save: bool. Whether to save the net load forecast error to the data checker directory. Incremental runs,
+    which only calculate the errors of the latest time points, leave the one of the last full run in place
+    :return: fc_err_df: pd.DataFrame of (M,R). The forecast error time series
+    """
+    fc_err_df = calculate_forecast_error_scenarios(
+        ts_data_df,
+        configs.forecast_error_configs,
+        {"base": configs.forecast_error_contribution},
+    )["base"]
+
+    # save to hard drive. Written to a temporary file first, as models preprocessed side by side share this file
+    if save and "Net_Load_Forecast_Error" in fc_err_df.columns:
+        fc_err_path = os.path.join(dir_str.data_checker_dir, "total_fc_error.csv")
+        tmp_path = "{}.tmp{}".format(fc_err_path, os.getpid())
+        fc_err_df.to_csv(tmp_path)
+        os.replace(tmp_path, fc_err_path)
+
+    return fc_err_df
+
 
-    # when actual load is higher than forecast or when forecast gen is higher than
-    # actual, you need upward reserve
+def build_forecast_error_signs(fe_contrib, fe_configs, ts_names):
+    """
+    Express the forecast errors of all categories as a sparse (timeseries x category) matrix of signs, so that the
+    forecast errors are the product of the timeseries with it. When actual load is higher than forecast or when
+    forecast gen is higher than actual, you need upward reserve, which is counted as positive
+    :param fe_contrib: pd.DataFrame. Contribution of each timeseries to the forecast errors, in the format of the
+    forecast error contribution tab
+    :param fe_configs: pd.DataFrame. Forecast error configs tab
+    :param ts_names: pd.Index. Names of the timeseries, in the order of the rows of the matrix
+    :return: signs: scipy.sparse.csc_matrix of (N,R) int8. R being the number of forecast errors to synthesize, with
+    the net load forecast error last, if any
+    fc_error_names: list of str. Names of the R forecast errors
+    """
     is_upward_reserve = (fe_contrib["Generation or Load"] == "Load") == (
         fe_contrib["Forecast or Actual"] == "Actual"
     )
-    fc_err_multipliers = (is_upward_reserve - 0.5) * 2  # convert (0,1) to (-1,1)
-    fc_err_df = pd.DataFrame(index=ts_data_df.index)
+    fc_err_multipliers = np.where(is_upward_reserve, 1, -1)  # convert (0,1) to (-1,1)
+    ts_pos = ts_names.get_indexer(fe_contrib.index)
+
+    rows, cols, fc_error_names = [], [], []
     for fe_cat in fe_configs.index:
         if fe_cat == "Net Load Forecast Error":
             continue
 
         if fe_configs.loc[fe_cat, "Synthesize Error?"]:
-            fc_error_name = fe_cat + "_Forecast_Error"
-            mask_of_category = (fe_contrib["Category"] == fe_cat) & (
-                fe_contrib["Impacts Forecast Error?"]
-            )
-            # pick out the timeseries of this category, and assign positive and negative
-            # based on forecast/actual
-            ts_fc_err = (
-                ts_data_df[ts_data_df.columns[mask_of_category]]
-                * fc_err_multipliers[mask_of_category].values
-            )
-            # No NaN is allowed in the summation process. Any NaN would nullify the
-            # entire row
-            fc_err_df[fc_error_name] = ts_fc_err.sum(
-                min_count=mask_of_category.sum(), axis=1
-            )
-            configs.lead_term_configs.loc[fc_error_name] = fe_configs.loc[
-                fe_cat,
-                [
-                    "Error Lead Term Start",
-                    "Error Lead Term End",
-                    "Error Lead Term Step",
-                ],
-            ].values
+            mask_of_category = (
+                (fe_contrib["Category"] == fe_cat)
+                & fe_contrib["Impacts Forecast Error?"]
+            ).to_numpy(dtype=bool)
+            if (ts_pos[mask_of_category] < 0).any():
+                raise KeyError(
+                    "Timeseries {} of {} not found!".format(
+                        list(fe_contrib.index[mask_of_category & (ts_pos < 0)]), fe_cat
+                    )
+                )
+            rows.append(np.flatnonzero(mask_of_category))
+            cols.append(np.full(mask_of_category.sum(), len(fc_error_names)))
+            fc_error_names.append(fe_cat + "_Forecast_Error")
 
-    # save to hard drive
-    # Calculate net load forecast error by adding this category's forecast error
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+    cols = np.concatenate(cols) if cols else np.array([], dtype=int)
+    # The net load forecast error sums up all the timeseries of all the categories above
     if fe_configs.loc["Net Load Forecast Error", "Synthesize Error?"]:
-        fc_err_df["Net_Load_Forecast_Error"] = fc_err_df.sum(
-            axis=1, min_count=fc_err_df.shape[1]
+        rows = np.concatenate([rows, rows])
+        cols = np.concatenate([cols, np.full(len(cols), len(fc_error_names))])
+        fc_error_names.append("Net_Load_Forecast_Error")
+
+    signs = scipy.sparse.csc_matrix(
+        (fc_err_multipliers[rows].astype("int8"), (ts_pos[rows], cols)),
+        shape=(len(ts_names), len(fc_error_names)),
+    )
+
+    return signs, fc_error_names
+
+
+def calculate_forecast_error_scenarios(ts_data_df, fe_configs, fe_contribs):
+    """
+    Calculate the forecast errors under one or more forecast error contributions, e.g. to evaluate what-if changes
+    in which resources count towards the forecast errors. The sign matrices of all contributions are stacked side by
+    side and applied to the timeseries in a single sparse matrix product. As with summing with a min_count of all
+    the timeseries involved, a forecast error is NaN whenever any of its timeseries is NaN
+    :param ts_data_df: pd.DataFrame of (M,N). The timeseries
+    :param fe_configs: pd.DataFrame. Forecast error configs tab
+    :param fe_contribs: dict[str, pd.DataFrame]. Forecast error contributions, by name of the scenario
+    :return: fc_err_dfs: dict[str, pd.DataFrame of (M,R)]. Forecast errors of each scenario
+    """
+    ts_names = pd.Index(ts_data_df.columns)
+    sign_list, fc_error_names_list = zip(
+        *[
+            build_forecast_error_signs(fe_contrib, fe_configs, ts_names)
+            for fe_contrib in fe_contribs.values()
+        ]
+    )
+    signs = scipy.sparse.hstack(sign_list, format="csc")
+
+    # The transposed values are a view of the timeseries as pandas holds them, with each timeseries contiguous
+    ts_values_t = np.ascontiguousarray(ts_data_df.to_numpy().T)
+    dtype = np.result_type(ts_values_t.dtype, np.float32)
+
+    # (M,N) x (N,R), done as (R,N) x (N,M) so that the product streams over the contiguous timeseries. As only the
+    # non-zero signs are multiplied in, timeseries contributing to no forecast error are never read, and a NaN only
+    # spreads to the forecast errors its timeseries contributes to
+    fc_err_values = (signs.T.tocsr().astype(dtype) @ ts_values_t).T
+
+    fc_err_dfs = {}
+    col_start = 0
+    for scenario, fc_error_names in zip(fe_contribs, fc_error_names_list):
+        col_end = col_start + len(fc_error_names)
+        fc_err_dfs[scenario] = pd.DataFrame(
+            fc_err_values[:, col_start:col_end],
+            index=ts_data_df.index,
+            columns=fc_error_names,
         )
+        col_start = col_end
+
+    return fc_err_dfs
+
+
+def add_forecast_error_configs(configs):
+    """
+    Add the lead term configs of the forecast errors calculated by compute_forecast_error
+    :param configs: parse_excel_configs.ExcelConfig. Configuration of the data preprocessing procedure, updated in place
+    """
+    fe_configs = configs.forecast_error_configs
+    lead_term_cols = [
+        "Error Lead Term Start",
+        "Error Lead Term End",
+        "Error Lead Term Step",
+    ]
+    for fe_cat in fe_configs.index:
+        if fe_cat == "Net Load Forecast Error":
+            continue
+
+        if fe_configs.loc[fe_cat, "Synthesize Error?"]:
+            configs.lead_term_configs.loc[fe_cat + "_Forecast_Error"] = fe_configs.loc[
+                fe_cat, lead_term_cols
+            ].values
+
+    if fe_configs.loc["Net Load Forecast Error", "Synthesize Error?"]:
         configs.lead_term_configs.loc["Net_Load_Forecast_Error"] = fe_configs.loc[
-            fe_cat,
-            [
-                "Error Lead Term Start",
-                "Error Lead Term End",
-                "Error Lead Term Step",
-            ],
+            fe_cat, lead_term_cols
         ].values
-        fc_err_df.to_csv(os.path.join(dir_str.data_checker_dir, "total_fc_error.csv"))
 
-    return fc_err_df
+
+def get_max_lag_and_lead(lag_term_configs, lead_term_configs):
+    """
+    Find the furthest lag and lead terms referred to in the term configs, expressed in sample intervals
+    :param lag_term_configs: pd.DataFrame of (I,3). Configuration of lag terms for input features
+    :param lead_term_configs: pd.DataFrame of (O,3). Configuration of lead terms for model responses
+    :return: max_lag_terms: int, non-positive. max_lead_terms: int, non-negative
+    """
+    max_lag_terms = min(
+        [lag_term_configs["Start"].min(), 0, lead_term_configs["Start"].min()]
+    )
+    max_lead_terms = max(
+        [lag_term_configs["End"].max(), 0, lead_term_configs["End"].max()]
+    )
+
+    return int(max_lag_terms), int(max_lead_terms)
+
+
+def get_pipeline_dtype(configs):
+    """
+    Floating type all the intermediate data of the preprocessing is kept in, set through an optional
+    "Pipeline Dtype" main parameter, e.g. float32. NaN marks both the padding and the invalid values. If not set,
+    the time series stay in the type they are read in with and only the lag and lead matrix is built in
+    DEFAULT_MATRIX_DTYPE
+    :param configs: parse_excel_configs.ExcelConfig. Configuration of the data preprocessing procedure
+    :return: dtype: np.dtype or None
+    """
+    dtype = getattr(configs, "pipeline_dtype", None)
+    if dtype is None:
+        return None
+    dtype = np.dtype(dtype)
+    if dtype.kind != "f":
+        raise ValueError("Pipeline dtype must be a floating type to hold NaNs!")
+
+    return dtype
+
+
+def get_matrix_dtype(configs):
+    """
+    :param configs: parse_excel_configs.ExcelConfig. Configuration of the data preprocessing procedure
+    :return: dtype: np.dtype. Type the lag and lead matrix is built in, the pipeline dtype if set
+    """
+    dtype = get_pipeline_dtype(configs)
+
+    return np.dtype(DEFAULT_MATRIX_DTYPE) if dtype is None else dtype
+
+
+def cast_to_dtype(data_df, dtype):
+    """
+    :param data_df: pd.DataFrame or None
+    :param dtype: np.dtype or None. No casting if None
+    :return: data_df cast to dtype, without copying if it is already of that type
+    """
+    if (data_df is None) or (dtype is None):
+        return data_df
+
+    return data_df.astype(dtype, copy=False)
+
+
+def check_dtype(data_df, dtype, stage_name):
+    """
+    Check at a stage boundary that no column has been upcast or turned into objects on the way
+    :param data_df: pd.DataFrame
+    :param dtype: np.dtype or None. Expected type of all the columns, no check if None
+    :param stage_name: str. Name of the stage that produced the data, for the error message
+    """
+    if dtype is None:
+        return None
+
+    is_wrong_dtype = data_df.dtypes != dtype
+    if is_wrong_dtype.any():
+        raise TypeError(
+            "Output of {} should be {}, but got {}".format(
+                stage_name,
+                dtype,
+                data_df.dtypes[is_wrong_dtype].astype(str).to_dict(),
+            )
+        )
+
+
+def get_last_processed_timestamp(data_dir, set_names=None):
+    """
+    Find the last sample saved by a previous run of the data preprocessing
+    :param data_dir: pathlib.Path. Directory holding the trainval, test and inference sets
+    :param set_names: list of str or None. Only look into these sets, e.g. ["trainval", "test"], or into all sets
+    :return: last_timestamp: pd.Timestamp, or None if no set has been saved yet
+    """
+    last_timestamps = [
+        get_last_timestamp(set_path)
+        for set_path in list_saved_sets(data_dir)
+        if set_path.name.startswith("input_")
+        and (
+            set_names is None
+            # e.g. input_trainval.pkl or input_trainval.part0003
+            or set_path.name.split(".")[0][len("input_") :] in set_names
+        )
+    ]
+
+    return max(last_timestamps) if last_timestamps else None
+
+
+def get_incremental_rebuild_start(data_dir, starts_and_ends, sample_interval):
+    """
+    First time point an incremental run has to rebuild. The time points saved to the inference set only, because
+    their lead outputs were not in yet, are rebuilt as well, so that they make it into the trainval or test set once
+    their outputs come in. Time points past the ends of the trainval and test sets are never rebuilt
+    :param data_dir: pathlib.Path. Directory holding the trainval, test and inference sets
+    :param starts_and_ends: pd.DataFrame. The start and end defined for the training, testing and inference sets
+    :param sample_interval: pd.Timedelta. Time step of the samples
+    :return: rebuild_start: pd.Timestamp, or None if no set has been saved yet
+    """
+    last_timestamp = get_last_processed_timestamp(data_dir)
+    if last_timestamp is None:
+        return None
+    rebuild_start = last_timestamp + sample_interval
+
+    labeled_sets = [
+        set_name for set_name in starts_and_ends.index if set_name != "infer"
+    ]
+    last_labeled_timestamp = get_last_processed_timestamp(data_dir, labeled_sets)
+    if last_labeled_timestamp is None:
+        labeled_start = starts_and_ends.loc[labeled_sets, "Start Time"].min()
+    else:
+        labeled_start = last_labeled_timestamp + sample_interval
+    if labeled_start < starts_and_ends.loc[labeled_sets, "End Time"].max():
+        rebuild_start = min(rebuild_start, labeled_start)
+
+    return rebuild_start
+
+
+def remove_saved_sets(data_dir):
+    """
+    Delete the trainval, test and inference sets saved by a previous run, including sets saved in shards
+    :param data_dir: pathlib.Path. Directory holding the trainval, test and inference sets
+    """
+    for set_path in list_saved_sets(data_dir):
+        remove_data_set(set_path)
 
 
 def pad_data_w_buffer(ts_data_df, lag_term_configs, lead_term_configs, sample_interval):
@@ -330,34 +728,45 @@ def pad_data_w_buffer(ts_data_df, lag_term_configs, lead_term_configs, sample_in
         sample_interval: pd.Timedelta. Interval between training/testing samples
 
     Returns:
-        ts_data_df: The feature data frame padded with enough NaNs in lag and lead direction
+        ts_data_df: The feature data frame padded with enough NaNs in lag and lead direction. Columns keep their
+        floating dtype
     """
 
     # Calculate the maximum amount of lag and lead to determine length of padding
-    max_lag_terms = min(
-        [lag_term_configs["Start"].min(), 0, lead_term_configs["Start"].min()]
-    )
-    max_lead_terms = max(
-        [lag_term_configs["End"].max(), 0, lead_term_configs["End"].max()]
+    max_lag_terms, max_lead_terms = get_max_lag_and_lead(
+        lag_term_configs, lead_term_configs
     )
 
     # Create padding for lag and lead terms
-    lag_terms_time_shift = np.arange(max_lag_terms, 0) * sample_interval
-    lead_terms_time_shift = np.arange(1, max_lead_terms + 1) * sample_interval
-    lag_pad = pd.DataFrame(
-        index=ts_data_df.index[0] + lag_terms_time_shift, columns=ts_data_df.columns
+    lag_terms_time_shift = pd.TimedeltaIndex(
+        np.arange(max_lag_terms, 0) * sample_interval
+    )
+    lead_terms_time_shift = pd.TimedeltaIndex(
+        np.arange(1, max_lead_terms + 1) * sample_interval
     )
-    lead_pad = pd.DataFrame(
-        index=ts_data_df.index[-1] + lead_terms_time_shift, columns=ts_data_df.columns
+    padded_index = (
+        (ts_data_df.index[0] + lag_terms_time_shift)
+        .append(ts_data_df.index)
+        .append(ts_data_df.index[-1] + lead_terms_time_shift)
     )
 
-    # Concatenate the padding to the raw data frame
-    padded_ts_data = pd.concat([lag_pad, ts_data_df, lead_pad])
+    # Reindexing fills the padding with NaNs of the type of each column, whereas concatenating empty frames to the
+    # raw data frame would turn every column into objects
+    padded_ts_data = ts_data_df.reindex(padded_index)
 
     return padded_ts_data
 
 
-def generate_lag_and_lead_terms(ts_data_df, lag_term_configs, lead_term_configs):
+def generate_lag_and_lead_terms(
+    ts_data_df, lag_term_configs, lead_term_configs, dropped_terms=None
+):
+    """
+    Build the lag and lead terms column by column, see build_lag_and_lead_matrix for the vectorized version
+    :param dropped_terms: list of str or None. Labels of terms screened out, which are left out altogether, see
+    feature_screening.py
+    :return: io_data_df, is_feature_input
+    """
+    dropped_terms = set() if dropped_terms is None else set(dropped_terms)
 
     # Initialize collectors to hold (and later save) trainval and inf data in
     io_data_df = pd.DataFrame(None, index=ts_data_df.index)
@@ -380,7 +789,12 @@ def generate_lag_and_lead_terms(ts_data_df, lag_term_configs, lead_term_configs)
             # Iterate over each time step for current predictor type
             for time_step in range(start, end + 1, step):
                 label = "{}_T{:+}".format(feature_name, time_step)
-                io_data_df[label] = None  # initialize feature values
+                if label in dropped_terms:
+                    continue
+                # initialize feature values as NaNs of the type of the feature
+                io_data_df[label] = pd.Series(
+                    np.nan, index=ts_index, dtype=ts_data_df[feature_name].dtype
+                )
                 if time_step > 0:
                     io_data_df.loc[ts_index[:-time_step], label] = ts_data_df.loc[
                         ts_index[time_step:], feature_name
@@ -398,8 +812,285 @@ def generate_lag_and_lead_terms(ts_data_df, lag_term_configs, lead_term_configs)
     return io_data_df, is_feature_input
 
 
+def list_lag_and_lead_terms(lag_term_configs, lead_term_configs, dropped_terms=None):
+    """
+    Enumerate every lag and lead term defined in the term configs, in the same order as they are
+    generated in generate_lag_and_lead_terms.
+
+    Args:
+        lag_term_configs: pd.DataFrame of (I,3). Configuration of lag terms for input features
+        lead_term_configs: pd.DataFrame of (O,3). Configuration of lead terms for model responses
+        dropped_terms: list of str or None. Labels of terms screened out, which are left out of the list
+
+    Returns:
+        terms_df: pd.DataFrame of (N2,3). Indexed by the label of each term, it holds the name of the source
+        feature, the time step (offset in sample intervals) and whether the term is an input
+    """
+
+    labels, features, time_steps, is_input = [], [], [], []
+    for i, term_configs in enumerate([lag_term_configs, lead_term_configs]):
+        # force the integer type as they are basis for range
+        term_configs = term_configs[["Start", "End", "Step"]].astype("int")
+        for feature_name in term_configs.index:
+            start, end, step = term_configs.loc[feature_name, ["Start", "End", "Step"]]
+            for time_step in range(start, end + 1, step):
+                labels.append("{}_T{:+}".format(feature_name, time_step))
+                features.append(feature_name)
+                time_steps.append(time_step)
+                # all lag terms are considered inputs, while lead_term are outputs
+                is_input.append(i == 0)
+
+    terms_df = pd.DataFrame(
+        {"Feature": features, "Time Step": time_steps, "Is Input?": is_input},
+        index=pd.Index(labels, dtype=object),
+    )
+    if dropped_terms is not None:
+        terms_df = terms_df.loc[~terms_df.index.isin(dropped_terms)]
+
+    return terms_df
+
+
+def get_window_validity(is_valid, start, end, step):
+    """
+    Dilate the validity of a ts over the time steps of its lag or lead terms
+    :param is_valid: np.ndarray of (M,) bool. Validity of the ts at each time point
+    :param start: int. Time step of the first term
+    :param end: int. Time step beyond which there are no more terms
+    :param step: int. Time steps between terms
+    :return: is_window_valid: np.ndarray of (M,) bool. Whether the ts is valid at all the time steps
+    range(start, end + 1, step) away from each time point. Time steps falling outside of the data are invalid
+    """
+    num_time_points = len(is_valid)
+    num_terms = len(range(start, end + 1, step))
+    if num_terms == 0:
+        return np.ones(num_time_points, dtype=bool)
+    end = start + (num_terms - 1) * step
+
+    # Invalidity of time points start to M - 1 + end away from the first time point
+    is_invalid = np.ones(num_time_points + end - start, dtype=bool)
+    first, last = max(start, 0), min(num_time_points - 1 + end, num_time_points - 1)
+    if first <= last:
+        is_invalid[first - start : last - start + 1] = ~is_valid[first : last + 1]
+
+    # Count the invalid time points of each window with cumulative sums taken every step, i.e. separately over each
+    # phase of the step, as the difference of the cumulative sums at the two ends of the window
+    padded_len = -(-len(is_invalid) // step) * step
+    invalid_cumsum = np.zeros(padded_len, dtype=np.int64)
+    invalid_cumsum[: len(is_invalid)] = is_invalid
+    invalid_cumsum = invalid_cumsum.reshape(-1, step).cumsum(axis=0).ravel()
+    window_ends = invalid_cumsum[end - start : end - start + num_time_points]
+    window_starts = np.zeros(num_time_points, dtype=np.int64)
+    window_starts[step:] = invalid_cumsum[: max(num_time_points - step, 0)]
+
+    return window_ends == window_starts
+
+
+def get_row_validity(
+    ts_data_df, lag_term_configs, lead_term_configs, dropped_terms=None
+):
+    """
+    Find the rows of the lag and lead matrix that have no NaN, without building it. Invalid values are NaN after
+    match_frequency, so the validity of each ts is dilated by the time steps of its terms, see get_window_validity.
+
+    Args:
+        ts_data_df: pd.DataFrame of (M,N). The feature data frame padded with NaNs, see pad_data_w_buffer
+        lag_term_configs: pd.DataFrame of (I,3). Configuration of lag terms for input features
+        lead_term_configs: pd.DataFrame of (O,3). Configuration of lead terms for model responses
+        dropped_terms: list of str or None. Labels of terms screened out, whose validity doesn't matter
+
+    Returns:
+        row_validity: pd.DataFrame of (M,2) bool, indexed as ts_data_df. Whether all the "input" and all the "output"
+        terms of each row of the lag and lead matrix are valid
+    """
+    row_validity = pd.DataFrame(
+        True, index=ts_data_df.index, columns=list(io_lag_lead_map)
+    )
+    dropped_terms = set() if dropped_terms is None else set(dropped_terms)
+    for data_cat, term_configs in zip(
+        io_lag_lead_map, [lag_term_configs, lead_term_configs]
+    ):
+        term_configs = term_configs[["Start", "End", "Step"]].astype("int")
+        is_valid = row_validity[data_cat].to_numpy()
+        for feature_name in term_configs.index:
+            start, end, step = term_configs.loc[feature_name, ["Start", "End", "Step"]]
+            is_feature_valid = ts_data_df[feature_name].notna().to_numpy()
+            time_steps = range(start, end + 1, step)
+            kept_steps = [
+                time_step
+                for time_step in time_steps
+                if "{}_T{:+}".format(feature_name, time_step) not in dropped_terms
+            ]
+            if len(kept_steps) == len(time_steps):
+                is_valid &= get_window_validity(is_feature_valid, start, end, step)
+            else:
+                # the kept terms are no longer evenly spaced, check them one by one
+                for time_step in kept_steps:
+                    is_valid &= get_window_validity(
+                        is_feature_valid, time_step, time_step, 1
+                    )
+        row_validity[data_cat] = is_valid
+
+    return row_validity
+
+
+def get_set_ranges(time_index, starts_and_ends):
+    """
+    :param time_index: pd.DatetimeIndex
+    :param starts_and_ends: pd.DataFrame. The start and end defined for the training, testing and inference sets
+    :return: set_ranges: dict[str, np.ndarray of bool]. Whether each time point falls in each set
+    """
+    return {
+        set_name: (
+            (starts_and_ends.loc[set_name, "Start Time"] <= time_index)
+            & (time_index < starts_and_ends.loc[set_name, "End Time"])
+        )
+        for set_name in starts_and_ends.index
+    }
+
+
+def get_rows_to_build(row_validity, starts_and_ends):
+    """
+    Rows of the lag and lead matrix that are kept in any set. The inference set only needs valid inputs, while the
+    other sets need valid inputs and outputs
+    :param row_validity: pd.DataFrame of (M,2) bool. See get_row_validity
+    :param starts_and_ends: pd.DataFrame. The start and end defined for the training, testing and inference sets
+    :return: is_row_needed: np.ndarray of (M,) bool
+    """
+    is_row_needed = np.zeros(len(row_validity), dtype=bool)
+    for set_name, set_range in get_set_ranges(
+        row_validity.index, starts_and_ends
+    ).items():
+        is_row_valid = row_validity["input"].to_numpy()
+        if set_name != "infer":
+            is_row_valid = is_row_valid & row_validity["output"].to_numpy()
+        is_row_needed |= set_range & is_row_valid
+
+    return is_row_needed
+
+
+def build_valid_lag_and_lead_matrix(
+    ts_data_df,
+    lag_term_configs,
+    lead_term_configs,
+    starts_and_ends,
+    dtype=DEFAULT_MATRIX_DTYPE,
+    start=None,
+    end=None,
+    dropped_terms=None,
+):
+    """
+    Build only the rows of the lag and lead matrix that are kept in any set, see build_lag_and_lead_matrix
+
+    Args:
+        ts_data_df: pd.DataFrame of (M,N). The feature data frame padded with NaNs, see pad_data_w_buffer
+        lag_term_configs: pd.DataFrame of (I,3). Configuration of lag terms for input features
+        lead_term_configs: pd.DataFrame of (O,3). Configuration of lead terms for model responses
+        starts_and_ends: pd.DataFrame. The start and end defined for the training, testing and inference sets
+        dtype: str or np.dtype. Data type of the returned matrix
+        start: pd.Timestamp or None. If provided, only rows from this time point on are considered
+        end: pd.Timestamp or None. If provided, only rows up to this time point, inclusive, are considered
+        dropped_terms: list of str or None. Labels of terms screened out, which are neither built nor checked for
+        validity, see feature_screening.py
+
+    Returns:
+        io_data_df: pd.DataFrame of (M2,N2). The rows needed by the sets
+        is_feature_input: pd.Series of (N2,) bool. A recording of whether each feature is an input
+        row_validity: pd.DataFrame of (M3,2) bool. See get_row_validity, for all the rows considered
+    """
+    row_validity = get_row_validity(
+        ts_data_df, lag_term_configs, lead_term_configs, dropped_terms
+    )
+    row_validity = row_validity.loc[start:end]
+    is_row_needed = get_rows_to_build(row_validity, starts_and_ends)
+    io_data_df, is_feature_input = build_lag_and_lead_matrix(
+        ts_data_df,
+        lag_term_configs,
+        lead_term_configs,
+        dtype=dtype,
+        row_positions=ts_data_df.index.get_indexer(row_validity.index[is_row_needed]),
+        dropped_terms=dropped_terms,
+    )
+
+    return io_data_df, is_feature_input, row_validity
+
+
+def build_lag_and_lead_matrix(
+    ts_data_df,
+    lag_term_configs,
+    lead_term_configs,
+    dtype=DEFAULT_MATRIX_DTYPE,
+    row_positions=None,
+    dropped_terms=None,
+):
+    """
+    Vectorized replacement of generate_lag_and_lead_terms. Instead of growing the data frame one label at a time,
+    the whole (time x feature x lag) matrix is preallocated as a single array, and each term is filled in with a
+    shifted view of the corresponding column of the padded ts_data_df.
+
+    Args:
+        ts_data_df: pd.DataFrame of (M,N). The feature data frame padded with NaNs, see pad_data_w_buffer
+        lag_term_configs: pd.DataFrame of (I,3). Configuration of lag terms for input features
+        lead_term_configs: pd.DataFrame of (O,3). Configuration of lead terms for model responses
+        dtype: str or np.dtype. Data type of the returned matrix. Must be a floating type to hold NaNs
+        row_positions: np.ndarray of int or None. If provided, only these rows of the matrix are built, e.g. the
+        valid ones, see build_valid_lag_and_lead_matrix. The terms of the rows must not fall outside of the data
+        dropped_terms: list of str or None. Labels of terms screened out, which are never built
+
+    Returns:
+        io_data_df: pd.DataFrame of (M,N2). Predictors and responses with all lag and lead terms generated
+        is_feature_input: pd.Series of (N2,) bool. A recording of whether each feature is an input
+    """
+
+    terms_df = list_lag_and_lead_terms(
+        lag_term_configs, lead_term_configs, dropped_terms
+    )
+    num_time_points = ts_data_df.shape[0]
+
+    # Only convert the features that are actually referred to by a term
+    features = terms_df["Feature"].unique()
+    ts_values = ts_data_df[features].to_numpy(dtype=dtype, na_value=np.nan)
+    feature_idx = pd.Index(features).get_indexer(terms_df["Feature"])
+
+    # Fortran order keeps every term contiguous in memory, so each assignment below is a plain block copy,
+    # and pandas can wrap the array into a single block without copying it again
+    if row_positions is None:
+        io_data = np.full(
+            (num_time_points, terms_df.shape[0]), np.nan, dtype=dtype, order="F"
+        )
+        for j, (f, time_step) in enumerate(zip(feature_idx, terms_df["Time Step"])):
+            if abs(time_step) >= num_time_points:
+                continue  # the whole term falls outside of the data, leave as NaN
+            if time_step > 0:
+                io_data[:-time_step, j] = ts_values[time_step:, f]
+            elif time_step < 0:
+                io_data[-time_step:, j] = ts_values[:time_step, f]
+            else:
+                io_data[:, j] = ts_values[:, f]
+        io_index = ts_data_df.index
+    else:
+        # Gather each term of the selected rows only, straight from the time series
+        io_data = np.empty(
+            (len(row_positions), terms_df.shape[0]), dtype=dtype, order="F"
+        )
+        for j, (f, time_step) in enumerate(zip(feature_idx, terms_df["Time Step"])):
+            np.take(ts_values[:, f], row_positions + time_step, out=io_data[:, j])
+        io_index = ts_data_df.index[row_positions]
+
+    io_data_df = pd.DataFrame(io_data, index=io_index, columns=terms_df.index)
+    is_feature_input = terms_df["Is Input?"].astype(bool).rename(None)
+
+    return io_data_df, is_feature_input
+
+
 def create_trainval_test_infer_sets(
-    io_data_df, starts_and_ends, is_feature_input, data_dir
+    io_data_df,
+    starts_and_ends,
+    is_feature_input,
+    data_dir,
+    append=False,
+    shard_id=None,
+    data_format=DEFAULT_DATA_FORMAT,
+    row_validity=None,
 ):
     """
     Takes the combined data set and separates out the trainval, test and inference sets
@@ -409,6 +1100,16 @@ def create_trainval_test_infer_sets(
     from the time series. It holds predictors and response variables, which have all lag and lead terms generated
     starts_and_ends: pd.DataFrame of [M, N2] the start and end defined for the training, testing and inference sets.
     is_feature_input: pd.Series of [N2] bool. A recording of whether each feature is an input
+    append: bool. If True, io_data_df only holds new time points. They are appended to the sets already saved in
+    data_dir, replacing any saved samples at or after the first new time point. Sets saved in one piece in the "npy"
+    format are appended to in place, see dataset.append_data_set; sets saved otherwise are read in, merged and saved
+    again in full
+    shard_id: int or None. If provided, io_data_df only holds one time chunk of the data, and the sets are saved as
+    numbered shards, e.g. input_trainval.part0003. Empty shards are not saved
+    data_format: str. Format to save the sets in, one of dataset.DATA_FORMATS. "npy" sets can be memory-mapped
+    row_validity: pd.DataFrame of [M3, 2] bool or None. Validity of the inputs and outputs of all the time points
+    considered, see get_row_validity. If provided, io_data_df may only hold the rows valid for any set, see
+    build_valid_lag_and_lead_matrix. Otherwise it is derived from io_data_df
 
     Output:
         None. The created input and output files are directly saved to hard drive
@@ -427,26 +1128,43 @@ def create_trainval_test_infer_sets(
     ):
         raise ValueError("There is overlap between training and testing data. BAD!")
 
+    if row_validity is None:
+        # A single pass over the matrix, rather than dropping the invalid samples of each set in turn
+        is_value_valid = ~np.isnan(io_data_df.to_numpy())
+        row_validity = pd.DataFrame(
+            {
+                data_cat: is_value_valid[
+                    :, is_feature_input.to_numpy() == (data_cat == "input")
+                ].all(axis=1)
+                for data_cat in io_lag_lead_map
+            },
+            index=io_data_df.index,
+        )
+        del is_value_valid
+
     # Separate train/inf set from the combined set
-    for set_name in starts_and_ends.index:
-        set_range = (
-            starts_and_ends.loc[set_name, "Start Time"] <= io_data_df.index
-        ) & (io_data_df.index < starts_and_ends.loc[set_name, "End Time"])
-        set_data_df = io_data_df.loc[set_range].copy()
-
-        # Inference set will not have a response. Delete the response columns
-        if set_name == "infer":
-            set_data_df = set_data_df.drop(
-                columns=set_data_df.columns[~is_feature_input]
-            )
+    set_ranges = get_set_ranges(row_validity.index, starts_and_ends)
+    for set_name, set_range in set_ranges.items():
+        # Inference set will not have a response, so only its inputs need to be valid
+        is_row_valid = row_validity["input"].to_numpy()
+        if set_name != "infer":
+            is_row_valid = is_row_valid & row_validity["output"].to_numpy()
 
         # summarize data validity and drop invalid samples
         print(
             "{} of {} {} samples are valid".format(
-                set_data_df.dropna().shape[0], set_data_df.shape[0], set_name
+                (set_range & is_row_valid).sum(), set_range.sum(), set_name
             )
         )
-        set_data_df = set_data_df.dropna()
+        row_pos = io_data_df.index.get_indexer(
+            row_validity.index[set_range & is_row_valid]
+        )
+        if (row_pos < 0).any():
+            raise ValueError(
+                "Valid samples of the {} set are missing from the data!".format(
+                    set_name
+                )
+            )
 
         for input_or_output in ["input", "output"]:
             if (set_name == "infer") and (input_or_output == "output"):
@@ -454,17 +1172,55 @@ def create_trainval_test_infer_sets(
             else:
                 is_looking_for_input = input_or_output == "input"
                 # Only retain trainval samples wherein predictor(s) and response(s) are both valid
-                set_io_df = set_data_df[
-                    io_data_df.columns[is_looking_for_input == is_feature_input]
+                set_io_df = io_data_df.iloc[
+                    row_pos,
+                    np.flatnonzero(is_looking_for_input == is_feature_input.to_numpy()),
                 ]
 
                 # save to hard drive
-                filename = "{}_{}.pkl".format(input_or_output, set_name)
+                set_path = get_set_path(
+                    data_dir, input_or_output, set_name, data_format, shard_id
+                )
+                if append:
+                    existing_paths = find_set_paths(data_dir, input_or_output, set_name)
+                    if existing_paths == [set_path] and set_path.is_dir():
+                        check_appended_columns(
+                            DataSet(set_path).columns, set_io_df.columns, set_path
+                        )
+                        append_data_set(set_io_df, set_path, row_validity.index[0])
+                        continue
+                    try:
+                        existing_io_df = read_data_set(
+                            data_dir, input_or_output, set_name
+                        )
+                    except FileNotFoundError:
+                        existing_io_df = set_io_df.iloc[:0]
+                    check_appended_columns(
+                        existing_io_df.columns, set_io_df.columns, set_path
+                    )
+                    set_io_df = pd.concat(
+                        [
+                            existing_io_df.loc[
+                                existing_io_df.index < row_validity.index[0]
+                            ],
+                            set_io_df,
+                        ]
+                    )
+                    # release the memory map of the existing set before it gets overwritten
+                    del existing_io_df
+
                 if (
                     len(set_io_df.index) >= 1
                 ):  # if there is no data then don't print out anything
-                    set_io_df.astype("float32").to_pickle(data_dir / filename)
-                else:
+                    if append:
+                        # the existing set may be saved in another format or in shards, replaced by the merged set
+                        for existing_path in find_set_paths(
+                            data_dir, input_or_output, set_name
+                        ):
+                            if existing_path != set_path:
+                                remove_data_set(existing_path)
+                    save_data_set(set_io_df, set_path)
+                elif shard_id is None:
                     print(
                         "{} for {} set is empty. Please double check!".format(
                             input_or_output, set_name
@@ -474,6 +1230,15 @@ def create_trainval_test_infer_sets(
     return None
 
 
+def check_appended_columns(existing_columns, new_columns, set_path):
+    if not pd.Index(existing_columns).equals(pd.Index(new_columns)):
+        raise ValueError(
+            "Features in {} differ from the current configs. Please run a full rebuild!".format(
+                set_path.name
+            )
+        )
+
+
 def concat_sub_ts(ts_data_df, sub_ts_dict, configs):
     """
     Combine the sub time series into previously generated timeseries DF
@@ -483,14 +1248,47 @@ def concat_sub_ts(ts_data_df, sub_ts_dict, configs):
     :return: ts_data_df: pd.DataFrame of (M, N + R +S) S being the net increase in timeseries when you count
     sub time series.
     """
+    ts_data_df = concat_sub_ts_data(ts_data_df, sub_ts_dict)
+    add_sub_ts_configs(configs, get_sub_ts_columns(sub_ts_dict))
 
-    ts_attrs = configs.timeseries_attributes
+    return ts_data_df
+
+
+def get_sub_ts_columns(sub_ts_dict):
+    """
+    :param sub_ts_dict: dict[str, pd.DataFrame]. The name of the timeseries as key, and unstacked dataframe as values
+    :return: sub_ts_columns: dict[str, list of str]. The name of the timeseries as key, and the names of its sub time
+    series as values, or None for timeseries with no sub
+    """
+    return {
+        ts_name: None if sub_ts_df is None else list(sub_ts_df.columns)
+        for ts_name, sub_ts_df in sub_ts_dict.items()
+    }
+
+
+def concat_sub_ts_data(ts_data_df, sub_ts_dict):
+    """
+    Replace the timeseries with their sub time series in the data, see concat_sub_ts. The configs are left untouched
+    """
     for ts_name, sub_ts_df in sub_ts_dict.items():
         if sub_ts_df is not None:  # skip all timeseries with no sub
             # Replace the 1 column timeseries with the multi-column sub timeseries
-            ts_data_df.drop(columns=ts_name, inplace=True)
-            ts_data_df = pd.concat((ts_data_df, sub_ts_df), axis=1, join="outer")
+            ts_data_df = pd.concat(
+                (ts_data_df.drop(columns=ts_name), sub_ts_df), axis=1, join="outer"
+            )
+
+    return ts_data_df
 
+
+def add_sub_ts_configs(configs, sub_ts_columns):
+    """
+    Replace the lag and lead term configs of the timeseries with the ones of their sub time series
+    :param configs: parse_excel_configs.ExcelConfigs. Configuration file of how to run this script, updated in place
+    :param sub_ts_columns: dict[str, list of str]. See get_sub_ts_columns
+    """
+    ts_attrs = configs.timeseries_attributes
+    for ts_name, sub_ts_cols in sub_ts_columns.items():
+        if sub_ts_cols is not None:  # skip all timeseries with no sub
             # The match frequency process sometimes change the name and amount of time series
             for data_cat, term_cat in io_lag_lead_map.items():
                 col_to_check = "Is {}?".format(data_cat.capitalize())
@@ -499,7 +1297,7 @@ def concat_sub_ts(ts_data_df, sub_ts_dict, configs):
 
                 if ts_attrs.loc[ts_name, col_to_check]:
                     addl_term_configs = pd.DataFrame(
-                        1, index=sub_ts_df.columns, columns=term_configs.columns
+                        1, index=sub_ts_cols, columns=term_configs.columns
                     )
                     addl_term_configs *= term_configs.loc[ts_name].values
                     # add in the new and drop the old
@@ -507,5 +1305,3 @@ def concat_sub_ts(ts_data_df, sub_ts_dict, configs):
                         ts_name
                     )
                     setattr(configs, term_configs_name, term_configs)
-
-    return ts_data_df
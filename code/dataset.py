@@ -0,0 +1,299 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Storage of the trainval, test and inference sets created by the data preprocessing. Two formats are supported:
+# "pkl": the set is a pickled pd.DataFrame, e.g. input_trainval.pkl
+# "npy": the set is a directory, e.g. input_trainval/, holding the values as a raw float32 array in values.npy,
+#        the timestamps in index.npy and the column names in schema.json. The values can be memory-mapped, so that
+#        opening a set is zero-copy and processes reading the same set share the same pages in memory.
+# Sets saved in chunks are split into numbered shards, e.g. input_trainval.part0003.pkl or input_trainval.part0003/
+
+import io
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+DATA_FORMATS = ["npy", "pkl"]
+DEFAULT_DATA_FORMAT = "npy"
+SCHEMA_VERSION = 1
+
+VALUES_FILENAME = "values.npy"
+INDEX_FILENAME = "index.npy"
+SCHEMA_FILENAME = "schema.json"
+# Present in a set while new samples are appended to it in place, see append_data_set
+APPENDING_FILENAME = "appending"
+
+
+class DataSet(object):
+    """
+    A set saved in the "npy" format. Values are memory-mapped and only read in from disk when accessed, so columns
+    or time ranges can be selected without loading the rest of the set.
+    """
+
+    def __init__(self, set_path):
+        """
+        Args:
+            set_path: pathlib.Path. Directory of the set
+        """
+        self.set_path = Path(set_path)
+        if (self.set_path / APPENDING_FILENAME).exists():
+            raise ValueError(
+                "{} was left half written while appending to it. Please run a full rebuild!".format(
+                    self.set_path
+                )
+            )
+        with open(self.set_path / SCHEMA_FILENAME) as f:
+            self.schema = json.load(f)
+
+        self.columns = pd.Index(self.schema["columns"], dtype=object)
+        self.index = pd.DatetimeIndex(
+            np.load(self.set_path / INDEX_FILENAME), name=self.schema["index_name"]
+        )
+        self.values = np.load(self.set_path / VALUES_FILENAME, mmap_mode="r")
+        self.shape = self.values.shape
+
+    def select(self, columns=None, start=None, end=None):
+        """
+        Select part of the set as a pd.DataFrame. A contiguous time range of all columns is a zero-copy view of the
+        memory-mapped values, while selecting a subset of columns reads only those values in.
+        :param columns: list of str or None. Columns to select, all columns if None
+        :param start: pd.Timestamp or None. Inclusive start of the time range, from the first time point if None
+        :param end: pd.Timestamp or None. Exclusive end of the time range, to the last time point if None
+        :return: set_df: pd.DataFrame
+        """
+        row_start = 0 if start is None else self.index.searchsorted(start, "left")
+        row_end = (
+            len(self.index) if end is None else self.index.searchsorted(end, "left")
+        )
+        values = self.values[row_start:row_end]
+
+        if columns is None:
+            columns = self.columns
+        else:
+            col_idx = self.columns.get_indexer(columns)
+            if (col_idx < 0).any():
+                raise KeyError(
+                    "{} not found in {}".format(
+                        list(pd.Index(columns)[col_idx < 0]), self.set_path
+                    )
+                )
+            values = values[:, col_idx]
+            columns = self.columns[col_idx]
+
+        return pd.DataFrame(
+            values, index=self.index[row_start:row_end], columns=columns, copy=False
+        )
+
+    def to_frame(self):
+        return self.select()
+
+
+def get_set_path(data_dir, input_or_output, set_name, data_format, shard_id=None):
+    """
+    Path where a set is saved
+    :param data_dir: pathlib.Path. Directory holding the sets, usually DirStructure.data_dir
+    :param input_or_output: str. Either "input" or "output"
+    :param set_name: str. One of "trainval", "test" or "infer"
+    :param data_format: str. One of DATA_FORMATS
+    :param shard_id: int or None. Number of the shard if the set is saved in chunks
+    :return: set_path: pathlib.Path
+    """
+    if data_format not in DATA_FORMATS:
+        raise ValueError("Data format must be one of {}!".format(DATA_FORMATS))
+
+    set_name = "{}_{}".format(input_or_output, set_name)
+    if shard_id is not None:
+        set_name += ".part{:04d}".format(shard_id)
+    if data_format == "pkl":
+        set_name += ".pkl"
+
+    return Path(data_dir) / set_name
+
+
+def find_set_paths(data_dir, input_or_output, set_name):
+    """
+    Find where a set is saved, in any of the supported formats
+    :return: set_paths: list of pathlib.Path. A single path if the set is saved in one piece, or the paths of all
+    the shards in order. Empty if the set is not found
+    """
+    for data_format in DATA_FORMATS:
+        set_path = get_set_path(data_dir, input_or_output, set_name, data_format)
+        if set_path.exists():
+            return [set_path]
+
+    shard_pattern = "{}_{}.part[0-9][0-9][0-9][0-9]*".format(input_or_output, set_name)
+    return sorted(
+        shard_path
+        for shard_path in Path(data_dir).glob(shard_pattern)
+        if shard_path.suffix != ".tmp"
+    )
+
+
+def list_saved_sets(data_dir):
+    """
+    List everything saved by the data preprocessing in a directory, including shards
+    :return: set_paths: list of pathlib.Path
+    """
+    return [
+        set_path
+        for pattern in ["input_*", "output_*"]
+        for set_path in Path(data_dir).glob(pattern)
+        if set_path.is_dir() or set_path.suffix == ".pkl"
+    ]
+
+
+def save_data_set(set_df, set_path):
+    """
+    Save a set as float32, in the format implied by its path (see get_set_path)
+    :param set_df: pd.DataFrame. The set to be saved
+    :param set_path: pathlib.Path
+    """
+    set_path = Path(set_path)
+    if set_path.suffix == ".pkl":
+        set_df.astype("float32", copy=False).to_pickle(set_path)
+        return None
+
+    # Write into a temporary directory first, so a set is never left half written
+    tmp_path = set_path.with_name(set_path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    Path.mkdir(tmp_path, parents=True)
+    np.save(tmp_path / VALUES_FILENAME, set_df.to_numpy(dtype="float32"))
+    np.save(tmp_path / INDEX_FILENAME, set_df.index.values.astype("datetime64[ns]"))
+    with open(tmp_path / SCHEMA_FILENAME, "w") as f:
+        json.dump(
+            {
+                "schema_version": SCHEMA_VERSION,
+                "columns": [str(col) for col in set_df.columns],
+                "index_name": set_df.index.name,
+                "dtype": "float32",
+                "shape": list(set_df.shape),
+            },
+            f,
+            indent=2,
+        )
+
+    remove_data_set(set_path)
+    os.replace(tmp_path, set_path)
+
+
+def append_data_set(set_df, set_path, start):
+    """
+    Replace the samples of a set saved in the "npy" format from a time point on with new ones, in place. The values
+    of the earlier samples are neither read in nor written again, so the cost is in the new samples, not the whole
+    history. Only the index, of 8 bytes a sample, is saved again in full. Sets whose values can't be appended to in
+    place, e.g. if the header of values.npy has no room left for the new shape, are merged in memory and saved again
+    :param set_df: pd.DataFrame. The new samples, with the same columns as the set, all at or after start
+    :param set_path: pathlib.Path. Directory of the set
+    :param start: pd.Timestamp. Samples of the set at or after it are replaced
+    """
+    set_path = Path(set_path)
+    data_set = DataSet(set_path)
+    num_kept = data_set.index.searchsorted(start, "left")
+    index = data_set.index[:num_kept].append(
+        pd.DatetimeIndex(set_df.index, name=data_set.index.name)
+    )
+    shape = (len(index), len(data_set.columns))
+    # release the memory map before the file is modified
+    del data_set
+
+    with open(set_path / VALUES_FILENAME, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            _, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            _, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_len = f.tell()
+        header = io.BytesIO()
+        header_dict = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": shape,
+        }
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_dict)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_dict)
+        is_appendable = not fortran_order and len(header.getvalue()) == header_len
+
+        if is_appendable:
+            # Flag the set until it is consistent again, so that an interruption is never mistaken for a complete set
+            (set_path / APPENDING_FILENAME).touch()
+            f.seek(header_len + num_kept * shape[1] * dtype.itemsize)
+            f.write(np.ascontiguousarray(set_df.to_numpy(dtype=dtype)).tobytes())
+            f.truncate()
+            f.seek(0)
+            f.write(header.getvalue())
+
+    if not is_appendable:
+        existing_df = DataSet(set_path).to_frame()
+        merged_df = pd.concat([existing_df.iloc[:num_kept], set_df])
+        del existing_df
+        save_data_set(merged_df, set_path)
+        return None
+
+    tmp_path = set_path / "{}.tmp{}.npy".format(INDEX_FILENAME, os.getpid())
+    np.save(tmp_path, index.values.astype("datetime64[ns]"))
+    os.replace(tmp_path, set_path / INDEX_FILENAME)
+    with open(set_path / SCHEMA_FILENAME) as f:
+        schema = json.load(f)
+    schema["shape"] = list(shape)
+    tmp_path = set_path / "{}.tmp{}".format(SCHEMA_FILENAME, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(schema, f, indent=2)
+    os.replace(tmp_path, set_path / SCHEMA_FILENAME)
+    (set_path / APPENDING_FILENAME).unlink()
+
+
+def remove_data_set(set_path):
+    set_path = Path(set_path)
+    if set_path.is_dir():
+        shutil.rmtree(set_path)
+    elif set_path.exists():
+        set_path.unlink()
+
+
+def load_data_set(set_path):
+    """
+    Load a set saved in either format. Sets in the "npy" format are memory-mapped rather than read in
+    :param set_path: pathlib.Path
+    :return: set_df: pd.DataFrame
+    """
+    set_path = Path(set_path)
+    if set_path.is_dir():
+        return DataSet(set_path).to_frame()
+
+    return pd.read_pickle(set_path)
+
+
+def get_last_timestamp(set_path):
+    """
+    Last time point of a set. For sets in the "npy" format, only the index is read in
+    :param set_path: pathlib.Path
+    :return: last_timestamp: pd.Timestamp
+    """
+    set_path = Path(set_path)
+    if set_path.is_dir():
+        return DataSet(set_path).index.max()
+
+    return pd.read_pickle(set_path).index.max()
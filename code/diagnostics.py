@@ -499,7 +499,7 @@ def get_multiple_model_metrics(models_to_compare, output_for_pareto_comp):
 
         # Read in predictions, targets, and validation masks for the current model
         pred_trainval = pd.read_pickle(dir_str.pred_trainval_path)
-        output_trainval = pd.read_pickle(dir_str.output_trainval_path)
+        output_trainval = utility.read_data_set(dir_str.data_dir, "output", "trainval")
         num_cv_folds = len(pred_trainval.columns.levels[1])
         val_masks_all_folds = cross_val.get_CV_masks(
             output_trainval.index, num_cv_folds, dir_str.shuffled_indices_path
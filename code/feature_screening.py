@@ -0,0 +1,244 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Screen the input features to avoid redundancy/noise when training the model. Each timeseries can be tagged as
+# mandatory or optional through an "Is Mandatory?" column of the timeseries attributes tab; untagged timeseries,
+# calendar terms and forecast errors are mandatory. Lag terms of optional timeseries, including those of their sub
+# time series, are ranked by how correlated they are with all the other input terms, and only the least correlated
+# ones are kept, up to the "Max Num Optional Features" main parameter. Screening is off if that parameter isn't set.
+# The correlations are accumulated over chunks of rows, so the lag and lead matrix is never built in full.
+
+import re
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from data_preprocessing_util import (
+    list_lag_and_lead_terms,
+    get_row_validity,
+    get_set_ranges,
+    build_lag_and_lead_matrix,
+)
+
+# Name of the screening results, saved alongside the sets
+SCREENING_FILENAME = "screened_features.csv"
+# Number of rows of the lag and lead matrix built at a time while accumulating the correlations
+DEFAULT_SCREENING_CHUNK_ROWS = 20000
+# Suffix of the sub time series created by match_frequency
+SUB_STEP_PATTERN = re.compile(r"_sub_step_\d+$")
+
+
+class OnlineCovariance(object):
+    """
+    Covariance of the columns of a matrix, accumulated over chunks of its rows. The statistics of each chunk are
+    merged into the running ones with the pairwise update of Chan et al., which is numerically stable.
+    """
+
+    def __init__(self, num_columns):
+        """
+        Args:
+            num_columns: int. Number of columns of the matrix
+        """
+        self.num_rows = 0
+        self.mean = np.zeros(num_columns)
+        self.sum_sq_dev = np.zeros((num_columns, num_columns))
+
+    def update(self, values):
+        """
+        Add a chunk of rows to the statistics
+        :param values: np.ndarray of (N, num_columns). Rows without any NaN
+        """
+        num_chunk_rows = values.shape[0]
+        if num_chunk_rows == 0:
+            return None
+
+        values = np.asarray(values, dtype="float64")
+        chunk_mean = values.mean(axis=0)
+        deviations = values - chunk_mean
+        chunk_sum_sq_dev = deviations.T @ deviations
+
+        total_rows = self.num_rows + num_chunk_rows
+        delta = chunk_mean - self.mean
+        self.sum_sq_dev += chunk_sum_sq_dev + np.outer(delta, delta) * (
+            self.num_rows * num_chunk_rows / total_rows
+        )
+        self.mean += delta * num_chunk_rows / total_rows
+        self.num_rows = total_rows
+
+    def get_covariance(self):
+        return self.sum_sq_dev / (self.num_rows - 1)
+
+    def get_correlation(self):
+        """
+        :return: corr_matrix: np.ndarray of (num_columns, num_columns). Constant columns are uncorrelated with the
+        others
+        """
+        std = np.sqrt(np.diag(self.sum_sq_dev))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            corr_matrix = self.sum_sq_dev / np.outer(std, std)
+        corr_matrix[~np.isfinite(corr_matrix)] = 0.0
+        np.fill_diagonal(corr_matrix, 1.0)
+
+        return corr_matrix
+
+
+def get_max_num_optional_features(configs):
+    """
+    :param configs: parse_excel_configs.ExcelConfigs. Configuration of the data preprocessing procedure
+    :return: max_num_optional_features: int, or None if the screening is off
+    """
+    max_num_optional_features = getattr(configs, "max_num_optional_features", None)
+    if max_num_optional_features is None or pd.isna(max_num_optional_features):
+        return None
+
+    return int(max_num_optional_features)
+
+
+def is_screening_enabled(configs):
+    return get_max_num_optional_features(configs) is not None
+
+
+def get_feature_tags(configs):
+    """
+    Whether each feature with lag terms is mandatory. Sub time series take the tag of their timeseries
+    :param configs: parse_excel_configs.ExcelConfigs. Configuration of the data preprocessing procedure
+    :return: is_mandatory: pd.Series of bool, indexed as the lag term configs
+    """
+    ts_attrs = configs.timeseries_attributes  # alias
+    if "Is Mandatory?" in ts_attrs.columns:
+        ts_is_mandatory = ts_attrs["Is Mandatory?"].fillna(True).astype(bool)
+    else:
+        ts_is_mandatory = pd.Series(True, index=ts_attrs.index)
+
+    features = configs.lag_term_configs.index
+    ts_names = [SUB_STEP_PATTERN.sub("", feature) for feature in features]
+    is_mandatory = ts_is_mandatory.reindex(ts_names).fillna(True).astype(bool)
+
+    return pd.Series(is_mandatory.to_numpy(), index=features)
+
+
+def compute_redundancy(
+    ts_data_df,
+    lag_term_configs,
+    lead_term_configs,
+    starts_and_ends,
+    chunk_rows=DEFAULT_SCREENING_CHUNK_ROWS,
+):
+    """
+    Redundancy of each input term, as the sum of its absolute correlations with all the other input terms over the
+    valid rows of the training and validation set. The lag terms are built chunk of rows by chunk of rows
+    :param ts_data_df: pd.DataFrame of (M,N). The feature data frame padded with NaNs, see pad_data_w_buffer
+    :param lag_term_configs: pd.DataFrame of (I,3). Configuration of lag terms for input features
+    :param lead_term_configs: pd.DataFrame of (O,3). Configuration of lead terms for model responses
+    :param starts_and_ends: pd.DataFrame. The start and end defined for the training, testing and inference sets
+    :param chunk_rows: int. Number of rows built at a time
+    :return: redundancy: pd.Series of float, indexed by the label of each input term
+    """
+    row_validity = get_row_validity(ts_data_df, lag_term_configs, lead_term_configs)
+    is_row_used = (
+        get_set_ranges(row_validity.index, starts_and_ends)["trainval"]
+        & row_validity["input"].to_numpy()
+        & row_validity["output"].to_numpy()
+    )
+    row_positions = ts_data_df.index.get_indexer(row_validity.index[is_row_used])
+    if len(row_positions) < 2:
+        raise ValueError("Not enough valid trainval samples to screen the features!")
+
+    no_lead_terms = lead_term_configs.iloc[:0]
+    stats = None
+    for chunk_start in range(0, len(row_positions), chunk_rows):
+        input_df, _ = build_lag_and_lead_matrix(
+            ts_data_df,
+            lag_term_configs,
+            no_lead_terms,
+            dtype="float64",
+            row_positions=row_positions[chunk_start : chunk_start + chunk_rows],
+        )
+        if stats is None:
+            labels = input_df.columns
+            stats = OnlineCovariance(len(labels))
+        stats.update(input_df.to_numpy())
+
+    abs_corr = np.abs(stats.get_correlation())
+
+    return pd.Series(abs_corr.sum(axis=1) - 1, index=labels)
+
+
+def screen_features(ts_data_df, configs):
+    """
+    Rank the lag terms of the optional features by redundancy, see compute_redundancy, and keep the least redundant
+    ones up to the maximum number of optional features
+    :param ts_data_df: pd.DataFrame of (M,N). The feature data frame padded with NaNs, see pad_data_w_buffer
+    :param configs: parse_excel_configs.ExcelConfigs. Configuration of the data preprocessing procedure
+    :return: screening_df: pd.DataFrame indexed by the label of each input term, holding its feature, whether it is
+    mandatory, its redundancy and whether it is kept
+    """
+    redundancy = compute_redundancy(
+        ts_data_df,
+        configs.lag_term_configs,
+        configs.lead_term_configs,
+        configs.starts_and_ends,
+        int(getattr(configs, "screening_chunk_rows", DEFAULT_SCREENING_CHUNK_ROWS)),
+    )
+    is_mandatory = get_feature_tags(configs)
+    features = list_lag_and_lead_terms(
+        configs.lag_term_configs, configs.lead_term_configs.iloc[:0]
+    ).loc[redundancy.index, "Feature"]
+
+    screening_df = pd.DataFrame(
+        {
+            "Feature": features,
+            "Is Mandatory?": is_mandatory.reindex(features).to_numpy(),
+            "Redundancy": redundancy.to_numpy(),
+        },
+        index=redundancy.index,
+    )
+    optional_redundancy = screening_df.loc[
+        ~screening_df["Is Mandatory?"], "Redundancy"
+    ].sort_values(kind="stable")
+    kept_optional = optional_redundancy.index[: get_max_num_optional_features(configs)]
+    screening_df["Is Kept?"] = screening_df["Is Mandatory?"] | screening_df.index.isin(
+        kept_optional
+    )
+
+    return screening_df
+
+
+def save_screening(screening_df, data_dir):
+    screening_path = Path(data_dir) / SCREENING_FILENAME
+    screening_df.to_csv(screening_path, index_label="Term")
+
+    return screening_path
+
+
+def read_dropped_terms(data_dir):
+    """
+    Terms screened out by the last screening saved in a directory
+    :param data_dir: pathlib.Path. Directory holding the sets, usually DirStructure.data_dir
+    :return: dropped_terms: pd.Index of str, or None if no screening was saved
+    """
+    screening_path = Path(data_dir) / SCREENING_FILENAME
+    if not screening_path.exists():
+        return None
+
+    screening_df = pd.read_csv(screening_path, index_col="Term")
+
+    return screening_df.index[~screening_df["Is Kept?"].astype(bool)]
@@ -0,0 +1,436 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Train the RESCUE networks of all the cross-validation folds at once. The weights of the F networks are stacked into
+# batched tensors, e.g. (F, num_inputs, num_neurons) for the first hidden layer, so that every mini-batch goes through
+# all the networks in a few batched matrix products. Each sample only contributes to the loss of the folds it is in
+# the training set of, see cross_val.get_fold_ids, and early stopping is tracked fold by fold: once a fold stops, its
+# weights are frozen while the other folds keep training. The networks are the same as those of
+# quantile_network.build_rescue_model, into which each fold can be exported.
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+import cross_val
+import quantile_network
+
+# Number of samples per batch when evaluating the validation losses and predicting
+DEFAULT_EVAL_BATCH_SIZE = 8192
+
+
+def get_glorot_uniform(rng, num_folds, fan_in, fan_out):
+    """
+    :return: np.array of (num_folds, fan_in, fan_out). Initial weights of a dense layer for each fold, drawn as by the
+    default initializer of tf.keras.layers.Dense
+    """
+    limit = np.sqrt(6 / (fan_in + fan_out))
+    return rng.uniform(-limit, limit, size=(num_folds, fan_in, fan_out)).astype(
+        "float32"
+    )
+
+
+class FoldStackedRescueModel(tf.Module):
+    """
+    The RESCUE networks of all the cross-validation folds, with their weights stacked along a first fold dimension
+    """
+
+    def __init__(
+        self,
+        num_folds,
+        num_inputs,
+        num_outputs,
+        taus,
+        norm_mean,
+        norm_variance,
+        num_neurons=quantile_network.DEFAULT_NUM_NEURONS,
+        activation_type=quantile_network.DEFAULT_ACTIVATION_TYPE,
+        non_crossing=False,
+        seed=None,
+    ):
+        """
+        Args:
+            num_folds: int. Number of cross-validation folds
+            num_inputs: int. Number of input features
+            num_outputs: int. Number of output variables
+            taus: array-like of float. The quantiles predicted jointly, see quantile_network.build_rescue_model. A
+            single quantile is predicted as a list of one
+            norm_mean: np.array of (num_inputs,) or (num_folds, num_inputs). Mean of each input feature, for all the
+            folds or for each fold
+            norm_variance: np.array of (num_inputs,) or (num_folds, num_inputs). Variance of each input feature
+            num_neurons: int. Number of neurons of each hidden layer
+            activation_type: str. Activation function of the hidden layers
+            non_crossing: bool. See quantile_network.build_rescue_model
+            seed: int or None. Seed of the initial weights
+        """
+        super().__init__(name="FoldStackedRescueModel")
+        self.num_folds = num_folds
+        self.num_inputs = num_inputs
+        self.num_outputs = num_outputs
+        self.taus = np.asarray(taus, dtype="float64")
+        self.num_neurons = num_neurons
+        self.activation_type = activation_type
+        self.non_crossing = non_crossing
+        if non_crossing and np.any(np.diff(self.taus) <= 0):
+            raise ValueError(
+                "Quantiles must be in increasing order to keep them from crossing!"
+            )
+
+        # Normalization statistics, broadcast to (num_folds, 1, num_inputs)
+        self.norm_mean = np.broadcast_to(norm_mean, (num_folds, num_inputs)).astype(
+            "float32"
+        )
+        self.norm_variance = np.broadcast_to(
+            norm_variance, (num_folds, num_inputs)
+        ).astype("float32")
+        # Same as in tf.keras.layers.experimental.preprocessing.Normalization
+        self.norm_std = np.maximum(
+            np.sqrt(self.norm_variance), tf.keras.backend.epsilon()
+        )[:, np.newaxis, :]
+
+        rng = np.random.default_rng(seed)
+        layer_sizes = [
+            num_inputs,
+            num_neurons,
+            num_neurons,
+            len(self.taus) * num_outputs,
+        ]
+        self.kernels = [
+            tf.Variable(
+                get_glorot_uniform(rng, num_folds, fan_in, fan_out),
+                name="kernel_{}".format(layer_idx),
+            )
+            for layer_idx, (fan_in, fan_out) in enumerate(
+                zip(layer_sizes[:-1], layer_sizes[1:])
+            )
+        ]
+        self.biases = [
+            tf.Variable(
+                np.zeros((num_folds, 1, fan_out), dtype="float32"),
+                name="bias_{}".format(layer_idx),
+            )
+            for layer_idx, fan_out in enumerate(layer_sizes[1:])
+        ]
+        self.activation = tf.keras.activations.get(activation_type)
+
+    def __call__(self, inputs):
+        """
+        :param inputs: tf.Tensor of (batch size, num_inputs). The same samples go through every fold
+        :return: y_pred: tf.Tensor of (num_folds, batch size, len(taus) * num_outputs)
+        """
+        hidden = (
+            tf.cast(inputs, tf.float32)[tf.newaxis, :, :] - self.norm_mean[:, None, :]
+        ) / self.norm_std
+        for layer_idx, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            hidden = tf.linalg.matmul(hidden, kernel) + bias
+            if layer_idx < len(self.kernels) - 1:
+                hidden = self.activation(hidden)
+
+        if self.non_crossing:
+            raw_quantiles = tf.reshape(
+                hidden,
+                (self.num_folds, tf.shape(hidden)[1], len(self.taus), self.num_outputs),
+            )
+            hidden = tf.reshape(
+                quantile_network.make_non_crossing(raw_quantiles),
+                tf.shape(hidden),
+            )
+
+        return hidden
+
+    def predict(self, input_df, fold_idx=None, batch_size=DEFAULT_EVAL_BATCH_SIZE):
+        """
+        :param input_df: pd.DataFrame of (N, num_inputs)
+        :param fold_idx: int or None. The fold whose network to predict with, by default all of them
+        :param batch_size: int. Number of samples predicted at a time
+        :return: pred_df: pd.DataFrame with (Quantiles, Fold ID, Output_Name) columns, as in rescue.ipynb. The output
+        names are those of the network's training outputs if known, otherwise their positions
+        """
+        pred = np.concatenate(
+            [
+                self(input_df.values[batch_start : batch_start + batch_size]).numpy()
+                for batch_start in range(0, len(input_df), batch_size)
+            ],
+            axis=1,
+        )
+        folds = range(self.num_folds) if fold_idx is None else [fold_idx]
+        output_names = getattr(self, "output_names", range(self.num_outputs))
+        # (fold, sample, quantile, output) to (sample, quantile, fold, output)
+        pred = pred[list(folds)].reshape(
+            len(folds), len(input_df), len(self.taus), self.num_outputs
+        )
+        pred = pred.transpose(1, 2, 0, 3).reshape(len(input_df), -1)
+
+        return pd.DataFrame(
+            pred,
+            index=input_df.index,
+            columns=pd.MultiIndex.from_product(
+                [self.taus, folds, output_names],
+                names=["Quantiles", "Fold ID", "Output_Name"],
+            ),
+        )
+
+    def to_keras_model(self, fold_idx, joint_quantiles=True):
+        """
+        Export the network of a fold into a stand-alone model, to be saved and deployed as any other RESCUE model
+        :param fold_idx: int. Index of the cross-validation fold
+        :param joint_quantiles: bool. Whether to export as a joint network, see quantile_network.build_rescue_model.
+        Only networks of a single quantile can be exported as single-quantile ones
+        :return: rescue_model: tf.keras.Model
+        """
+        if not joint_quantiles and len(self.taus) != 1:
+            raise ValueError(
+                "Only networks of a single quantile can be exported as such!"
+            )
+        rescue_model = quantile_network.build_rescue_model(
+            self.num_inputs,
+            self.num_outputs,
+            self.num_neurons,
+            self.activation_type,
+            taus=self.taus if joint_quantiles else None,
+            non_crossing=self.non_crossing and joint_quantiles,
+            norm_mean=self.norm_mean[fold_idx],
+            norm_variance=self.norm_variance[fold_idx],
+        )
+        dense_layers = [
+            layer
+            for layer in rescue_model.layers
+            if isinstance(layer, tf.keras.layers.Dense)
+        ]
+        for dense_layer, kernel, bias in zip(dense_layers, self.kernels, self.biases):
+            dense_layer.set_weights(
+                [kernel[fold_idx].numpy(), bias[fold_idx, 0].numpy()]
+            )
+
+        return rescue_model
+
+
+def get_fold_losses(model, inputs, outputs, fold_masks, loss_wts):
+    """
+    :param fold_masks: tf.Tensor of (num_folds, batch size) float. Which samples count towards the loss of each fold
+    :return: fold_loss_sums: tf.Tensor of (num_folds,). Sum of the losses of the samples of each fold
+    """
+    loss_for_each_sample = quantile_network.get_multi_quantile_loss_per_sample(
+        outputs[tf.newaxis, :, :], model(inputs), model.taus, loss_wts
+    )
+    return tf.math.reduce_sum(loss_for_each_sample * fold_masks, axis=1)
+
+
+def get_validation_losses(model, input_values, output_values, fold_ids, loss_wts):
+    """
+    :return: val_losses: np.array of (num_folds,). Average loss of each fold over its validation set
+    """
+    fold_range = np.arange(model.num_folds)[:, np.newaxis]
+    loss_sums = np.zeros(model.num_folds)
+    for batch_start in range(0, len(input_values), DEFAULT_EVAL_BATCH_SIZE):
+        batch = slice(batch_start, batch_start + DEFAULT_EVAL_BATCH_SIZE)
+        loss_sums += get_fold_losses(
+            model,
+            input_values[batch],
+            output_values[batch],
+            (fold_ids[np.newaxis, batch] == fold_range).astype("float32"),
+            loss_wts,
+        ).numpy()
+
+    return loss_sums / np.bincount(fold_ids, minlength=model.num_folds)
+
+
+def train_fold_stacked(
+    input_trainval,
+    output_trainval,
+    fold_ids,
+    num_cv_folds,
+    taus,
+    loss_wts,
+    num_neurons=quantile_network.DEFAULT_NUM_NEURONS,
+    activation_type=quantile_network.DEFAULT_ACTIVATION_TYPE,
+    non_crossing=False,
+    batch_size=64,
+    max_epochs=50,
+    optimizer_choice="adam",
+    early_stop_min_delta=0.0,
+    early_stop_patience=3,
+    norm_mean=None,
+    norm_variance=None,
+    seed=None,
+    verbose=1,
+):
+    """
+    Train the networks of all the cross-validation folds in one run. Every mini-batch is drawn from all the trainval
+    samples, each sample contributing to the loss of the folds it is in the training set of. The early stopping
+    follows tf.keras.callbacks.EarlyStopping on the validation loss, fold by fold.
+
+    Args:
+        input_trainval: pd.DataFrame of (N, num_inputs)
+        output_trainval: pd.DataFrame of (N, num_outputs)
+        fold_ids: np.array of N int8. The fold each sample is validated in, see cross_val.get_fold_ids
+        num_cv_folds: int. Number of cross-validation folds, each of which must have validation samples
+        taus: array-like of float. The quantiles predicted jointly, or a list of one for a single quantile
+        loss_wts: array-like of float. Relative importance of loss corresponding to each output
+        num_neurons: int. Number of neurons of each hidden layer
+        activation_type: str. Activation function of the hidden layers
+        non_crossing: bool. See quantile_network.build_rescue_model
+        batch_size: int. Size of each mini-batch
+        max_epochs: int. Maximum number of epochs in training
+        optimizer_choice: str. Optimizer, as understood by tf.keras.optimizers.get
+        early_stop_min_delta: float. Minimum decrease of the validation loss of a fold to count as an improvement, for
+        each quantile, see quantile_network.get_early_stop_min_delta
+        early_stop_patience: int. Number of epochs without improvement after which a fold stops
+        norm_mean: np.array of (num_inputs,) or (num_folds, num_inputs) or None. Normalization means, by default
+        those of the training samples of each fold, see cross_val.get_fold_norm_stats
+        norm_variance: np.array or None. Normalization variances, see norm_mean
+        seed: int or None. Seed of the initial weights and of the shuffling
+        verbose: int. 0 for no output, 1 for the losses of each epoch
+
+    Returns:
+        model: FoldStackedRescueModel
+        history: pd.DataFrame of the training and validation losses of each fold, indexed by epoch, with (loss or
+        val_loss, fold) columns. NaN once a fold has stopped
+    """
+    num_folds = num_cv_folds
+    cross_val.get_fold_sizes(fold_ids, num_folds)
+    input_values = input_trainval.values.astype("float32")
+    output_values = output_trainval.values.astype("float32")
+    if norm_mean is None or norm_variance is None:
+        fold_norm_stats = cross_val.get_fold_norm_stats(
+            input_values, fold_ids, num_folds
+        )
+        norm_mean = fold_norm_stats[0] if norm_mean is None else norm_mean
+        norm_variance = fold_norm_stats[1] if norm_variance is None else norm_variance
+
+    model = FoldStackedRescueModel(
+        num_folds,
+        input_values.shape[1],
+        output_values.shape[1],
+        taus,
+        norm_mean,
+        norm_variance,
+        num_neurons=num_neurons,
+        activation_type=activation_type,
+        non_crossing=non_crossing,
+        seed=seed,
+    )
+    model.output_names = output_trainval.columns.values
+    variables = model.kernels + model.biases
+    optimizer = tf.keras.optimizers.get(optimizer_choice)
+    # Folds still training, and the weights the stopped folds are frozen at
+    is_active = tf.Variable(tf.ones((num_folds, 1, 1)), trainable=False)
+    frozen_variables = [
+        tf.Variable(variable, trainable=False) for variable in variables
+    ]
+    fold_range = tf.constant(np.arange(num_folds, dtype="int8")[:, np.newaxis])
+
+    @tf.function
+    def train_step(inputs, outputs, batch_fold_ids):
+        train_masks = tf.cast(
+            tf.not_equal(batch_fold_ids[tf.newaxis, :], fold_range), tf.float32
+        )
+        num_train_samples = tf.math.reduce_sum(train_masks, axis=1)
+        with tf.GradientTape() as tape:
+            fold_loss_sums = get_fold_losses(
+                model, inputs, outputs, train_masks, loss_wts
+            )
+            # Average over the training samples of each fold. The folds don't share any weight, so summing their
+            # losses trains each of them on its own loss
+            fold_losses = fold_loss_sums / tf.math.maximum(num_train_samples, 1)
+            total_loss = tf.math.reduce_sum(fold_losses * tf.reshape(is_active, [-1]))
+        gradients = tape.gradient(total_loss, variables)
+        optimizer.apply_gradients(zip(gradients, variables))
+        # The momentum of the optimizer would still move the weights of the stopped folds
+        for variable, frozen_variable in zip(variables, frozen_variables):
+            variable.assign(
+                tf.where(tf.cast(is_active, tf.bool), variable, frozen_variable)
+            )
+        return fold_loss_sums, num_train_samples
+
+    # Using tf.data API to batch and shuffle the dataset, as in rescue.ipynb
+    train_ds = (
+        tf.data.Dataset.from_tensor_slices(
+            (input_values, output_values, fold_ids.astype("int8"))
+        )
+        .shuffle(buffer_size=len(input_values), seed=seed)
+        .batch(batch_size)
+    )
+
+    history = pd.DataFrame(
+        np.nan,
+        index=pd.RangeIndex(max_epochs, name="epoch"),
+        columns=pd.MultiIndex.from_product(
+            [["loss", "val_loss"], range(num_folds)], names=["metric", "fold"]
+        ),
+    )
+    best_val_losses = np.full(num_folds, np.inf)
+    # The validation loss sums the losses of the quantiles, so the minimum decrease is scaled by their number
+    early_stop_min_delta = quantile_network.get_early_stop_min_delta(
+        early_stop_min_delta, taus
+    )
+    num_waits = np.zeros(num_folds, dtype=int)
+    is_fold_active = np.ones(num_folds, dtype=bool)
+    for epoch in range(max_epochs):
+        epoch_loss_sums = np.zeros(num_folds)
+        epoch_num_samples = np.zeros(num_folds)
+        for inputs, outputs, batch_fold_ids in train_ds:
+            fold_loss_sums, num_train_samples = train_step(
+                inputs, outputs, batch_fold_ids
+            )
+            epoch_loss_sums += fold_loss_sums.numpy()
+            epoch_num_samples += num_train_samples.numpy()
+        val_losses = get_validation_losses(
+            model, input_values, output_values, fold_ids, loss_wts
+        )
+        active_folds = np.flatnonzero(is_fold_active)
+        history.loc[epoch, [("loss", fold) for fold in active_folds]] = (
+            epoch_loss_sums / np.maximum(epoch_num_samples, 1)
+        )[active_folds]
+        history.loc[epoch, [("val_loss", fold) for fold in active_folds]] = val_losses[
+            active_folds
+        ]
+
+        # Early stopping of each fold, as in tf.keras.callbacks.EarlyStopping
+        is_improved = val_losses < best_val_losses - early_stop_min_delta
+        best_val_losses[is_improved] = val_losses[is_improved]
+        num_waits = np.where(is_improved, 0, num_waits + 1)
+        is_stopping = is_fold_active & (num_waits >= early_stop_patience)
+        if verbose:
+            print(
+                "Epoch {}/{}: {} folds training, mean val_loss {:.4f}{}".format(
+                    epoch + 1,
+                    max_epochs,
+                    is_fold_active.sum(),
+                    val_losses[is_fold_active].mean(),
+                    (
+                        ", early stopping folds {}".format(np.flatnonzero(is_stopping))
+                        if is_stopping.any()
+                        else ""
+                    ),
+                )
+            )
+        if is_stopping.any():
+            is_fold_active &= ~is_stopping
+            for variable, frozen_variable in zip(variables, frozen_variables):
+                frozen_variable.assign(variable)
+            is_active.assign(
+                is_fold_active.astype("float32")[:, np.newaxis, np.newaxis]
+            )
+        if not is_fold_active.any():
+            break
+
+    return model, history.dropna(how="all")
@@ -0,0 +1,285 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Instrumentation of the data preprocessing. Each stage and each series read is timed and sized, and the records
+# are saved as a JSON run report in the diagnostics directory, to track down regressions as the configs grow.
+
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Version 2 replaced the peak RSS of each step by its change in current RSS, along with the peak RSS of the process
+REPORT_VERSION = 2
+REPORT_FILENAME = "preprocessing_report.json"
+# Columns of the human readable summary, in order
+SUMMARY_COLUMNS = [
+    "name",
+    "kind",
+    "status",
+    "wall_time_s",
+    "cpu_time_s",
+    "rss_delta_mb",
+    "process_peak_rss_mb",
+    "rows_in",
+    "rows_out",
+    "columns_out",
+]
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size of the process so far, in MB
+    :return: peak_rss_mb: float, or None if it cannot be measured on this platform
+    """
+    try:
+        import resource
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # reported in bytes on macOS and in KB on Linux
+        return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        # Only reported on Windows
+        return psutil.Process().memory_info().peak_wset / 2**20
+    except (ImportError, AttributeError):
+        return None
+
+
+def get_current_rss_mb():
+    """
+    Current resident set size of the process, in MB. Unlike the peak, it goes down as memory is released
+    :return: rss_mb: float, or None if it cannot be measured on this platform
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            # in pages, the second field being the resident set
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        return None
+
+
+def get_data_shape(data):
+    """
+    Number of rows and columns of the data passed between stages. Tuples, e.g. a data frame along with its metadata,
+    are described by the first data frame or array they hold
+    :param data: pd.DataFrame, pd.Series, np.ndarray, tuple, list, dict or None
+    :return: num_rows, num_columns: int or None
+    """
+    if isinstance(data, (tuple, list)):
+        for item in data:
+            num_rows, num_columns = get_data_shape(item)
+            if num_rows is not None:
+                return num_rows, num_columns
+    elif isinstance(data, pd.DataFrame):
+        return data.shape
+    elif isinstance(data, (pd.Series, np.ndarray)):
+        return data.shape[0], 1 if data.ndim == 1 else data.shape[1]
+
+    return None, None
+
+
+def record_data_in(record, *data):
+    """
+    Record the total number of rows of the data going into a step
+    :param record: dict. Record of the step, see RunReport.measure
+    :param data: data going into the step, see get_data_shape
+    """
+    rows_in = [get_data_shape(item)[0] for item in data]
+    rows_in = [num_rows for num_rows in rows_in if num_rows is not None]
+    record["rows_in"] = int(sum(rows_in)) if rows_in else None
+
+
+def record_data_out(record, data):
+    """
+    Record the number of rows and columns of the data coming out of a step
+    :param record: dict. Record of the step, see RunReport.measure
+    :param data: data coming out of the step, see get_data_shape
+    """
+    num_rows, num_columns = get_data_shape(data)
+    record["rows_out"] = None if num_rows is None else int(num_rows)
+    record["columns_out"] = None if num_columns is None else int(num_columns)
+
+
+def measure(report, name, kind="stage", per_thread=False):
+    """
+    Measure a step in a report if there is one, see RunReport.measure
+    :param report: RunReport or None
+    :return: context manager yielding the record of the step, a throwaway dict if report is None
+    """
+    if report is None:
+        return nullcontext({})
+
+    return report.measure(name, kind=kind, per_thread=per_thread)
+
+
+class RunReport(object):
+    """
+    Collects performance records of a run. Each record holds the wall time and CPU time of a step, and how much the
+    current RSS of the process grew over the step, along with the number of rows going in and out of it and the
+    number of columns of its output. The peak RSS of the whole process so far is recorded as well, as
+    process_peak_rss_mb: it never goes down, so it only tells which step first reached the peak. Records can be
+    added from several threads at once, in which case the RSS change includes the memory of the other threads.
+    """
+
+    def __init__(self, run_name):
+        """
+        Args:
+            run_name: str. Name of the run, e.g. the model name
+        """
+        self.run_name = run_name
+        self.started_at = pd.Timestamp.now().isoformat()
+        self.start_time = time.perf_counter()
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name, kind="stage", per_thread=False):
+        """
+        Measure a step. The yielded record can be filled in with the size of the data, see record_data_in and
+        record_data_out, or any other entry. It is added to the report even if the step fails
+        :param name: str. Name of the step
+        :param kind: str. Kind of the step, e.g. "stage", "series" or "chunk"
+        :param per_thread: bool. If True, the CPU time is measured for the current thread only, e.g. for steps run
+        concurrently in a thread pool. Otherwise for the whole process
+        :return: record: dict
+        """
+        cpu_clock = time.thread_time if per_thread else time.process_time
+        record = {
+            "name": name,
+            "kind": kind,
+            "status": "run",
+            "rows_in": None,
+            "rows_out": None,
+            "columns_out": None,
+        }
+        wall_start, cpu_start = time.perf_counter(), cpu_clock()
+        rss_start = get_current_rss_mb()
+        try:
+            yield record
+        except BaseException:
+            record["status"] = "failed"
+            raise
+        finally:
+            record["wall_time_s"] = time.perf_counter() - wall_start
+            record["cpu_time_s"] = cpu_clock() - cpu_start
+            rss_end = get_current_rss_mb()
+            record["rss_delta_mb"] = (
+                None if rss_start is None or rss_end is None else rss_end - rss_start
+            )
+            record["process_peak_rss_mb"] = get_peak_rss_mb()
+            self.add_record(record)
+
+    def add_record(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def add_skipped(self, name, kind="stage", status="up to date"):
+        """
+        Record a step that was not run, e.g. a stage whose output is taken from the cache
+        """
+        self.add_record(
+            {
+                "name": name,
+                "kind": kind,
+                "status": status,
+                "wall_time_s": 0.0,
+                "cpu_time_s": 0.0,
+                "rss_delta_mb": 0.0,
+                "process_peak_rss_mb": get_peak_rss_mb(),
+                "rows_in": None,
+                "rows_out": None,
+                "columns_out": None,
+            }
+        )
+
+    def to_dict(self):
+        return {
+            "report_version": REPORT_VERSION,
+            "run_name": self.run_name,
+            "started_at": self.started_at,
+            "total_wall_time_s": time.perf_counter() - self.start_time,
+            "process_peak_rss_mb": get_peak_rss_mb(),
+            "python_version": platform.python_version(),
+            "pandas_version": pd.__version__,
+            "numpy_version": np.__version__,
+            "cpu_count": os.cpu_count(),
+            "records": self.records,
+        }
+
+    def save(self, report_dir, filename=REPORT_FILENAME):
+        """
+        Save the report as JSON
+        :param report_dir: pathlib.Path. Usually DirStructure.diag_dir
+        :param filename: str. Name of the report file
+        :return: report_path: pathlib.Path
+        """
+        report_path = Path(report_dir) / filename
+        Path.mkdir(report_path.parent, parents=True, exist_ok=True)
+        # write to a temporary file first so that a crash never leaves a partial report behind
+        tmp_path = report_path.with_suffix(".tmp{}".format(os.getpid()))
+        with open(tmp_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp_path, report_path)
+
+        return report_path
+
+    def summarize(self):
+        """
+        :return: summary_df: pd.DataFrame of the records, one row per step, in the order they finished
+        """
+        summary_df = pd.DataFrame(self.records, columns=SUMMARY_COLUMNS)
+        count_columns = ["rows_in", "rows_out", "columns_out"]
+        summary_df[count_columns] = summary_df[count_columns].astype("Int64")
+        return summary_df
+
+    def print_summary(self):
+        summary_df = self.summarize()
+        float_columns = [
+            "wall_time_s",
+            "cpu_time_s",
+            "rss_delta_mb",
+            "process_peak_rss_mb",
+        ]
+        summary_df[float_columns] = summary_df[float_columns].applymap(
+            lambda value: "" if pd.isna(value) else "{:.3f}".format(value)
+        )
+        print(summary_df.astype(object).fillna("").to_string(index=False))
+        print(
+            "Total wall time {:.3f}s, peak RSS {:.1f} MB".format(
+                time.perf_counter() - self.start_time, get_peak_rss_mb() or np.nan
+            )
+        )
@@ -370,8 +370,8 @@ if __name__ == "__main__":
     num_cv_folds = 10
 
     dir_str = utility.DirStructure(model_name=model_name)
-    input_trainval = pd.read_pickle(dir_str.input_trainval_path)
-    output_trainval = pd.read_pickle(dir_str.output_trainval_path)
+    input_trainval = utility.read_data_set(dir_str.data_dir, "input", "trainval")
+    output_trainval = utility.read_data_set(dir_str.data_dir, "output", "trainval")
     val_masks_all_folds = cross_val.get_CV_masks(
         input_trainval.index, num_cv_folds, dir_str.shuffled_indices_path
     )
@@ -1,5 +1,12 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+import openpyxl
 import pandas as pd
-import xlwings as xw
+
+# Bump whenever the way sheets are read in changes, so old snapshots are never reused
+SNAPSHOT_VERSION = 1
 
 
 class ExcelConfigs(object):
@@ -44,17 +51,15 @@ class ExcelConfigs(object):
         1. Every tab will be transformed into a pd DataFrame spanning cell "A1" to the the first empty row/column
         2. The data frame will become an attribute of the object, and will have a name based on the tab. All lower cases with spaces substituted with _
         3. The initializer will attempt to find a tab called "Main Params", any parameters defined in this tab will be exposed and expanded into an attribute.
+        The workbook is read without Excel. Parsed tabs are saved into a snapshot next to the workbook, which is reused
+        as long as the workbook is unchanged.
         Args:
             input_excel_path: pathlib.Path defining the path to the input excel file
         """
 
-        # Connect to the reclaim input workbook
-        reclaim_input_wb = xw.Book(input_excel_path)
-
         # Loop thru each of the tabs and read them all in as different pd Dataframe
-        for sheet in reclaim_input_wb.sheets:
-            df = sheet.range("A1").options(pd.DataFrame, expand="table").value
-            attr_name = sheet.name.lower().replace(" ", "_")
+        for sheet_name, df in self.read_workbook(Path(input_excel_path)).items():
+            attr_name = sheet_name.lower().replace(" ", "_")
             self.__setattr__(attr_name, df)
 
         # Find the main params
@@ -77,3 +82,79 @@ class ExcelConfigs(object):
 
         # parse the data set's names into short hands:
         self.starts_and_ends.rename(index=self.set_names_to_shorthand, inplace=True)
+
+    @staticmethod
+    def read_workbook(input_excel_path):
+        """
+        Read every tab of the workbook into a pd DataFrame, going through the compiled snapshot when it is up to date
+        :param input_excel_path: pathlib.Path defining the path to the input excel file
+        :return: sheets: dict(str: pd.DataFrame). Tab name as key and the content of the tab as value
+        """
+        workbook_hash = hashlib.sha1(input_excel_path.read_bytes()).hexdigest()
+        snapshot_path = input_excel_path.with_name(
+            input_excel_path.stem + "_compiled.pkl"
+        )
+
+        if snapshot_path.exists():
+            try:
+                with open(snapshot_path, "rb") as f:
+                    snapshot = pickle.load(f)
+                if snapshot["key"] == (SNAPSHOT_VERSION, workbook_hash):
+                    return snapshot["sheets"]
+            except Exception as e:
+                # e.g. left truncated by a crash before the snapshots were written atomically, rebuilt below
+                print("Ignoring unreadable {}: {!r}".format(snapshot_path.name, e))
+
+        # Only the cached values are read in, so formulas show up as last calculated by Excel
+        workbook = openpyxl.load_workbook(
+            input_excel_path, read_only=True, data_only=True
+        )
+        sheets = {
+            worksheet.title: read_table_from_A1(worksheet)
+            for worksheet in workbook.worksheets
+        }
+        workbook.close()
+
+        # write to a temporary file first, so that a crash or a concurrent reader never sees a partial snapshot
+        tmp_path = snapshot_path.with_suffix(".tmp{}".format(os.getpid()))
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"key": (SNAPSHOT_VERSION, workbook_hash), "sheets": sheets}, f)
+        os.replace(tmp_path, snapshot_path)
+
+        return sheets
+
+
+def read_table_from_A1(worksheet):
+    """
+    Read the table spanning cell "A1" to the first empty row/column into a pd DataFrame. The first row is used as
+    header and the first column as index. Same as xlwings' range("A1").options(pd.DataFrame, expand="table"), which
+    means all numbers are read in as floats.
+    :param worksheet: openpyxl worksheet to read from
+    :return: df: pd.DataFrame holding the table
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    header = list(next(rows, []))
+    num_cols = header.index(None) if None in header else len(header)
+    header = header[:num_cols]
+
+    data = []
+    for row in rows:
+        row = (list(row) + [None] * num_cols)[:num_cols]
+        if row[0] is None:
+            break
+        data.append(
+            [
+                (
+                    float(value)
+                    if isinstance(value, int) and not isinstance(value, bool)
+                    else value
+                )
+                for value in row
+            ]
+        )
+
+    df = pd.DataFrame(data, columns=header)
+    if num_cols > 0:
+        df = df.set_index(header[0])
+
+    return df
@@ -0,0 +1,363 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# A small engine to run a sequence of stages as a DAG, memoizing the output of each stage on disk.
+# Each stage is fingerprinted by the fingerprints of its upstream stages, the config values it reads and the files it
+# reads in, so that after a config change only the stages affected by it are rerun.
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from instrumentation import measure, record_data_in, record_data_out
+
+# Bump whenever the stored records change, so old records are never reused
+PIPELINE_VERSION = 1
+
+
+class Stage(object):
+    """
+    A step of a pipeline. Stages may update the configs, e.g. to register the features they create. As the updates are
+    needed by the downstream stages whether the stage is rerun or not, they are split out of the stage function into
+    an update function that always runs, fed with a small, cached "meta" output of the stage.
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        upstream=(),
+        get_params=None,
+        update_configs=None,
+        get_input_files=None,
+        get_output_files=None,
+        persist=True,
+        description=None,
+    ):
+        """
+        Args:
+            name: str. Unique name of the stage
+            func: callable(configs, dir_str, *upstream outputs) returning (output, meta). output is passed on to the
+                downstream stages, while meta is passed on to update_configs
+            upstream: list of str. Names of the stages whose outputs are passed to func, in order
+            get_params: callable(configs) or None. Returns the config values the output of the stage depends on
+            update_configs: callable(configs, meta) or None. Updates the configs in place, run whether the stage is
+                rerun or its output is taken from the cache
+            get_input_files: callable(configs, dir_str) or None. Returns the paths of the files read in by the stage,
+                fingerprinted by their size and modification time
+            get_output_files: callable(configs, dir_str) or None. Returns the paths of the files written by the stage.
+                The stage is rerun if any of them is deleted or modified outside of it
+            persist: bool. Whether the output of the stage is saved in the cache. Cheap stages with large outputs are
+                better not persisted, they are rerun whenever a downstream stage needs their output
+            description: str or None. Printed when the stage runs
+        """
+        self.name = name
+        self.func = func
+        self.upstream = list(upstream)
+        self.get_params = get_params
+        self.update_configs = update_configs
+        self.get_input_files = get_input_files
+        self.get_output_files = get_output_files
+        self.persist = persist
+        self.description = description or name
+
+
+class Pipeline(object):
+    """
+    Runs stages in order, rerunning only the stale ones. A stage is stale if its fingerprint differs from the one
+    recorded the last time it ran, or if the files it wrote have changed since then.
+    """
+
+    def __init__(self, stages, configs, dir_str, cache_dir, report=None):
+        """
+        Args:
+            stages: list of Stage, in an order where every stage comes after its upstream stages
+            configs: parse_excel_configs.ExcelConfigs. Configuration of the model, updated in place by the stages
+            dir_str: utility.DirStructure. Directory structure of the model
+            cache_dir: pathlib.Path. Directory of the cached stage records and outputs
+            report: instrumentation.RunReport or None. If provided, every stage run or taken from the cache is
+                recorded in it
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.configs = configs
+        self.dir_str = dir_str
+        self.cache_dir = Path(cache_dir)
+        self.report = report
+        Path.mkdir(self.cache_dir, parents=True, exist_ok=True)
+
+        self.fingerprints = {}  # fingerprint of each stage visited so far
+        self.reasons = (
+            {}
+        )  # reason to run each stage visited so far, None if it was up to date
+        self.outputs = {}  # outputs of the stages held in memory
+        self.is_dry_run = False
+
+        stage_names = []
+        for stage in stages:
+            for upstream_name in stage.upstream:
+                if upstream_name not in stage_names:
+                    raise ValueError(
+                        "Upstream stage {} must come before {}!".format(
+                            upstream_name, stage.name
+                        )
+                    )
+            stage_names.append(stage.name)
+
+    def get_record_path(self, stage_name):
+        return self.cache_dir / "{}.json".format(stage_name)
+
+    def get_meta_path(self, stage_name):
+        return self.cache_dir / "{}_meta.pkl".format(stage_name)
+
+    def get_output_path(self, stage_name):
+        return self.cache_dir / "{}_output.pkl".format(stage_name)
+
+    def get_fingerprint(self, stage):
+        """
+        Fingerprint a stage by its upstream stages, the config values it depends on and the files it reads in
+        :param stage: Stage
+        :return: fingerprint: str. Hex digest
+        """
+        fingerprint = hashlib.sha1()
+        fingerprint.update(
+            "{}\0{}\0".format(PIPELINE_VERSION, stage.name).encode("utf-8")
+        )
+        for upstream_name in stage.upstream:
+            fingerprint.update(self.fingerprints[upstream_name].encode("utf-8"))
+        if stage.get_params is not None:
+            update_hash(fingerprint, stage.get_params(self.configs))
+        if stage.get_input_files is not None:
+            update_hash(
+                fingerprint,
+                get_file_signature(stage.get_input_files(self.configs, self.dir_str)),
+            )
+
+        return fingerprint.hexdigest()
+
+    def get_output_signature(self, stage):
+        if stage.get_output_files is None:
+            return None
+        return get_file_signature(stage.get_output_files(self.configs, self.dir_str))
+
+    def load_record(self, stage_name):
+        record_path = self.get_record_path(stage_name)
+        if not record_path.exists():
+            return None
+        with open(record_path) as f:
+            return json.load(f)
+
+    def check_stage(self, stage):
+        """
+        Check whether a stage needs to be rerun, assuming the configs have been updated by all the stages before it
+        :param stage: Stage
+        :return: reason: str, or None if the cached results of the stage are up to date
+        """
+        record = self.load_record(stage.name)
+        if record is None or not self.get_meta_path(stage.name).exists():
+            return "never run"
+        if record["fingerprint"] != self.fingerprints[stage.name]:
+            return "inputs changed"
+        if stage.persist and not self.get_output_path(stage.name).exists():
+            return "output missing"
+        # Let json turn the signature into lists, as the recorded one
+        output_signature = json.loads(json.dumps(self.get_output_signature(stage)))
+        if record["output_signature"] != output_signature:
+            return "output files changed"
+
+        return None
+
+    def run_stage(self, stage):
+        """
+        Run a stage, loading or running its upstream stages as needed
+        :param stage: Stage
+        :return: output, meta: outputs of the stage function
+        """
+        upstream_outputs = [
+            self.get_output(upstream_name) for upstream_name in stage.upstream
+        ]
+        print("=== {} ===".format(stage.description))
+        with measure(self.report, stage.name) as record:
+            record_data_in(record, *upstream_outputs)
+            output, meta = stage.func(self.configs, self.dir_str, *upstream_outputs)
+            record_data_out(record, output)
+        self.outputs[stage.name] = output
+
+        return output, meta
+
+    def save_results(self, stage, output, meta):
+        pd.to_pickle(meta, self.get_meta_path(stage.name))
+        if stage.persist:
+            pd.to_pickle(output, self.get_output_path(stage.name))
+        else:
+            remove_file(self.get_output_path(stage.name))
+
+    def save_record(self, stage):
+        record = {
+            "fingerprint": self.fingerprints[stage.name],
+            "output_signature": self.get_output_signature(stage),
+        }
+        tmp_path = self.get_record_path(stage.name).with_suffix(
+            ".tmp{}".format(os.getpid())
+        )
+        with open(tmp_path, "w") as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp_path, self.get_record_path(stage.name))
+
+    def get_output(self, stage_name):
+        """
+        Output of an up-to-date stage, from memory, from the cache if persisted, or otherwise by rerunning it
+        """
+        if stage_name not in self.outputs:
+            stage = self.stages[stage_name]
+            if stage.persist:
+                self.outputs[stage_name] = pd.read_pickle(
+                    self.get_output_path(stage_name)
+                )
+            else:
+                # The stage is up to date, so rerunning it gives the same results as cached
+                self.run_stage(stage)
+
+        return self.outputs[stage_name]
+
+    def run(self, target, dry_run=False):
+        """
+        Bring a stage and all its upstream stages up to date
+        :param target: str. Name of the stage
+        :param dry_run: bool. If True, only report which stages are stale without running anything
+        :return: output of the target stage, or the staleness report if dry_run, as a pd.Series indexed by stage
+        name with the reason why each stage needs to run, or None if it is up to date. Stages visited by an earlier
+        call are not checked again
+        """
+        if self.is_dry_run and not dry_run:
+            raise ValueError(
+                "The configs have been updated by a dry run, start a new pipeline to run it!"
+            )
+        self.is_dry_run = dry_run
+        stage_names = list(self.stages)
+        stage_names = stage_names[: stage_names.index(target) + 1]
+
+        report = {}
+        for stage_name in stage_names:
+            stage = self.stages[stage_name]
+            if stage_name in self.reasons:
+                # Visited by an earlier call, with its config updates already applied
+                report[stage_name] = self.reasons[stage_name]
+                continue
+            self.fingerprints[stage_name] = self.get_fingerprint(stage)
+            stale_upstream = [
+                upstream_name
+                for upstream_name in stage.upstream
+                if report[upstream_name] is not None
+            ]
+            reason = self.check_stage(stage)
+            if dry_run and (reason is None) and stale_upstream:
+                # The upstream stages may update the configs differently once rerun
+                reason = "upstream stale"
+            report[stage_name] = reason
+
+            if reason is None:
+                print("=== {}: up to date ===".format(stage.description))
+                if (self.report is not None) and not dry_run:
+                    self.report.add_skipped(stage_name)
+                meta = pd.read_pickle(self.get_meta_path(stage_name))
+            elif dry_run:
+                if not self.get_meta_path(stage_name).exists():
+                    # The configs updates of this stage are unknown until it runs, so the rest of the stages are
+                    # stale as far as the dry run can tell
+                    report.update(
+                        {name: "upstream stale" for name in stage_names[len(report) :]}
+                    )
+                    break
+                meta = pd.read_pickle(self.get_meta_path(stage_name))
+            else:
+                # Remove the old record first, so that a crash never leaves a record pointing to a stale output
+                remove_file(self.get_record_path(stage_name))
+                output, meta = self.run_stage(stage)
+                self.save_results(stage, output, meta)
+            if stage.update_configs is not None:
+                stage.update_configs(self.configs, meta)
+            if (reason is not None) and not dry_run:
+                # Saved once the configs are updated, so the output files of the stage are seen in the same state as
+                # when checking the stage next time
+                self.save_record(stage)
+            self.reasons[stage_name] = reason
+
+        if dry_run:
+            return pd.Series(report, name="Reason to Run", dtype=object)
+
+        return self.get_output(target)
+
+
+def update_hash(hash_obj, value):
+    """
+    Feed a value into a hash, recursing into containers. Data frames and series are hashed by their labels, dtypes and
+    values, so that the fingerprint doesn't depend on how they are pickled
+    :param hash_obj: hashlib hash object
+    :param value: the value to hash
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        hash_obj.update(b"pandas\0")
+        if isinstance(value, pd.DataFrame):
+            update_hash(hash_obj, [str(col) for col in value.columns])
+            update_hash(hash_obj, [str(dtype) for dtype in value.dtypes])
+        else:
+            update_hash(hash_obj, [value.name, str(value.dtype)])
+        update_hash(hash_obj, [str(idx) for idx in value.index])
+        hash_obj.update(pd.util.hash_pandas_object(value, index=False).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        hash_obj.update("ndarray\0{}\0{}\0".format(value.dtype, value.shape).encode())
+        hash_obj.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        hash_obj.update(b"dict\0")
+        for key in sorted(value, key=str):
+            update_hash(hash_obj, key)
+            update_hash(hash_obj, value[key])
+    elif isinstance(value, (list, tuple)):
+        hash_obj.update("list{}\0".format(len(value)).encode())
+        for item in value:
+            update_hash(hash_obj, item)
+    else:
+        hash_obj.update("{}\0{!r}\0".format(type(value).__name__, value).encode())
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_file_signature(paths):
+    """
+    :param paths: list of str or pathlib.Path
+    :return: signature: list of [path, size, modification time in ns], with None for the size and time of missing files
+    """
+    signature = []
+    for path in paths:
+        try:
+            path_stat = os.stat(path)
+            signature.append([str(path), path_stat.st_size, path_stat.st_mtime_ns])
+        except FileNotFoundError:
+            signature.append([str(path), None, None])
+
+    return signature
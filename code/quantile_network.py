@@ -0,0 +1,398 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# The RESCUE network, its pinball losses and its training metrics, as used in rescue.ipynb. The network either predicts
+# a single quantile, being trained once per quantile, or all the quantiles jointly with one output head per (quantile,
+# output variable). The outputs of a joint network are laid out quantile by quantile, in the order of the quantiles,
+# and output by output within each quantile, i.e. as the (Quantiles, Output_Name) columns of the predictions.
+
+import json
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+# Default structural parameters of the network
+DEFAULT_NUM_NEURONS = 10
+DEFAULT_ACTIVATION_TYPE = "relu"
+# Name of the directories holding the joint networks, in place of the tau_x directories of single-quantile networks
+JOINT_QUANTILES_DIRNAME = "tau_joint"
+
+
+def get_model_subdir(base_dir, fold_idx, tau=None):
+    """
+    Directory of the network of a quantile and a fold, under the models, checkpoints or logs directory
+    :param base_dir: pathlib.Path. E.g. DirStructure.models_dir
+    :param fold_idx: int. Index of the cross-validation fold
+    :param tau: float or None. Target quantile, or None for a network predicting all the quantiles jointly
+    :return: model_subdir: pathlib.Path
+    """
+    tau_dirname = JOINT_QUANTILES_DIRNAME if tau is None else "tau_{:.1%}".format(tau)
+
+    return Path(base_dir) / tau_dirname / "fold_#{}".format(fold_idx)
+
+
+def make_non_crossing(raw_quantiles):
+    """
+    Turns the raw outputs of the quantile heads into quantile predictions that never cross. The lowest quantile is
+    taken as is, and each of the next ones adds a non-negative increment to the previous one.
+    :param raw_quantiles: tf.Tensor of (..., number of quantiles, number of outputs), quantiles in increasing order
+    :return: quantiles: tf.Tensor of the same shape
+    """
+    base = raw_quantiles[..., :1, :]
+    increments = tf.math.cumsum(tf.math.softplus(raw_quantiles[..., 1:, :]), axis=-2)
+    return tf.concat([base, base + increments], axis=-2)
+
+
+@tf.keras.utils.register_keras_serializable(package="rescue")
+class NonCrossingQuantiles(tf.keras.layers.Layer):
+    """
+    See make_non_crossing. Input and output shape: (batch size, number of quantiles, number of outputs)
+    """
+
+    def call(self, inputs):
+        return make_non_crossing(inputs)
+
+
+def build_rescue_model(
+    num_inputs,
+    num_outputs,
+    num_neurons=DEFAULT_NUM_NEURONS,
+    activation_type=DEFAULT_ACTIVATION_TYPE,
+    taus=None,
+    non_crossing=False,
+    norm_mean=None,
+    norm_variance=None,
+):
+    """
+    A two layer ANN network for regression, with a pre-processing normalization layer. The state of the normalization
+    layer is either given, or to be set from the data before training, see rescue.ipynb
+    :param num_inputs: int. Number of input features
+    :param num_outputs: int. Number of output variables
+    :param num_neurons: int. Number of neurons of each hidden layer
+    :param activation_type: str. Activation function of the hidden layers
+    :param taus: array-like of float or None. If provided, the network predicts all these quantiles jointly, with
+    (len(taus) * num_outputs) outputs laid out quantile by quantile. Otherwise it predicts a single quantile
+    :param non_crossing: bool. If True, the jointly predicted quantiles are guaranteed not to cross, see
+    NonCrossingQuantiles. The taus must then be in increasing order
+    :param norm_mean: np.array of (num_inputs,) or None. Mean of each input feature in the normalization layer
+    :param norm_variance: np.array of (num_inputs,) or None. Variance of each input feature in the normalization layer
+    :return: rescue_model: tf.keras.Model
+    """
+    inputs = tf.keras.Input(shape=(num_inputs,))
+
+    # Create a Normalization layer, its internal state being set from the training data unless given
+    normalizer = tf.keras.layers.experimental.preprocessing.Normalization(
+        mean=norm_mean, variance=norm_variance, name="Normalization"
+    )
+    norm_inputs = normalizer(inputs)
+
+    # A two-layer ANN network for regression
+    hidden1 = tf.keras.layers.Dense(num_neurons, activation=activation_type)(
+        norm_inputs
+    )
+    hidden2 = tf.keras.layers.Dense(num_neurons, activation=activation_type)(hidden1)
+    if taus is None:
+        outputs = tf.keras.layers.Dense(num_outputs)(hidden2)
+        return tf.keras.Model(inputs, outputs)
+
+    # One output head per (quantile, output variable)
+    num_taus = len(taus)
+    outputs = tf.keras.layers.Dense(num_taus * num_outputs)(hidden2)
+    if non_crossing:
+        if np.any(np.diff(taus) <= 0):
+            raise ValueError(
+                "Quantiles must be in increasing order to keep them from crossing!"
+            )
+        outputs = tf.keras.layers.Reshape((num_taus, num_outputs))(outputs)
+        outputs = NonCrossingQuantiles(name="NonCrossingQuantiles")(outputs)
+        outputs = tf.keras.layers.Reshape((num_taus * num_outputs,))(outputs)
+
+    return tf.keras.Model(inputs, outputs)
+
+
+class PinballLoss(tf.keras.losses.Loss):
+    def __init__(self, tau=0.5, loss_wts=[1], name="pinball_loss", **kwargs):
+        super().__init__(name=name)
+        self.tau = tau  # the target quantile
+        # Relative importance of loss corresponding to each output
+        self.loss_wts = loss_wts
+
+    def call(self, y_true, y_pred):
+        err = y_true - y_pred  # the convention is always true - pred
+        # essentially, quantile regression takes two region. For values bigger than the quantile forecast,
+        # they are weighted by 1-tau, while for values smaller than the forecast it's weighted by tau.
+        loss_for_each_output_var_of_each_sample = tf.math.maximum(
+            self.tau * err, (self.tau - 1) * err
+        )
+        # Get weighted avg loss for each sample
+        loss_for_each_sample = tf.math.reduce_mean(
+            tf.math.multiply(loss_for_each_output_var_of_each_sample, self.loss_wts),
+            axis=1,
+        )
+        # Now get a single loss across all samples that make up the batch
+        skewed_mse = tf.math.reduce_mean(loss_for_each_sample, axis=0)
+
+        return skewed_mse
+
+
+def get_multi_quantile_loss_per_sample(y_true, y_pred, taus, loss_wts):
+    """
+    Pinball loss of all the quantiles predicted jointly, for each sample. The loss of each quantile is that of
+    PinballLoss, and the losses of the quantiles are summed
+    :param y_true: tf.Tensor of (..., batch size, number of outputs)
+    :param y_pred: tf.Tensor of (..., batch size, number of quantiles * number of outputs), laid out quantile by
+    quantile, see build_rescue_model
+    :param taus: np.array of float. The target quantiles
+    :param loss_wts: array-like of float. Relative importance of loss corresponding to each output
+    :return: loss_for_each_sample: tf.Tensor of (..., batch size)
+    """
+    # the target quantiles, shaped to broadcast against (..., batch size, number of quantiles, number of outputs)
+    taus = np.reshape(np.asarray(taus, dtype="float32"), (-1, 1))
+    y_pred = tf.reshape(
+        y_pred, tf.concat([tf.shape(y_pred)[:-1], [taus.shape[0], -1]], axis=0)
+    )
+    # the same true values for every quantile
+    err = tf.expand_dims(tf.cast(y_true, y_pred.dtype), axis=-2) - y_pred
+    loss_for_each_output_var_of_each_sample = tf.math.maximum(
+        taus * err, (taus - 1) * err
+    )
+    # Get weighted avg loss over the outputs for each sample and quantile, then sum over the quantiles
+    return tf.math.reduce_sum(
+        tf.math.reduce_mean(
+            tf.math.multiply(loss_for_each_output_var_of_each_sample, loss_wts),
+            axis=-1,
+        ),
+        axis=-1,
+    )
+
+
+class MultiQuantilePinballLoss(tf.keras.losses.Loss):
+    """
+    Pinball loss of all the quantiles predicted jointly, computed in one pass. The loss of each quantile is that of
+    PinballLoss, and the losses of the quantiles are summed, so that each quantile head is trained as if on its own
+    """
+
+    def __init__(
+        self, taus, loss_wts=[1], name="multi_quantile_pinball_loss", **kwargs
+    ):
+        super().__init__(name=name)
+        self.taus = taus  # the target quantiles
+        # Relative importance of loss corresponding to each output
+        self.loss_wts = loss_wts
+
+    def call(self, y_true, y_pred):
+        loss_for_each_sample = get_multi_quantile_loss_per_sample(
+            y_true, y_pred, self.taus, self.loss_wts
+        )
+
+        return tf.math.reduce_mean(loss_for_each_sample, axis=0)
+
+
+def get_early_stop_min_delta(min_delta, taus=None):
+    """
+    The loss of a joint network is the sum of the losses of its quantiles, see MultiQuantilePinballLoss, so the
+    minimum decrease of the loss for the early stopping is scaled by the number of quantiles, to stop the training as
+    a network of each quantile on its own would
+    :param min_delta: float. Minimum decrease of the loss of a single quantile
+    :param taus: array-like of float or None. The quantiles of a joint network, None for a single quantile
+    :return: min_delta: float
+    """
+    return min_delta if taus is None else min_delta * len(taus)
+
+
+def select_quantile(y_pred, tau_idx, num_taus):
+    """
+    :return: the predictions of the tau_idx-th quantile out of the outputs of a joint network, see build_rescue_model
+    """
+    return tf.reshape(y_pred, (tf.shape(y_pred)[0], num_taus, -1))[:, tau_idx, :]
+
+
+class CoverageProbability(tf.keras.metrics.Metric):
+    def __init__(self, name="CP", tau_idx=None, num_taus=1, **kwargs):
+        super(CoverageProbability, self).__init__(name=name, **kwargs)
+        # For joint networks, the quantile whose coverage is measured
+        self.tau_idx = tau_idx
+        self.num_taus = num_taus
+        self.coverage_probability = self.add_weight(
+            name="CP", initializer="zeros", dtype=tf.float64
+        )
+        # the cumulative number of samples and the number of samples smaller than current quantile forecast
+        self.cum_n_samples = self.add_weight(
+            name="n_samples", initializer="zeros", dtype=tf.int32
+        )
+        self.cum_n_covered = self.add_weight(
+            name="n_covered", initializer="zeros", dtype=tf.int32
+        )
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        if self.tau_idx is not None:
+            y_pred = select_quantile(y_pred, self.tau_idx, self.num_taus)
+        # the state would be updated everytime we have a new calculation
+        self.cum_n_samples.assign_add(tf.size(y_pred, out_type=tf.int32))
+        self.cum_n_covered.assign_add(
+            tf.math.count_nonzero(tf.math.less_equal(y_true, y_pred), dtype=tf.int32)
+        )
+        # cp = n_covered/n_samples
+        self.coverage_probability.assign(
+            tf.math.divide(self.cum_n_covered, self.cum_n_samples)
+        )
+
+    def result(self):
+        return self.coverage_probability
+
+    def reset_state(self):
+        # The state of the metric will be reset at the start of each epoch.
+        self.coverage_probability.assign(0.0)
+
+
+class AverageIntervalWidth(tf.keras.metrics.Metric):
+    def __init__(self, name="AIW", tau_idx=None, num_taus=1, **kwargs):
+        super(AverageIntervalWidth, self).__init__(name=name, **kwargs)
+        # For joint networks, the quantile whose width is measured
+        self.tau_idx = tau_idx
+        self.num_taus = num_taus
+        self.average_interval_width = self.add_weight(
+            name="AIW", initializer="zeros", dtype=tf.float32
+        )
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        if self.tau_idx is not None:
+            y_pred = select_quantile(y_pred, self.tau_idx, self.num_taus)
+        # the state would be updated everytime we have a new calculation
+        self.average_interval_width.assign(tf.math.reduce_mean(y_pred))
+
+    def result(self):
+        return self.average_interval_width
+
+    def reset_state(self):
+        # The state of the metric will be reset at the start of each epoch.
+        self.average_interval_width.assign(0.0)
+
+
+def get_training_metrics(taus=None):
+    """
+    :param taus: array-like of float or None. The quantiles of a joint network, or None for a single-quantile one
+    :return: metrics: list of tf.keras.metrics.Metric. Coverage probability and average interval width, of each
+    quantile for joint networks
+    """
+    if taus is None:
+        return [CoverageProbability(), AverageIntervalWidth()]
+
+    return [
+        metric_class(
+            name="{}_{:.1%}".format(short_name, tau),
+            tau_idx=tau_idx,
+            num_taus=len(taus),
+        )
+        for tau_idx, tau in enumerate(taus)
+        for metric_class, short_name in [
+            (CoverageProbability, "CP"),
+            (AverageIntervalWidth, "AIW"),
+        ]
+    ]
+
+
+class ResumableEarlyStopping(tf.keras.callbacks.EarlyStopping):
+    """
+    tf.keras.callbacks.EarlyStopping whose state survives an interruption. tf.keras.callbacks.BackupAndRestore
+    restores the weights and the epoch only, so the patience would start over on resuming. The wait and best of each
+    epoch are saved next to the backup, and restored when the training resumes right after that epoch. They are
+    deleted, along with the backup, once the training finishes. The best value of the monitored quantity over all the
+    epochs, including those before any interruption, is kept in best_value.
+    """
+
+    def __init__(self, state_path, **kwargs):
+        """
+        Args:
+            state_path: pathlib.Path. JSON file to save the state in, e.g. in the backup directory
+            kwargs: see tf.keras.callbacks.EarlyStopping
+        """
+        super().__init__(**kwargs)
+        self.state_path = Path(state_path)
+        self.is_resuming = False
+        self.best_value = None
+
+    def on_train_begin(self, logs=None):
+        super().on_train_begin(logs)
+        self.is_resuming = self.state_path.exists()
+        # Unlike best, not held back by min_delta
+        self.best_value = self.best
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if not self.is_resuming:
+            return
+        self.is_resuming = False
+        with open(self.state_path) as f:
+            state = json.load(f)
+        # Only if the backup was taken at the same epoch, otherwise the patience starts over
+        if state["epoch"] == epoch - 1:
+            self.wait = state["wait"]
+            self.best = state["best"]
+            self.best_epoch = state["best_epoch"]
+            # Saved before the best value was kept, best is the closest to it
+            self.best_value = state.get("best_value", self.best)
+
+    def on_epoch_end(self, epoch, logs=None):
+        super().on_epoch_end(epoch, logs)
+        current = (logs or {}).get(self.monitor)
+        if current is not None and self.monitor_op(current, self.best_value):
+            self.best_value = float(current)
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(
+            "{}.{}.tmp".format(self.state_path.name, os.getpid())
+        )
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "epoch": epoch,
+                    "wait": int(self.wait),
+                    "best": float(self.best),
+                    "best_epoch": int(self.best_epoch),
+                    "best_value": float(self.best_value),
+                },
+                f,
+            )
+        os.replace(tmp_path, self.state_path)
+
+    def on_train_end(self, logs=None):
+        super().on_train_end(logs)
+        if self.state_path.exists():
+            self.state_path.unlink()
+
+
+def predict_quantiles(model, input_df, taus, output_names):
+    """
+    Predict all the quantiles with a joint network
+    :param model: tf.keras.Model. See build_rescue_model
+    :param input_df: pd.DataFrame of (N, num_inputs)
+    :param taus: array-like of float. The quantiles the network was built for, in the same order
+    :param output_names: array-like of str. Names of the output variables, in the same order
+    :return: pred_df: pd.DataFrame of (N, len(taus) * len(output_names)), with (Quantiles, Output_Name) columns
+    """
+    return pd.DataFrame(
+        model.predict(input_df.values),
+        index=input_df.index,
+        columns=pd.MultiIndex.from_product(
+            [taus, output_names], names=["Quantiles", "Output_Name"]
+        ),
+    )
@@ -0,0 +1,144 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+
+# Regression checks of the faster ways to run the data preprocessing, on synthetic data, see synthetic_data.py. Each
+# check compares the sets they save with those of a plain full rebuild, which must match exactly.
+# Run as: python regression_checks.py --num-days 30
+
+import argparse
+import tempfile
+from pathlib import Path
+import pandas as pd
+
+import synthetic_data
+from data_preprocessing import run_preprocessing
+from data_preprocessing_util import COL_NAME_DATETIME
+from dataset import list_saved_sets
+from parse_excel_configs import ExcelConfigs
+from utility import read_data_set
+
+
+def run_synthetic_preprocessing(dir_str, incremental=False):
+    """
+    Run the data preprocessing on the synthetic data of a root directory, see synthetic_data.py. No input is known
+    ahead of its time point, so that the outputs of the last time points are always still to come in
+    :param dir_str: utility.DirStructure. Directory structure holding the synthetic data and its config workbook
+    :param incremental: bool. See data_preprocessing.run_preprocessing
+    """
+    configs = ExcelConfigs(dir_str.RESERVE_input_path)
+    configs.lag_term_configs["End"] = configs.lag_term_configs["End"].clip(upper=0)
+    run_preprocessing(configs, dir_str, incremental=incremental)
+
+
+def compare_saved_sets(data_dir, expected_data_dir):
+    """
+    Check the sets saved in a directory against the expected ones, saved in another directory
+    :raises AssertionError: if a set is missing, or differs in its samples, features or values
+    """
+    set_names = sorted(
+        set_path.name.split(".")[0] for set_path in list_saved_sets(expected_data_dir)
+    )
+    for set_name in set_names:
+        input_or_output, set_name = set_name.split("_", 1)
+        expected_df = read_data_set(expected_data_dir, input_or_output, set_name)
+        try:
+            set_df = read_data_set(data_dir, input_or_output, set_name)
+        except FileNotFoundError:
+            raise AssertionError("{}_{} is missing!".format(input_or_output, set_name))
+        if not set_df.index.equals(expected_df.index):
+            raise AssertionError(
+                "{}_{} has {} samples instead of {}, {} of them missing".format(
+                    input_or_output,
+                    set_name,
+                    len(set_df),
+                    len(expected_df),
+                    len(expected_df.index.difference(set_df.index)),
+                )
+            )
+        pd.testing.assert_frame_equal(set_df, expected_df)
+        print(
+            "{}_{} matches ({} samples)".format(input_or_output, set_name, len(set_df))
+        )
+
+
+def check_incremental_matches_full_rebuild(
+    work_dir, num_days=30, cutoff_frac=0.5, seed=0
+):
+    """
+    Preprocess the first part of the history, then let the rest of the history come in and run the incremental
+    mode. The sets must match those of a full rebuild over the whole history, including the samples whose lead
+    outputs were not in yet at the first run
+    :param work_dir: pathlib.Path. Directory to write the synthetic data and the sets into
+    :param num_days: int. Length of the synthetic history in days
+    :param cutoff_frac: float. Fraction of the history already in at the first run
+    :param seed: int. Seed of the synthetic data
+    """
+    work_dir = Path(work_dir)
+    full_dir_str, incremental_dir_str = [
+        synthetic_data.generate_synthetic_dataset(
+            work_dir / root_name, num_years=num_days / 365, seed=seed
+        )
+        for root_name in ["full", "incremental"]
+    ]
+
+    print("=== Preprocessing the history up to the cutoff ===")
+    csv_paths = sorted(incremental_dir_str.data_checker_dir.glob("*.csv"))
+    csv_dfs = {
+        csv_path: pd.read_csv(csv_path, parse_dates=[COL_NAME_DATETIME])
+        for csv_path in csv_paths
+    }
+    first_timestamp = min(df[COL_NAME_DATETIME].min() for df in csv_dfs.values())
+    cutoff = first_timestamp + pd.Timedelta(days=num_days) * cutoff_frac
+    for csv_path, csv_df in csv_dfs.items():
+        csv_df.loc[csv_df[COL_NAME_DATETIME] < cutoff].to_csv(csv_path, index=False)
+    run_synthetic_preprocessing(incremental_dir_str)
+
+    print("=== Preprocessing the rest of the history incrementally ===")
+    for csv_path, csv_df in csv_dfs.items():
+        csv_df.to_csv(csv_path, index=False)
+    run_synthetic_preprocessing(incremental_dir_str, incremental=True)
+
+    print("=== Full rebuild over the whole history ===")
+    run_synthetic_preprocessing(full_dir_str)
+
+    compare_saved_sets(incremental_dir_str.data_dir, full_dir_str.data_dir)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Regression checks of the data preprocessing on synthetic data"
+    )
+    parser.add_argument(
+        "--num-days", type=int, default=30, help="length of the synthetic history"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+# run as a script
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as work_dir:
+        check_incremental_matches_full_rebuild(
+            work_dir, num_days=args.num_days, seed=args.seed
+        )
+    print("All checks passed!")
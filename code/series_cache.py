@@ -0,0 +1,192 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# Bump whenever the parsing or frequency matching logic changes, so old entries are never reused
+CACHE_VERSION = 3
+# Default upper limit on the total size of the cache
+DEFAULT_MAX_SIZE_MB = 2048
+# Size of the blocks read in while hashing files
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class SeriesCache(object):
+    """
+    On-disk cache of parsed and frequency-matched data-checker time series. Each entry holds the two outputs of
+    data_preprocessing_util.match_frequency, stored column by column as raw binary arrays in an uncompressed .npz
+    file. Entries are keyed by the content hash and modification time of the source file, the name of the time
+    series and the sample interval of the model, so a warm run doesn't need to parse any csv.
+    The total size of the cache is capped; when exceeded, the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        """
+        Args:
+            cache_dir: pathlib.Path. Directory to hold the cache entries
+            max_size_mb: float. Upper limit on the total size of the cache in MB
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size_mb * 2**20
+        Path.mkdir(self.cache_dir, parents=True, exist_ok=True)
+
+    def get_key(self, csv_path, ts_name, sample_interval):
+        """
+        Compute the key of the cache entry for a time series
+        :param csv_path: str or pathlib.Path. Path to the data-checker output file
+        :param ts_name: str. Name of the ts
+        :param sample_interval: pd.Timedelta. The time step of the ML model
+        :return: key: str. Hex digest identifying the cache entry
+        """
+        content_hash = hashlib.sha1()
+        with open(csv_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                content_hash.update(block)
+
+        key_hash = hashlib.sha1()
+        for key_part in [
+            CACHE_VERSION,
+            content_hash.hexdigest(),
+            os.stat(csv_path).st_mtime_ns,
+            ts_name,
+            pd.Timedelta(sample_interval).value,
+        ]:
+            key_hash.update(str(key_part).encode() + b"\0")
+
+        return key_hash.hexdigest()
+
+    def get_entry_path(self, key):
+        return self.cache_dir / "{}.npz".format(key)
+
+    def load(self, key):
+        """
+        Load a cache entry
+        :param key: str. Key of the entry, see get_key
+        :return: (ts_data_one, sub_ts_df) as returned by match_frequency, or None if the entry doesn't exist or can't be read
+        """
+        entry_path = self.get_entry_path(key)
+        if not entry_path.exists():
+            return None
+
+        try:
+            with np.load(entry_path, allow_pickle=False) as entry:
+                ts_data_one = _arrays_to_frame(entry, "ts_")
+                sub_ts_df = (
+                    _arrays_to_frame(entry, "sub_") if "sub_index" in entry else None
+                )
+        except (ValueError, KeyError, OSError) as e:
+            print("Ignoring unreadable series cache entry {}: {}".format(entry_path, e))
+            return None
+        # mark the entry as recently used, unless another process evicted it meanwhile
+        try:
+            os.utime(entry_path)
+        except FileNotFoundError:
+            pass
+
+        return ts_data_one, sub_ts_df
+
+    def save(self, key, ts_data_one, sub_ts_df):
+        """
+        Save the outputs of match_frequency as a cache entry
+        :param key: str. Key of the entry, see get_key
+        :param ts_data_one: pd.DataFrame. The frequency-matched time series
+        :param sub_ts_df: pd.DataFrame or None. The sub time series
+        """
+        arrays = _frame_to_arrays(ts_data_one, "ts_")
+        if sub_ts_df is not None:
+            arrays.update(_frame_to_arrays(sub_ts_df, "sub_"))
+
+        # write to a temporary file first so that a crash never leaves a partial entry behind
+        entry_path = self.get_entry_path(key)
+        tmp_path = entry_path.with_suffix(".tmp{}".format(os.getpid()))
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, entry_path)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the total size of the cache is within the limit. Several processes
+        may share the cache and evict at once, see batch_preprocessing.py, so entries removed meanwhile are skipped
+        """
+        entries = []
+        for entry_path in self.cache_dir.glob("*.npz"):
+            try:
+                entry_stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def _frame_to_arrays(df, prefix):
+    """
+    Split a data frame into plain numpy arrays: the datetime index, the column names, the column dtypes and one
+    array per column, so columns of different dtypes are never upcast to a common one. Object columns are stored as
+    strings since the entries are loaded without pickle support
+    """
+    arrays = {
+        prefix + "index": df.index.values,
+        prefix + "index_name": np.array(df.index.name or ""),
+        prefix + "columns": np.array(df.columns, dtype=str),
+        prefix + "dtypes": np.array([dtype.str for dtype in df.dtypes], dtype=str),
+    }
+    for i, column in enumerate(df.columns):
+        values = df[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        arrays["{}col_{}".format(prefix, i)] = values
+    return arrays
+
+
+def _arrays_to_frame(entry, prefix):
+    """Inverse of _frame_to_arrays. Raises a ValueError if a column doesn't come back with the dtype it was saved with"""
+    index = pd.DatetimeIndex(
+        entry[prefix + "index"], name=str(entry[prefix + "index_name"]) or None
+    )
+    columns = entry[prefix + "columns"].tolist()
+    data = {}
+    for i, (column, dtype) in enumerate(zip(columns, entry[prefix + "dtypes"])):
+        values = entry["{}col_{}".format(prefix, i)]
+        if np.dtype(dtype) == object:
+            values = values.astype(object)
+        if values.dtype != np.dtype(dtype):
+            raise ValueError(
+                "Column {} was cached as {} but loaded as {}".format(
+                    column, dtype, values.dtype
+                )
+            )
+        data[i] = values
+    # build the frame from positional keys first so repeated column names are kept
+    df = pd.DataFrame(data, index=index)
+    df.columns = columns
+    return df
@@ -0,0 +1,201 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pvlib
+
+# Bump whenever the solar calculations change, so old entries are never reused
+CACHE_VERSION = 1
+# Quantities held by the cache, grouped by the calculation that produces them
+SOLAR_POSITION = "solar_position"
+CLEAR_SKY_OUTPUT = "clear_sky_output"
+QUANTITY_COLUMNS = {
+    SOLAR_POSITION: ["apparent_zenith", "azimuth"],
+    CLEAR_SKY_OUTPUT: ["clear_sky_output"],
+}
+
+
+def get_typical_1axis_CSO(dt_array, lat, lon):
+    """
+    Assume there's a typical 1axis solar array installed at (lat, lon), calculate the cosine of incidence angle for
+    each entry of the dt_array. Typical is defined as a one-axis tracking solar array, that has a "N-S" axis and no
+    tilt. For reference: https://www.powerfromthesun.net/Book/chapter04/chapter04.html#4.1.2%20Single-Axis%20Tracking%20Apertures
+
+    :param dt_array: pd.DatetimeIndex. A series of date times that incidence should be calculated.
+    :param lat: float. Latitude of the solar installation.
+    :param lon: float. Longitude of the solar installation
+    :return: cos_incidence: pd.series of float. Cosine of the incidence angles.
+    """
+
+    typical_single_axis_mount = pvlib.pvsystem.SingleAxisTrackerMount(
+        axis_tilt=0, axis_azimuth=180, backtrack=False
+    )
+    loc = pvlib.location.Location(lat, lon)
+    # default for these module parameters.
+    # pdc0 is output under 1KW/m2, size of panel. gamma_pdc relates to temp model
+    # pdc0 for inverter is the inverter size limit, choose bigger than first pdc0
+    array = pvlib.pvsystem.Array(
+        mount=typical_single_axis_mount,
+        module_parameters=dict(pdc0=1, gamma_pdc=-0.004, b=0.05),
+        temperature_model_parameters=dict(a=-3.56, b=-0.075, deltaT=3),
+    )
+    system = pvlib.pvsystem.PVSystem(arrays=[array], inverter_parameters=dict(pdc0=3))
+    mc = pvlib.modelchain.ModelChain(system, loc, spectral_model="no_loss")
+
+    weather = loc.get_clearsky(dt_array)
+    mc.run_model(weather)
+
+    results = mc.results.ac
+
+    return results
+
+
+def calculate_solar_quantity(dt_index, quantity, latitude, longitude, tz_from_utc):
+    """
+    Calculate solar quantities from scratch
+    :param dt_index: pd.DatetimeIndex. Timestamps in local standard time
+    :param quantity: str. One of the keys of QUANTITY_COLUMNS
+    :param latitude: float. Latitude of the location
+    :param longitude: float. Longitude of the location
+    :param tz_from_utc: float. Time difference between local standard time and UTC in hours
+    :return: quantity_values: np.ndarray of float64 of [len(dt_index), number of columns of the quantity]
+    """
+    utc_time = pd.DatetimeIndex(dt_index) - tz_from_utc * pd.Timedelta("1H")
+    if quantity == SOLAR_POSITION:
+        position_df = pvlib.solarposition.get_solarposition(
+            utc_time, latitude, longitude
+        )
+        return position_df[QUANTITY_COLUMNS[SOLAR_POSITION]].to_numpy(dtype="float64")
+    elif quantity == CLEAR_SKY_OUTPUT:
+        clear_sky_output = get_typical_1axis_CSO(utc_time, latitude, longitude)
+        return clear_sky_output.to_numpy(dtype="float64").reshape(-1, 1)
+    else:
+        raise ValueError(
+            "Solar quantity must be one of {}!".format(list(QUANTITY_COLUMNS))
+        )
+
+
+class SolarCache(object):
+    """
+    On-disk cache of solar zenith, azimuth and clear sky output at a location. These depend only on the location and
+    the timestamps, so they are calculated once for whole calendar years on a regular grid of the given resolution,
+    and saved as one raw binary .npz file per year and quantity. Entries are grouped into a sub-directory per
+    location and resolution, so any model of the same balancing area shares them across runs.
+    """
+
+    def __init__(self, cache_dir, latitude, longitude, tz_from_utc, resolution):
+        """
+        Args:
+            cache_dir: pathlib.Path. Root directory of the cache, usually DirStructure.solar_cache_dir
+            latitude: float. Latitude of the location
+            longitude: float. Longitude of the location
+            tz_from_utc: float. Time difference between local standard time and UTC in hours
+            resolution: pd.Timedelta. Time step of the cached grid. Must divide a day
+        """
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.tz_from_utc = float(tz_from_utc)
+        self.resolution = pd.Timedelta(resolution)
+        if pd.Timedelta("1D") % self.resolution != pd.Timedelta(0):
+            raise ValueError("Resolution of the solar cache must divide a day!")
+
+        location_name = "v{}_pvlib{}_lat{:.4f}_lon{:.4f}_tz{:g}_res{:.0f}s".format(
+            CACHE_VERSION,
+            pvlib.__version__,
+            self.latitude,
+            self.longitude,
+            self.tz_from_utc,
+            self.resolution.total_seconds(),
+        )
+        self.location_dir = Path(cache_dir) / location_name
+        Path.mkdir(self.location_dir, parents=True, exist_ok=True)
+        self.loaded_years = {}  # in-memory copies of the entries already used
+
+    def get_entry_path(self, quantity, year):
+        return self.location_dir / "{}_{}.npz".format(quantity, year)
+
+    def get_year(self, quantity, year):
+        """
+        Values of a quantity over the whole grid of a year, calculated and saved if not cached yet
+        :param quantity: str. One of the keys of QUANTITY_COLUMNS
+        :param year: int. Calendar year, in local standard time
+        :return: year_values: np.ndarray of float64 of [number of grid points in the year, number of columns]
+        """
+        if (quantity, year) in self.loaded_years:
+            return self.loaded_years[(quantity, year)]
+
+        entry_path = self.get_entry_path(quantity, year)
+        if entry_path.exists():
+            with np.load(entry_path, allow_pickle=False) as entry:
+                year_values = entry["values"]
+        else:
+            year_grid = pd.date_range(
+                pd.Timestamp(year=year, month=1, day=1),
+                pd.Timestamp(year=year + 1, month=1, day=1),
+                freq=self.resolution,
+                inclusive="left",
+            )
+            year_values = calculate_solar_quantity(
+                year_grid, quantity, self.latitude, self.longitude, self.tz_from_utc
+            )
+            # write to a temporary file first so that a crash never leaves a partial entry behind
+            tmp_path = entry_path.with_suffix(".tmp{}".format(os.getpid()))
+            with open(tmp_path, "wb") as f:
+                np.savez(f, values=year_values)
+            os.replace(tmp_path, entry_path)
+
+        self.loaded_years[(quantity, year)] = year_values
+        return year_values
+
+    def query(self, dt_index, quantity):
+        """
+        Look up a solar quantity at arbitrary timestamps. Timestamps on the grid of the cache are read from the
+        yearly entries; the few that aren't, if any, are calculated directly.
+        :param dt_index: pd.DatetimeIndex. Timestamps in local standard time
+        :param quantity: str. One of the keys of QUANTITY_COLUMNS
+        :return: quantity_df: pd.DataFrame indexed by dt_index, with the columns listed in QUANTITY_COLUMNS
+        """
+        dt_index = pd.DatetimeIndex(dt_index)
+        columns = QUANTITY_COLUMNS[quantity]
+        quantity_values = np.full((len(dt_index), len(columns)), np.nan)
+
+        is_on_grid = dt_index.asi8 % self.resolution.value == 0
+        years = dt_index.year.to_numpy()
+        for year in np.unique(years[is_on_grid]):
+            is_in_year = is_on_grid & (years == year)
+            grid_pos = (
+                dt_index[is_in_year] - pd.Timestamp(year=year, month=1, day=1)
+            ) // self.resolution
+            quantity_values[is_in_year] = self.get_year(quantity, year)[grid_pos]
+
+        if not is_on_grid.all():
+            quantity_values[~is_on_grid] = calculate_solar_quantity(
+                dt_index[~is_on_grid],
+                quantity,
+                self.latitude,
+                self.longitude,
+                self.tz_from_utc,
+            )
+
+        return pd.DataFrame(quantity_values, index=dt_index, columns=columns)
@@ -0,0 +1,514 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Generator of synthetic data-checker outputs, to develop, test and benchmark the model without the proprietary
+# inputs. Load, solar and wind actuals and their forecasts are written as data-checker CSVs, along with a matching
+# config workbook, laid out as in utility.DirStructure under a root directory.
+# Run as: python synthetic_data.py --root-dir ../synthetic --num-years 2
+
+import argparse
+from pathlib import Path
+import numpy as np
+import openpyxl
+import pandas as pd
+import scipy.signal
+
+from utility import DirStructure
+from data_preprocessing_util import (
+    COL_NAME_DATETIME,
+    COL_NAME_VALUE,
+    COL_NAME_VALIDITY,
+)
+
+# Category, whether it is generation or load, and whether it is an actual or a forecast of each synthetic series
+SYNTHETIC_SERIES = {
+    "load_actuals": ("Load", "Load", "Actual"),
+    "load_forecasts": ("Load", "Load", "Forecast"),
+    "solar_actuals": ("Solar", "Generation", "Actual"),
+    "solar_forecasts": ("Solar", "Generation", "Forecast"),
+    "wind_actuals": ("Wind", "Generation", "Actual"),
+    "wind_forecasts": ("Wind", "Generation", "Forecast"),
+}
+# Size of each resource in MW
+LOAD_PEAK = 5000.0
+SOLAR_CAPACITY = 1000.0
+WIND_CAPACITY = 1500.0
+# Standard deviation of the forecast errors of each category, as a fraction of the size of the resource
+FORECAST_ERROR_STD = {"Load": 0.02, "Solar": 0.06, "Wind": 0.08}
+
+
+def make_ar1_noise(num_values, phi, rng):
+    """
+    First order autoregressive noise of unit variance, filtered in one pass rather than looped over in Python
+    :param num_values: int. Length of the noise
+    :param phi: float. Autocorrelation between consecutive values, in [0, 1)
+    :param rng: np.random.Generator
+    :return: noise: np.ndarray of float64 of (num_values,)
+    """
+    innovations = rng.normal(scale=np.sqrt(1 - phi**2), size=num_values)
+    innovations[0] = rng.normal()
+    noise = scipy.signal.lfilter([1.0], [1.0, -phi], innovations)
+
+    return noise
+
+
+def get_sin_solar_elevation(dt_index, latitude, longitude, tz_from_utc):
+    """
+    Approximate sine of the solar elevation, precise enough for synthetic data and much faster than pvlib
+    :param dt_index: pd.DatetimeIndex. Timestamps in local standard time
+    :param latitude: float. Latitude of the location
+    :param longitude: float. Longitude of the location
+    :param tz_from_utc: float. Time difference between local standard time and UTC in hours
+    :return: sin_elevation: np.ndarray of float64
+    """
+    day_of_year = dt_index.dayofyear.to_numpy()
+    hour = (dt_index - dt_index.normalize()) / pd.Timedelta("1H")
+    declination = np.deg2rad(23.45) * np.sin(2 * np.pi * (284 + day_of_year) / 365)
+    solar_time = np.asarray(hour) + (longitude - 15 * tz_from_utc) / 15
+    hour_angle = np.deg2rad(15 * (solar_time - 12))
+    latitude = np.deg2rad(latitude)
+
+    return np.sin(latitude) * np.sin(declination) + np.cos(latitude) * np.cos(
+        declination
+    ) * np.cos(hour_angle)
+
+
+def make_load_actuals(dt_index, rng):
+    """
+    Load with winter and summer peaks, morning and evening peaks, lower weekends and weather driven noise
+    """
+    day_of_year = dt_index.dayofyear.to_numpy()
+    hour = np.asarray((dt_index - dt_index.normalize()) / pd.Timedelta("1H"))
+    seasonal = 0.1 * np.cos(4 * np.pi * (day_of_year - 15) / 365)
+    daily = 0.12 * np.exp(-(((hour - 8) / 2.5) ** 2)) + 0.18 * np.exp(
+        -(((hour - 18.5) / 3) ** 2)
+    )
+    weekend = -0.06 * (dt_index.dayofweek.to_numpy() >= 5)
+    noise = 0.03 * make_ar1_noise(len(dt_index), 0.999, rng)
+
+    return LOAD_PEAK * (0.6 + seasonal + daily + weekend + noise)
+
+
+def make_solar_actuals(dt_index, latitude, longitude, tz_from_utc, rng):
+    """
+    Solar output following the sun, dimmed by passing clouds
+    """
+    clear_sky = np.clip(
+        get_sin_solar_elevation(dt_index, latitude, longitude, tz_from_utc), 0, None
+    )
+    cloudiness = 1 / (
+        1 + np.exp(-1.5 - 1.5 * make_ar1_noise(len(dt_index), 0.995, rng))
+    )
+
+    return SOLAR_CAPACITY * clear_sky * cloudiness
+
+
+def make_wind_actuals(dt_index, rng):
+    """
+    Wind output drifting between calm and full output over a few hours
+    """
+    wind_speed = 2 * make_ar1_noise(len(dt_index), 0.998, rng)
+
+    return WIND_CAPACITY / (1 + np.exp(-wind_speed))
+
+
+def make_forecast(actuals, forecast_resolution, error_std, rng, capacity=None):
+    """
+    Forecast of a series at a coarser resolution: the interval average of the actuals plus autocorrelated errors
+    :param actuals: pd.Series. The actuals
+    :param forecast_resolution: pd.Timedelta. Time step of the forecast
+    :param error_std: float. Standard deviation of the forecast errors, in the unit of the actuals
+    :param rng: np.random.Generator
+    :param capacity: float or None. Upper bound of the forecast, if any
+    :return: forecast: pd.Series
+    """
+    forecast = actuals.resample(forecast_resolution).mean()
+    forecast += error_std * make_ar1_noise(len(forecast), 0.9, rng)
+
+    return forecast.clip(lower=0, upper=capacity)
+
+
+def make_validity(num_values, invalid_frac, rng, mean_run_length=6):
+    """
+    Validity flags of a series, with the invalid values grouped in runs, as data-checker outputs tend to be
+    :param num_values: int. Length of the series
+    :param invalid_frac: float. Approximate fraction of invalid values
+    :param rng: np.random.Generator
+    :param mean_run_length: float. Average number of consecutive invalid values
+    :return: is_valid: np.ndarray of bool of (num_values,)
+    """
+    is_valid = np.ones(num_values, dtype=bool)
+    num_runs = int(round(invalid_frac * num_values / mean_run_length))
+    if num_runs == 0:
+        return is_valid
+
+    run_starts = rng.integers(0, num_values, size=num_runs)
+    run_lengths = rng.geometric(1 / mean_run_length, size=num_runs)
+    # Mark the start and end of each run, then fill the runs in with a cumsum
+    run_edges = np.zeros(num_values + 1, dtype=np.int64)
+    np.add.at(run_edges, run_starts, 1)
+    np.add.at(run_edges, np.minimum(run_starts + run_lengths, num_values), -1)
+    is_valid[np.cumsum(run_edges[:-1]) > 0] = False
+
+    return is_valid
+
+
+def to_data_checker_df(values, is_valid):
+    """
+    Lay a series out in the format of the data-checker outputs, see data_preprocessing_util.read_data_checker_csv
+    :param values: pd.Series. The series
+    :param is_valid: np.ndarray of bool. Validity of each value
+    :return: ts_csv_df: pd.DataFrame
+    """
+    return pd.DataFrame(
+        {
+            COL_NAME_DATETIME: values.index,
+            COL_NAME_VALUE: values.to_numpy(),
+            COL_NAME_VALIDITY: is_valid,
+        }
+    )
+
+
+def make_synthetic_series(
+    start="2017-01-01",
+    num_days=365,
+    resolution="5T",
+    forecast_resolution="15T",
+    invalid_frac=0.01,
+    latitude=45.9,
+    longitude=-106.62,
+    tz_from_utc=-8,
+    seed=0,
+):
+    """
+    Create all synthetic series, see SYNTHETIC_SERIES
+    :param start: str or pd.Timestamp. First timestamp of the history
+    :param num_days: int. Length of the history in days
+    :param resolution: str or pd.Timedelta. Time step of the actuals
+    :param forecast_resolution: str or pd.Timedelta. Time step of the forecasts
+    :param invalid_frac: float. Approximate fraction of values flagged as invalid in each series
+    :param latitude: float. Latitude of the location, used for the solar output
+    :param longitude: float. Longitude of the location
+    :param tz_from_utc: float. Time difference between local standard time and UTC in hours
+    :param seed: int. Seed of the random number generator, the same seed always yields the same series
+    :return: ts_csv_dfs: dict(str: pd.DataFrame). Series in the data-checker format, by name
+    """
+    rng = np.random.default_rng(seed)
+    dt_index = pd.date_range(
+        start,
+        pd.Timestamp(start) + pd.Timedelta(days=num_days),
+        freq=resolution,
+        inclusive="left",
+    )
+
+    actuals = {
+        "Load": make_load_actuals(dt_index, rng),
+        "Solar": make_solar_actuals(dt_index, latitude, longitude, tz_from_utc, rng),
+        "Wind": make_wind_actuals(dt_index, rng),
+    }
+    resource_sizes = {"Load": LOAD_PEAK, "Solar": SOLAR_CAPACITY, "Wind": WIND_CAPACITY}
+
+    ts_csv_dfs = {}
+    for ts_name, (category, _, forecast_or_actual) in SYNTHETIC_SERIES.items():
+        values = pd.Series(actuals[category], index=dt_index)
+        if forecast_or_actual == "Forecast":
+            values = make_forecast(
+                values,
+                pd.Timedelta(forecast_resolution),
+                FORECAST_ERROR_STD[category] * resource_sizes[category],
+                rng,
+                capacity=None if category == "Load" else resource_sizes[category],
+            )
+        ts_csv_dfs[ts_name] = to_data_checker_df(
+            values, make_validity(len(values), invalid_frac, rng)
+        )
+
+    return ts_csv_dfs
+
+
+def make_synthetic_configs(
+    file_names,
+    start="2017-01-01",
+    num_days=365,
+    model_name="RESERVE_synthetic",
+    sample_interval="15T",
+    latitude=45.9,
+    longitude=-106.62,
+    tz_from_utc=-8,
+):
+    """
+    Tabs of a config workbook matching the synthetic series, laid out as in RESERVE_input_v1.xlsx. The last third
+    of the history is held out as the testing set
+    :param file_names: dict(str: str). File name of each synthetic series, by name
+    :return: sheets: dict(str: pd.DataFrame). Tab name as key and the table starting at "A1" as value
+    """
+    history_start = pd.Timestamp(start).normalize()
+    history_end = history_start + pd.Timedelta(days=num_days)
+    test_start = history_start + pd.Timedelta(days=num_days * 2 // 3)
+    ts_names = list(SYNTHETIC_SERIES)
+    is_forecast = [SYNTHETIC_SERIES[ts_name][2] == "Forecast" for ts_name in ts_names]
+
+    main_parameters = pd.DataFrame(
+        {
+            "Value": [
+                model_name,
+                latitude,
+                longitude,
+                tz_from_utc,
+                sample_interval,
+                True,
+            ],
+            "Notes": None,
+        },
+        index=pd.Index(
+            [
+                "Model Name",
+                "Latitude",
+                "Longitude",
+                "TZ from UTC",
+                "Sample Interval",
+                "synthesize forecast error",
+            ],
+            name="Parameters",
+        ),
+    )
+    timeseries_attributes = pd.DataFrame(
+        {
+            "File Name": [file_names[ts_name] for ts_name in ts_names],
+            "Is Input?": True,
+            "Is Output?": False,
+            "Notes": "synthetic",
+        },
+        index=pd.Index(ts_names, name="Feature Name"),
+    )
+    starts_and_ends = pd.DataFrame(
+        {
+            "Start Time": [history_start, test_start, history_start],
+            "End Time": [test_start, history_end, history_end],
+            "Notes": None,
+        },
+        index=pd.Index(
+            ["Training and Validation Set", "Testing Set", "Inference Set"],
+            name="Set Name",
+        ),
+    )
+    # Forecasts are known ahead of time, so their next value is also an input
+    lag_term_configs = pd.DataFrame(
+        [[-1, 1, 1] if forecast else [-5, -2, 1] for forecast in is_forecast],
+        index=pd.Index(ts_names, name="Feature"),
+        columns=["Start", "End", "Step"],
+    )
+    lead_term_configs = pd.DataFrame(
+        columns=["Start", "End", "Step"], index=pd.Index([], name="Feature")
+    )
+    temporal_features = pd.DataFrame(
+        {"To include?": True, "Notes": None},
+        index=pd.Index(
+            [
+                "Holiday",
+                "Day of week",
+                "Revolution angle",
+                "Rotation angle",
+                "Elapsed time",
+                "Solar position",
+            ],
+            name="Temporal Feature",
+        ),
+    )
+    forecast_configs = pd.DataFrame(
+        {
+            "Synthesize Forecast?": False,
+            "Method": None,
+            "Forecast Feature Name": None,
+            "Forecast Horizon": None,
+            "Forecast Term Start": None,
+            "Forecast Term End": None,
+            "Forecast Term Step": None,
+            "Notes": None,
+        },
+        index=pd.Index(ts_names, name="Feature Name"),
+    )
+    forecast_error_configs = pd.DataFrame(
+        [[True, 1, 1, 1]] * 4,
+        index=pd.Index(
+            ["Net Load Forecast Error", "Load", "Solar", "Wind"], name="Category Name"
+        ),
+        columns=[
+            "Synthesize Error?",
+            "Error Lead Term Start",
+            "Error Lead Term End",
+            "Error Lead Term Step",
+        ],
+    )
+    forecast_error_contribution = pd.DataFrame(
+        [
+            [True, gen_or_load, forecast_or_actual, category, "synthetic"]
+            for category, gen_or_load, forecast_or_actual in SYNTHETIC_SERIES.values()
+        ],
+        index=pd.Index(ts_names, name="Feature Name"),
+        columns=[
+            "Impacts Forecast Error?",
+            "Generation or Load",
+            "Forecast or Actual",
+            "Category",
+            "Notes",
+        ],
+    )
+
+    return {
+        "Main Parameters": main_parameters,
+        "Timeseries Attributes": timeseries_attributes,
+        "Starts and Ends": starts_and_ends,
+        "Lag Term Configs": lag_term_configs,
+        "Lead Term Configs": lead_term_configs,
+        "Temporal Features": temporal_features,
+        "Forecast Configs": forecast_configs,
+        "Forecast Error Configs": forecast_error_configs,
+        "Forecast Error Contribution": forecast_error_contribution,
+    }
+
+
+def write_config_workbook(sheets, config_path):
+    """
+    Write the tabs of a config workbook, each table starting at cell "A1" with the index as first column, so that
+    it can be read back by parse_excel_configs.ExcelConfigs
+    :param sheets: dict(str: pd.DataFrame). Tab name as key and the table as value
+    :param config_path: pathlib.Path. Path to the workbook
+    """
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for sheet_name, df in sheets.items():
+        worksheet = workbook.create_sheet(sheet_name)
+        worksheet.append([df.index.name] + list(df.columns))
+        for label, row in zip(df.index, df.itertuples(index=False)):
+            worksheet.append([to_cell_value(value) for value in (label,) + tuple(row)])
+
+    workbook.save(config_path)
+
+
+def to_cell_value(value):
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+
+    return value
+
+
+def generate_synthetic_dataset(
+    root_dir,
+    num_years=1,
+    start="2017-01-01",
+    resolution="5T",
+    forecast_resolution="15T",
+    invalid_frac=0.01,
+    model_name="RESERVE_synthetic",
+    sample_interval="15T",
+    seed=0,
+):
+    """
+    Write the synthetic series as data-checker CSVs, along with a matching config workbook, under a root directory
+    laid out as in utility.DirStructure. To run the data preprocessing on them, copy the code directory into the root
+    directory and the config workbook into it as RESERVE_input_v1.xlsx
+    :param root_dir: pathlib.Path. Root directory, i.e. the parent of the code directory
+    :param num_years: float. Length of the history in years
+    :param model_name: str. Name of the model in the config workbook
+    :return: dir_str: utility.DirStructure. Directory structure holding the synthetic data, the config workbook being
+    saved as dir_str.RESERVE_input_path
+    """
+    num_days = int(round(365 * num_years))
+    dir_str = DirStructure(code_dir=Path(root_dir) / "code", model_name=model_name)
+    Path.mkdir(dir_str.data_checker_dir, parents=True, exist_ok=True)
+
+    ts_csv_dfs = make_synthetic_series(
+        start=start,
+        num_days=num_days,
+        resolution=resolution,
+        forecast_resolution=forecast_resolution,
+        invalid_frac=invalid_frac,
+        seed=seed,
+    )
+    file_names = {}
+    for ts_name, ts_csv_df in ts_csv_dfs.items():
+        print("Writing {} of {} values...".format(ts_name, len(ts_csv_df)))
+        file_names[ts_name] = "synthetic_{}.csv".format(ts_name)
+        ts_csv_df.to_csv(dir_str.data_checker_dir / file_names[ts_name], index=False)
+
+    write_config_workbook(
+        make_synthetic_configs(
+            file_names,
+            start=start,
+            num_days=num_days,
+            model_name=model_name,
+            sample_interval=sample_interval,
+        ),
+        dir_str.RESERVE_input_path,
+    )
+    print("Config workbook saved to {}".format(dir_str.RESERVE_input_path))
+
+    return dir_str
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic data-checker outputs and a matching config"
+    )
+    parser.add_argument(
+        "--root-dir",
+        type=Path,
+        required=True,
+        help="root directory to write into, laid out as the parent of the code directory",
+    )
+    parser.add_argument(
+        "--num-years", type=float, default=1, help="length of the history in years"
+    )
+    parser.add_argument(
+        "--start", default="2017-01-01", help="first timestamp of the history"
+    )
+    parser.add_argument(
+        "--resolution", default="5T", help="time step of the actuals, e.g. 5T"
+    )
+    parser.add_argument(
+        "--forecast-resolution",
+        default="15T",
+        help="time step of the forecasts, e.g. 15T",
+    )
+    parser.add_argument(
+        "--invalid-frac",
+        type=float,
+        default=0.01,
+        help="approximate fraction of values flagged as invalid",
+    )
+    parser.add_argument(
+        "--model-name", default="RESERVE_synthetic", help="name of the model"
+    )
+    parser.add_argument(
+        "--sample-interval", default="15T", help="time step of the ML model"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+# run as a script
+if __name__ == "__main__":
+    generate_synthetic_dataset(**vars(parse_args()))
@@ -0,0 +1,701 @@
+# ############################ LICENSE INFORMATION ############################
+# This file is part of the E3 RESERVE Model.
+
+# Copyright (C) 2021 Energy and Environmental Economics, Inc.
+# For contact information, go to www.ethree.com
+
+# The E3 RESERVE Model is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# The E3 RESERVE Model is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with the E3 RESERVE Model (in the file LICENSE.TXT). If not,
+# see <http://www.gnu.org/licenses/>.
+# #############################################################################
+
+# Train the RESCUE networks of a model outside of rescue.ipynb, spreading the (tau, fold) grid over worker processes.
+# Each worker caps the threads TensorFlow uses, and is pinned to its own CPU cores where the OS allows it, so that the
+# workers don't oversubscribe the machine. The trainval sets are memory-mapped by every worker from the "npy" format,
+# see dataset.DataSet, rather than unpickled once per worker; sets saved otherwise are converted once beforehand.
+# The trained networks are saved to DirStructure.models_dir/tau_x/fold_#y, as in the notebook.
+# The hyperparameters are read from the optional "Training Parameters" tab of the input workbook. Training can be
+# resumed: each finished network is recorded in a manifest, and the networks interrupted partway through resume from
+# their last epoch, backed up under DirStructure.ckpts_dir/tau_x/fold_#y along with the state of their early stopping.
+# Run as: python trainer.py RESERVE_PSE_6.0 --max-workers 8
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+import cross_val
+import dataset
+import utility
+from parse_excel_configs import ExcelConfigs
+
+# Default hyperparameters, the same as the user inputs of rescue.ipynb
+DEFAULT_HYPERPARAMS = {
+    "PI_percentiles": [0.025, 0.5, 0.975],
+    "joint_quantiles": False,
+    "non_crossing_quantiles": False,
+    "num_neurons": 10,
+    "activation_type": "relu",
+    "loss_wts": [np.sqrt(3), 1.0, 1.0, 1.0],
+    "num_cv_folds": 10,
+    "batch_size": 64,
+    "max_epochs": 50,
+    "optimizer_choice": "adam",
+    "early_stop_monitor": "val_loss",
+    "early_stop_min_delta": 0.5,
+    "early_stop_patience": 3,
+    "log_activation_freq": 0,
+    "log_update_freq": "epoch",
+}
+# Same default workbook as data_preprocessing.py, not imported from there to keep the workers light
+INPUT_EXCEL_NAME = Path("RESERVE_input_v1.xlsx")
+# Directory the trainval sets are converted into, under DirStructure.ckpts_dir, unless already saved as "npy" sets
+SHARED_SETS_DIRNAME = "trainval_sets"
+# Name of the summary of the trained networks, saved in DirStructure.diag_dir
+TRAINING_SUMMARY_FILENAME = "training_summary.csv"
+# Name of the manifest of the finished networks, saved in DirStructure.models_dir
+MANIFEST_FILENAME = "manifest.json"
+# Name of the state of the early stopping, saved next to the backup of each network, see train_job
+EARLY_STOPPING_STATE_FILENAME = "early_stopping.json"
+
+
+def read_hyperparams(configs):
+    """
+    Hyperparameters from the optional "Training Parameters" tab of the input workbook, laid out as "Main Parameters":
+    one parameter per row, e.g. "Num Neurons", with its value in the "Value" column. Parameters not in the tab keep
+    their default, see DEFAULT_HYPERPARAMS. Lists such as "PI Percentiles" are written as comma separated numbers.
+    :param configs: parse_excel_configs.ExcelConfigs
+    :return: hyperparams: dict of the hyperparameters
+    """
+    hyperparams = dict(DEFAULT_HYPERPARAMS)
+    training_parameters = getattr(configs, "training_parameters", None)
+    if training_parameters is None:
+        return hyperparams
+
+    names = {name.lower(): name for name in DEFAULT_HYPERPARAMS}
+    for param_name, value in training_parameters["Value"].items():
+        attr_name = str(param_name).strip().lower().replace(" ", "_")
+        if attr_name not in names:
+            raise ValueError(
+                "Unknown training parameter '{}'! Expecting one of {}".format(
+                    param_name, list(DEFAULT_HYPERPARAMS)
+                )
+            )
+        if value is None or pd.isna(value):
+            continue
+        name = names[attr_name]
+        default = DEFAULT_HYPERPARAMS[name]
+        if isinstance(default, list):
+            values = value.split(",") if isinstance(value, str) else [value]
+            hyperparams[name] = [float(v) for v in values]
+        elif isinstance(default, bool):
+            hyperparams[name] = (
+                value.strip().lower() in ["true", "yes", "1"]
+                if isinstance(value, str)
+                else bool(value)
+            )
+        elif isinstance(default, int):
+            hyperparams[name] = int(value)
+        elif isinstance(default, float):
+            hyperparams[name] = float(value)
+        else:
+            hyperparams[name] = value
+
+    return hyperparams
+
+
+def get_job_key(job):
+    """
+    :return: job_key: str. Key of the job in the manifest, the same as its subdirectory, e.g. "tau_joint/fold_#0"
+    """
+    # Not imported at the top, as the workers import this module before TensorFlow may start up, see init_worker
+    import quantile_network
+
+    return quantile_network.get_model_subdir(
+        Path(), job["fold_idx"], job["tau"]
+    ).as_posix()
+
+
+def get_training_fingerprint(hyperparams, input_set, output_set, saved_set_paths):
+    """
+    :param hyperparams: dict of the hyperparameters
+    :param input_set: dataset.DataSet. The trainval inputs, see get_shared_set_paths
+    :param output_set: dataset.DataSet. The trainval outputs
+    :param saved_set_paths: list of pathlib.Path. Where data_preprocessing.py saved the trainval inputs and outputs
+    :return: fingerprint: str. Hash of the hyperparameters, the trainval samples, the input and output features and
+    the time the sets were last saved at. Networks recorded in a manifest under another fingerprint are stale, e.g.
+    after the data preprocessing was rerun with other features, and are trained again
+    """
+    fingerprint = hashlib.sha256(
+        json.dumps(
+            {
+                "hyperparams": {
+                    name: np.asarray(value).tolist()
+                    for name, value in hyperparams.items()
+                },
+                "input_columns": [str(col) for col in input_set.columns],
+                "output_columns": [str(col) for col in output_set.columns],
+                "input_shape": list(input_set.shape),
+                "output_shape": list(output_set.shape),
+                "saved_sets": [
+                    [set_path.name, set_path.stat().st_mtime_ns]
+                    for set_path in saved_set_paths
+                ],
+            },
+            sort_keys=True,
+        ).encode()
+    )
+    fingerprint.update(cross_val.get_index_fingerprint(input_set.index).encode())
+
+    return fingerprint.hexdigest()
+
+
+def read_manifest(manifest_path, fingerprint):
+    """
+    :param manifest_path: pathlib.Path
+    :param fingerprint: str. See get_training_fingerprint
+    :return: job_records: dict(str: dict) of the record of each finished job by key, see get_job_key. Empty if there's
+    no manifest yet, None if it was recorded under another fingerprint
+    """
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("fingerprint") != fingerprint:
+        return None
+
+    return manifest["jobs"]
+
+
+def save_manifest(manifest_path, fingerprint, job_records):
+    """
+    Save the manifest atomically, so that an interruption never leaves it half written
+    """
+    tmp_path = manifest_path.with_name(
+        "{}.{}.tmp".format(manifest_path.name, os.getpid())
+    )
+    with open(tmp_path, "w") as f:
+        json.dump({"fingerprint": fingerprint, "jobs": job_records}, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_shared_set_paths(dir_str):
+    """
+    Paths of the trainval sets in the "npy" format, which every worker can memory-map. Sets saved in the "pkl" format
+    or in shards are converted once, and the conversion is reused as long as it is newer than the sets
+    :param dir_str: utility.DirStructure. Directory structure of the model
+    :return: set_paths: dict of pathlib.Path of the "input" and "output" sets
+    """
+    set_paths = {}
+    for input_or_output in ["input", "output"]:
+        saved_paths = dataset.find_set_paths(
+            dir_str.data_dir, input_or_output, "trainval"
+        )
+        if not saved_paths:
+            raise FileNotFoundError(
+                "{}_trainval not found in {}!".format(input_or_output, dir_str.data_dir)
+            )
+        if len(saved_paths) == 1 and saved_paths[0].is_dir():
+            set_paths[input_or_output] = saved_paths[0]
+            continue
+
+        shared_path = dataset.get_set_path(
+            dir_str.ckpts_dir / SHARED_SETS_DIRNAME, input_or_output, "trainval", "npy"
+        )
+        if not shared_path.exists() or shared_path.stat().st_mtime < max(
+            saved_path.stat().st_mtime for saved_path in saved_paths
+        ):
+            print(
+                "Converting {}_trainval to be memory-mapped...".format(input_or_output)
+            )
+            shared_path.parent.mkdir(parents=True, exist_ok=True)
+            dataset.save_data_set(
+                utility.read_data_set(dir_str.data_dir, input_or_output, "trainval"),
+                shared_path,
+            )
+        set_paths[input_or_output] = shared_path
+
+    return set_paths
+
+
+def get_core_groups(num_workers):
+    """
+    Split the CPU cores available to this process into one group per worker
+    :return: core_groups: list of list of int, or None if the OS doesn't support pinning processes to cores
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+
+    return [
+        [int(core) for core in group]
+        for group in np.array_split(cores, num_workers)
+        if len(group)
+    ]
+
+
+def init_worker(core_groups_queue, threads_per_worker):
+    """
+    Pin the worker to its own cores, and cap the threads of TensorFlow, before TensorFlow starts up in the worker
+    :param core_groups_queue: multiprocessing.Queue of the core groups not yet taken, or None
+    :param threads_per_worker: int. Number of intra-op threads of TensorFlow
+    """
+    if core_groups_queue is not None:
+        os.sched_setaffinity(0, core_groups_queue.get())
+    for env_var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[env_var] = str(threads_per_worker)
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def get_batched_dataset(
+    input_values, output_values, sample_idx, batch_size, shuffle=False
+):
+    """
+    Batches of the samples of a fold, gathered from the memory-mapped sets as they are consumed. Only the sample
+    indices are held in memory and shuffled, rather than copying the rows of the fold into a tensor
+    :param input_values: np.ndarray, memory-mapped. The trainval inputs
+    :param output_values: np.ndarray, memory-mapped. The trainval outputs
+    :param sample_idx: np.ndarray of int. Rows of the samples of the fold
+    :param batch_size: int
+    :param shuffle: bool. Whether to reshuffle the samples at every epoch
+    :return: ds: tf.data.Dataset of (input, output) batches
+    """
+    import tensorflow as tf
+
+    def gather_rows(batch_idx):
+        # Sorted so that the rows are read in file order; the order within a batch doesn't change its loss
+        batch_idx = np.sort(batch_idx)
+        return input_values[batch_idx], output_values[batch_idx]
+
+    def gather_batch(batch_idx):
+        input_batch, output_batch = tf.numpy_function(
+            gather_rows,
+            [batch_idx],
+            [tf.as_dtype(input_values.dtype), tf.as_dtype(output_values.dtype)],
+        )
+        input_batch.set_shape([None, input_values.shape[1]])
+        output_batch.set_shape([None, output_values.shape[1]])
+        return input_batch, output_batch
+
+    ds = tf.data.Dataset.from_tensor_slices(sample_idx)
+    if shuffle:
+        ds = ds.shuffle(buffer_size=len(sample_idx), reshuffle_each_iteration=True)
+
+    return ds.batch(batch_size).map(gather_batch)
+
+
+def train_job(job):
+    """
+    Train, in a worker process, the network of a quantile and a fold, as in the training loop of rescue.ipynb
+    :param job: dict of the tau (None for a joint network), the fold_idx, the set_paths, the fold_ids, the
+    normalization statistics, the hyperparams and the directories of the model. A job interrupted partway through
+    resumes from the last epoch backed up in its checkpoint directory
+    :return: job_summary: dict of the tau, the fold_idx, the number of epochs, the best validation loss and the
+    wall time
+    """
+    # Only imported in the workers, so that TensorFlow starts up after init_worker
+    import tensorflow as tf
+    import quantile_network
+
+    tic = time.perf_counter()
+    tau, fold_idx, hyperparams = job["tau"], job["fold_idx"], job["hyperparams"]
+    taus = np.asarray(hyperparams["PI_percentiles"])
+
+    # Memory-mapped, and only the rows of each batch are read in, see get_batched_dataset, so the workers share the
+    # sets through the page cache instead of each holding its own copy
+    input_trainval = dataset.DataSet(job["set_paths"]["input"]).values
+    output_trainval = dataset.DataSet(job["set_paths"]["output"]).values
+    val_mask = cross_val.get_val_mask(job["fold_ids"], fold_idx)
+    train_ds = get_batched_dataset(
+        input_trainval,
+        output_trainval,
+        np.flatnonzero(~val_mask),
+        hyperparams["batch_size"],
+        shuffle=True,
+    )
+    val_ds = get_batched_dataset(
+        input_trainval,
+        output_trainval,
+        np.flatnonzero(val_mask),
+        hyperparams["batch_size"],
+    )
+
+    # The normalization statistics are computed once for all the jobs, instead of adapting the layer in each job
+    rescue_model = quantile_network.build_rescue_model(
+        input_trainval.shape[1],
+        output_trainval.shape[1],
+        hyperparams["num_neurons"],
+        hyperparams["activation_type"],
+        taus=taus if tau is None else None,
+        non_crossing=hyperparams["non_crossing_quantiles"] and tau is None,
+        norm_mean=job["norm_mean"],
+        norm_variance=job["norm_variance"],
+    )
+    if tau is None:
+        loss = quantile_network.MultiQuantilePinballLoss(
+            taus, loss_wts=hyperparams["loss_wts"]
+        )
+        training_metrics = quantile_network.get_training_metrics(taus)
+    else:
+        loss = quantile_network.PinballLoss(tau=tau, loss_wts=hyperparams["loss_wts"])
+        training_metrics = quantile_network.get_training_metrics()
+    rescue_model.compile(
+        loss=loss,
+        optimizer=hyperparams["optimizer_choice"],
+        metrics=training_metrics,
+    )
+
+    logs_dir = quantile_network.get_model_subdir(job["logs_dir"], fold_idx, tau)
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    # Backs up the weights, the optimizer state and the epoch after each epoch, and restores them when the job is run
+    # again after an interruption, along with the state of the early stopping. The backup is deleted once the
+    # training finishes
+    ckpt_dir = quantile_network.get_model_subdir(job["ckpts_dir"], fold_idx, tau)
+    early_stopping = quantile_network.ResumableEarlyStopping(
+        ckpt_dir / EARLY_STOPPING_STATE_FILENAME,
+        monitor=hyperparams["early_stop_monitor"],
+        min_delta=quantile_network.get_early_stop_min_delta(
+            hyperparams["early_stop_min_delta"], taus if tau is None else None
+        ),
+        patience=hyperparams["early_stop_patience"],
+    )
+    callbacks = [
+        tf.keras.callbacks.BackupAndRestore(str(ckpt_dir)),
+        early_stopping,
+        tf.keras.callbacks.TensorBoard(
+            str(logs_dir),
+            histogram_freq=hyperparams["log_activation_freq"],
+            embeddings_freq=0,
+            update_freq=hyperparams["log_update_freq"],
+        ),
+    ]
+    history = rescue_model.fit(
+        train_ds,
+        validation_data=val_ds,
+        epochs=hyperparams["max_epochs"],
+        callbacks=callbacks,
+        verbose=0,
+    )
+
+    model_dir = quantile_network.get_model_subdir(job["models_dir"], fold_idx, tau)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    rescue_model.save(str(model_dir))
+
+    return {
+        "tau": "joint" if tau is None else tau,
+        "fold_idx": fold_idx,
+        # Epochs are counted from the start of the training, including those before any interruption
+        "num_epochs": history.epoch[-1] + 1,
+        # The history only holds the epochs since the last interruption, unlike the early stopping
+        "best_val_loss": (
+            early_stopping.best_value
+            if early_stopping.monitor == "val_loss"
+            else min(history.history["val_loss"])
+        ),
+        "wall_time_s": time.perf_counter() - tic,
+    }
+
+
+def get_training_jobs(dir_str, hyperparams):
+    """
+    One job per (tau, fold), or per fold for joint networks. The trainval sets are shared by all the jobs, see
+    get_shared_set_paths, and so are the fold assignment and the normalization statistics
+    :return: jobs: list of dict, see train_job. fingerprint: str, see get_training_fingerprint
+    """
+    set_paths = get_shared_set_paths(dir_str)
+    input_set = dataset.DataSet(set_paths["input"])
+    output_set = dataset.DataSet(set_paths["output"])
+    if input_set.shape[0] != output_set.shape[0]:
+        raise ValueError("Input and output shape mismatch!")
+    if output_set.shape[1] != len(hyperparams["loss_wts"]):
+        raise ValueError("Number of 'loss_wts' must equal number of outputs")
+
+    fold_ids = cross_val.get_fold_ids(
+        input_set.index, hyperparams["num_cv_folds"], dir_str.shuffled_indices_path
+    )
+    # Every fold needs validation samples, for its early stopping
+    cross_val.get_fold_sizes(fold_ids, hyperparams["num_cv_folds"])
+    # Normalization statistics of the training samples of each fold, so that none leak from the validation samples
+    norm_means, norm_variances = cross_val.get_cached_fold_norm_stats(
+        input_set.values,
+        input_set.columns,
+        fold_ids,
+        hyperparams["num_cv_folds"],
+        dataset.find_set_paths(dir_str.data_dir, "input", "trainval"),
+        dir_str.norm_stats_path,
+    )
+
+    taus_to_train = (
+        [None] if hyperparams["joint_quantiles"] else hyperparams["PI_percentiles"]
+    )
+    jobs = [
+        {
+            "tau": tau,
+            "fold_idx": fold_idx,
+            "set_paths": set_paths,
+            "fold_ids": fold_ids,
+            "norm_mean": norm_means[fold_idx],
+            "norm_variance": norm_variances[fold_idx],
+            "hyperparams": hyperparams,
+            "models_dir": dir_str.models_dir,
+            "ckpts_dir": dir_str.ckpts_dir,
+            "logs_dir": dir_str.logs_dir,
+        }
+        for tau in taus_to_train
+        for fold_idx in range(hyperparams["num_cv_folds"])
+    ]
+
+    saved_set_paths = [
+        set_path
+        for input_or_output in ["input", "output"]
+        for set_path in dataset.find_set_paths(
+            dir_str.data_dir, input_or_output, "trainval"
+        )
+    ]
+    return jobs, get_training_fingerprint(
+        hyperparams, input_set, output_set, saved_set_paths
+    )
+
+
+def run_jobs(jobs, max_workers=None, threads_per_worker=None, on_job_done=None):
+    """
+    Run the training jobs in worker processes. A failed job doesn't stop the others, and is reported at the end
+    :param jobs: list of dict, see train_job
+    :param max_workers: int or None. Number of worker processes, by default one per job up to the number of cores
+    :param threads_per_worker: int or None. Number of TensorFlow threads of each worker, by default the cores split
+    evenly among the workers
+    :param on_job_done: callable or None. Called with each job and its summary as soon as the job finishes
+    :return: summary_df: pd.DataFrame of the summary of each job, see train_job
+    """
+    num_cores = (
+        len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else (os.cpu_count() or 1)
+    )
+    if max_workers is None:
+        max_workers = min(len(jobs), num_cores)
+    if threads_per_worker is None:
+        threads_per_worker = max(num_cores // max_workers, 1)
+
+    # TensorFlow is not fork-safe, so the workers are started afresh
+    mp_context = multiprocessing.get_context("spawn")
+    core_groups = get_core_groups(max_workers)
+    core_groups_queue = None
+    if core_groups is not None and len(core_groups) == max_workers:
+        core_groups_queue = mp_context.Queue()
+        for core_group in core_groups:
+            core_groups_queue.put(core_group)
+
+    print(
+        "=== Training {} networks in {} workers of {} threads ===".format(
+            len(jobs), max_workers, threads_per_worker
+        )
+    )
+    job_summaries = []
+    failed_jobs = {}
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(core_groups_queue, threads_per_worker),
+    ) as executor:
+        futures = {executor.submit(train_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                job_summary = future.result()
+            except Exception as e:
+                print("Failed {}: {!r}".format(get_job_key(job), e))
+                failed_jobs[get_job_key(job)] = e
+                continue
+            print(
+                "Trained tau {tau}, fold #{fold_idx} in {num_epochs} epochs, "
+                "best val_loss {best_val_loss:.4f}, {wall_time_s:.1f}s".format(
+                    **job_summary
+                )
+            )
+            if on_job_done is not None:
+                on_job_done(job, job_summary)
+            job_summaries.append(job_summary)
+
+    if failed_jobs:
+        raise RuntimeError(
+            "Training failed for {}, rerun to resume them".format(list(failed_jobs))
+        ) from next(iter(failed_jobs.values()))
+
+    return pd.DataFrame(job_summaries)
+
+
+def train(
+    model_name=None,
+    hyperparams=None,
+    max_workers=None,
+    threads_per_worker=None,
+    input_excel_path=INPUT_EXCEL_NAME,
+    restart=False,
+):
+    """
+    Train all the networks of a model, see get_training_jobs and run_jobs. The networks recorded as finished in the
+    manifest of a previous run are skipped, and those interrupted partway through resume from their last epoch, as
+    long as the hyperparameters and the trainval sets haven't changed since
+    :param model_name: str or None. Name of the model, whose sets were saved by data_preprocessing.py. By default the
+    model name of the workbook
+    :param hyperparams: dict or None. Hyperparameters overriding those of the workbook, see read_hyperparams
+    :param input_excel_path: pathlib.Path. Path to the config workbook
+    :param restart: bool. Whether to train all the networks from scratch, ignoring the previous runs
+    :return: summary_df: pd.DataFrame of the summary of each network, also saved in DirStructure.diag_dir
+    """
+    configs = ExcelConfigs(Path(input_excel_path).resolve())
+    hyperparams = {**read_hyperparams(configs), **(hyperparams or {})}
+    dir_str = utility.DirStructure(model_name=model_name or configs.model_name)
+
+    tic = time.perf_counter()
+    jobs, fingerprint = get_training_jobs(dir_str, hyperparams)
+
+    manifest_path = dir_str.models_dir / MANIFEST_FILENAME
+    job_records = {} if restart else read_manifest(manifest_path, fingerprint)
+    if job_records is None or restart:
+        if job_records is None:
+            print(
+                "Hyperparameters or trainval sets changed, training all networks again"
+            )
+        # The backups of the interrupted networks are stale as well
+        for job in jobs:
+            shutil.rmtree(dir_str.ckpts_dir / get_job_key(job), ignore_errors=True)
+        job_records = {}
+    else:
+        job_records = {
+            job_key: record
+            for job_key, record in job_records.items()
+            if (dir_str.models_dir / job_key).exists()
+        }
+    save_manifest(manifest_path, fingerprint, job_records)
+
+    jobs_to_run = [job for job in jobs if get_job_key(job) not in job_records]
+    if len(jobs_to_run) < len(jobs):
+        print(
+            "Skipping {} networks already trained, see {}".format(
+                len(jobs) - len(jobs_to_run), manifest_path
+            )
+        )
+
+    def record_job(job, job_summary):
+        job_records[get_job_key(job)] = job_summary
+        save_manifest(manifest_path, fingerprint, job_records)
+
+    if jobs_to_run:
+        run_jobs(jobs_to_run, max_workers, threads_per_worker, on_job_done=record_job)
+
+    # Summarizes the networks trained in the previous runs as well, in the order of the jobs
+    summary_df = pd.DataFrame([job_records[get_job_key(job)] for job in jobs])
+    summary_path = dir_str.diag_dir / TRAINING_SUMMARY_FILENAME
+    summary_df.to_csv(summary_path, index=False)
+    print(
+        "All done in {:.1f}s! Summary saved to {}".format(
+            time.perf_counter() - tic, summary_path
+        )
+    )
+
+    return summary_df
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="RESCUE training of the networks of all quantiles and folds"
+    )
+    parser.add_argument(
+        "model_name",
+        nargs="?",
+        default=None,
+        help="name of the model to train, by default the model name of the workbook",
+    )
+    parser.add_argument(
+        "--config",
+        default=INPUT_EXCEL_NAME,
+        help="config workbook, whose optional 'Training Parameters' tab sets the hyperparameters",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="train all networks from scratch, instead of resuming the previous run",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="number of worker processes, by default one per network up to the number of cores",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="number of TensorFlow threads of each worker, by default the cores split evenly among the workers",
+    )
+    parser.add_argument(
+        "--taus",
+        type=float,
+        nargs="+",
+        default=None,
+        help="target quantiles, overriding the workbook",
+    )
+    quantiles_group = parser.add_mutually_exclusive_group()
+    quantiles_group.add_argument(
+        "--joint-quantiles",
+        dest="joint_quantiles",
+        action="store_true",
+        default=None,
+        help="train one joint network per fold, instead of one network per quantile and fold",
+    )
+    quantiles_group.add_argument(
+        "--per-quantile",
+        dest="joint_quantiles",
+        action="store_false",
+        help="train one network per quantile and fold, overriding the workbook",
+    )
+    parser.add_argument("--num-cv-folds", type=int, default=None)
+    parser.add_argument("--max-epochs", type=int, default=None)
+    return parser.parse_args()
+
+
+# run as a script
+if __name__ == "__main__":
+    args = parse_args()
+    hyperparams = {
+        name: value
+        for name, value in [
+            ("PI_percentiles", args.taus),
+            ("num_cv_folds", args.num_cv_folds),
+            ("max_epochs", args.max_epochs),
+            ("joint_quantiles", args.joint_quantiles),
+        ]
+        if value is not None
+    }
+    train(
+        args.model_name,
+        hyperparams,
+        max_workers=args.max_workers,
+        threads_per_worker=args.threads_per_worker,
+        input_excel_path=args.config,
+        restart=args.restart,
+    )
@@ -21,16 +21,21 @@
 
 from pathlib import Path
 import shutil
+import pandas as pd
+
+import dataset
 
 
 class DirStructure:
     """Directory and file structure of the RESCUE model."""
 
-    def __init__(self, code_dir=Path.cwd(), model_name="rescue"):
+    def __init__(self, code_dir=Path.cwd(), model_name="rescue", clear_logs=False):
         """Initialize directory structure based on scenario name
         Args:
             code_dir (str): Path to `code` directory where all python code is located
             model_name (str): specific name of the model. Recommendation: RESCUE + VER number
+            clear_logs (bool): whether to clear the log directory. Off by default, so that the logs of an interrupted
+                training run are kept when it resumes
         """
         self.model_name = model_name
         self.code_dir = code_dir
@@ -40,8 +45,14 @@ class DirStructure:
         self.raw_data_dir = self.par_dir / "data" / "raw_data"
         # stores data checker outputs
         self.data_checker_dir = self.raw_data_dir / "data_checker_outputs"
+        # caches parsed data checker outputs
+        self.series_cache_dir = self.raw_data_dir / "series_cache"
+        # caches solar geometry and clear sky output, shared by all models
+        self.solar_cache_dir = self.raw_data_dir / "solar_cache"
         # stores extracted features
         self.data_dir = self.par_dir / "data" / self.model_name
+        # caches the intermediate results of the data preprocessing stages
+        self.pipeline_cache_dir = self.data_dir / "pipeline_cache"
         # stores extracted features
         self.output_dir = self.par_dir / "output" / self.model_name
         # training log for tensorboard
@@ -61,14 +72,17 @@ class DirStructure:
         self.shuffled_indices_path = self.data_dir / "shuffled_indices_{}.npy".format(
             self.model_name
         )
-        self.input_trainval_path = self.data_dir / "input_trainval.pkl"
-        self.output_trainval_path = self.data_dir / "output_trainval.pkl"
+        self.norm_stats_path = self.data_dir / "norm_stats_{}.npz".format(
+            self.model_name
+        )
+        # The sets have no fixed path, as they are saved in any of dataset.DATA_FORMATS and possibly in shards. They
+        # are found through read_data_set or dataset.find_set_paths
         self.pred_trainval_path = self.output_dir / "pred_trainval.pkl"
         self.training_hist_path = self.diag_dir / "training_history.npy"
         self.metrics_path = self.diag_dir / "metrics.npy"
 
-        # clear all contents in the log directory
-        if Path.exists(self.logs_dir):
+        # clear all contents in the log directory, only if asked to
+        if clear_logs and Path.exists(self.logs_dir):
             shutil.rmtree(self.logs_dir)
 
         # make these directories if they do not already exist
@@ -77,7 +91,10 @@ class DirStructure:
     def make_directories(self):
         for folder in [
             self.data_dir,
+            self.pipeline_cache_dir,
             self.raw_data_dir,
+            self.series_cache_dir,
+            self.solar_cache_dir,
             self.output_dir,
             self.logs_dir,
             self.ckpts_dir,
@@ -86,3 +103,45 @@ class DirStructure:
             self.plots_dir,
         ]:
             Path.mkdir(folder, parents=True, exist_ok=True)
+
+
+def read_data_set(data_dir, input_or_output, set_name):
+    """
+    Read in a set saved by the data preprocessing, stitching it back together if it was saved in shards. Sets saved
+    in one piece in the "npy" format are memory-mapped rather than read in, see dataset.DataSet
+    :param data_dir: pathlib.Path. Directory holding the sets, usually DirStructure.data_dir
+    :param input_or_output: str. Either "input" or "output"
+    :param set_name: str. One of "trainval", "test" or "infer"
+    :return: set_df: pd.DataFrame of the set
+    """
+    set_paths = dataset.find_set_paths(data_dir, input_or_output, set_name)
+    if not set_paths:
+        raise FileNotFoundError(
+            "{}_{} not found in {}, nor any shard of it!".format(
+                input_or_output, set_name, data_dir
+            )
+        )
+    if len(set_paths) == 1:
+        return dataset.load_data_set(set_paths[0])
+
+    return pd.concat([dataset.load_data_set(set_path) for set_path in set_paths])
+
+
+def open_data_set(data_dir, input_or_output, set_name):
+    """
+    Open a set saved in one piece in the "npy" format, without reading any of its values in yet. Columns and time
+    ranges can then be selected lazily, see dataset.DataSet
+    :param data_dir: pathlib.Path. Directory holding the sets, usually DirStructure.data_dir
+    :param input_or_output: str. Either "input" or "output"
+    :param set_name: str. One of "trainval", "test" or "infer"
+    :return: dataset.DataSet
+    """
+    set_path = dataset.get_set_path(data_dir, input_or_output, set_name, "npy")
+    if not set_path.is_dir():
+        raise FileNotFoundError(
+            "{} not found! Only sets saved in one piece in the npy format can be opened".format(
+                set_path
+            )
+        )
+
+    return dataset.DataSet(set_path)